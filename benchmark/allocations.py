@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# Counts the values the Python NariVM allocates while running a benchmark program, and the
+# peak memory (RSS) of the process that runs it.
+# Usage: python3 benchmark/allocations.py [source files]
+
+import os
+import resource
+import runpy
+import subprocess
+import sys
+
+import harness
+import narivm
+
+
+def run_counting_values(filename: str):
+    """Runs a program on the Python NariVM inside this process, counting every value built,
+    and reports the count and the peak RSS on the standard error.
+    """
+    value_count = 0
+    original_init = narivm.Value.__init__
+
+    def counting_init(self, *args, **kwargs):
+        nonlocal value_count
+        value_count += 1
+        original_init(self, *args, **kwargs)
+
+    narivm.Value.__init__ = counting_init
+    sys.argv = [harness.KAT_LOCATION, f"--vm={harness.PYTHON_VMS[0]}", filename]
+    try:
+        runpy.run_path(harness.KAT_LOCATION, run_name="__main__")
+    except SystemExit:
+        pass
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{value_count} {peak_rss}", file=sys.stderr)
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        run_counting_values(sys.argv[2])
+        return
+    for filename in harness.program_filenames():
+        result = harness.run_script([__file__, "--child", filename], stderr=subprocess.PIPE)
+        value_count, peak_rss = result.stderr.split()[-2:]
+        print(f"{os.path.basename(filename)}: {int(value_count)} values allocated, {int(peak_rss) // 1024} MiB peak RSS.")
+
+
+if __name__ == "__main__":
+    main()
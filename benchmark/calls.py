@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# Measures how long the Python NariVM takes to run a call-heavy program with
+# the $_ table built on every call and with the fast call convention.
+# Usage: python3 benchmark/calls.py [source file]
+
+import copy
+import os
+import sys
+
+import harness
+import kat
+import narivm
+
+
+def best_time(instructions) -> float:
+    code_listing = narivm.load_bytecode(kat.instructions_to_bytecode(kat.resolve_variable_slots(kat.optimize_peephole(instructions))))
+    return harness.time_code_listing(code_listing)
+
+
+def main():
+    filename = os.path.join(harness.BENCHMARK_LOCATION, "calls.kat")
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    instructions = kat.eliminate_dead_functions(harness.compile_program(filename))
+    table_time = best_time(copy.deepcopy(instructions))
+    fast_time = best_time(kat.use_fast_calls(instructions))
+    print(f"Table calls: {table_time:.3f}s.")
+    print(f"Fast calls:  {fast_time:.3f}s ({table_time / fast_time:.2f}x faster).")
+
+
+if __name__ == "__main__":
+    main()
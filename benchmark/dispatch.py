@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Measures what a single command costs on the Python NariVM, for commands found at the
+# start, the middle and the end of the VM's command list. Each listing runs one cheap
+# command many times, so the differences between commands come from their own work and
+# from how long the VM takes to find the code that runs them.
+# Usage: python3 benchmark/dispatch.py [repetitions]
+
+import sys
+
+import harness
+import narivm
+
+# (Command, Nambly that sets the stack up, Nambly repeated) in the order the VM lists them
+CASES = [
+    ("PUSH", "", "PUSH 1"),
+    ("JUMP", "", "JUMP L{n}\n@L{n}"),
+    ("NIL?", "PUSH 1", "NIL?"),
+    ("LNOT", "PUSH 1", "LNOT"),
+    ("TRIM", 'PUSH "a"', "TRIM"),
+    ("SWAP", "PUSH 1\nPUSH 2", "SWAP"),
+    ("FLOR", "PUSH 1", "FLOR"),
+]
+
+
+def time_listing(code: str):
+    """Returns the best time out of five runs of a Nambly listing, and its command count.
+    """
+    code_listing = []
+
+    def load():
+        narivm.label_to_pc.clear()
+        narivm.execution_stack.clear()
+        code_listing[:] = narivm.generate_label_map(narivm.split_lines(code))
+
+    best_time = harness.best_time(lambda: narivm.execute_code_listing(code_listing), load)
+    return best_time, len(code_listing)
+
+
+def main():
+    repetitions = 100000
+    if len(sys.argv) > 1:
+        repetitions = int(sys.argv[1])
+    for name, setup, body in CASES:
+        code = setup + "\n" + "\n".join(body.format(n=n) for n in range(repetitions))
+        best_time, command_count = time_listing(code)
+        print(f"{name}: {best_time * 1e9 / command_count:.0f} ns per command.")
+
+
+if __name__ == "__main__":
+    main()
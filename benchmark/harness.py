@@ -0,0 +1,87 @@
+# Helpers shared by the benchmark scripts: where the compiler and the Python NariVM live,
+# the ways the Python NariVM can run a program, a timing loop and a runner for kat.py.
+# The benchmarks import it as their first module, so they can import kat and narivm after it.
+
+import glob
+import io
+import os
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+from typing import Callable, List, Optional
+
+BENCHMARK_LOCATION = os.path.dirname(os.path.abspath(__file__))
+KAT_LOCATION = os.path.join(BENCHMARK_LOCATION, "..", "kat.py")
+# --vm modes of the Python NariVM, the plain main loop first
+PYTHON_VMS = ("python", "threaded", "transpiled", "tracing")
+
+sys.path.insert(0, os.path.join(BENCHMARK_LOCATION, ".."))
+sys.path.insert(0, os.path.join(BENCHMARK_LOCATION, "..", "old"))
+import kat
+import narivm
+
+
+def best_time(function: Callable[[], object], setup: Optional[Callable[[], object]] = None, runs: int = 5) -> float:
+    """Returns the best time out of several calls to a function, calling setup (untimed)
+    before each one.
+    """
+    best = None
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def reset_vm_state():
+    """Clears everything a previous run left in the Python NariVM.
+    """
+    narivm.variable_tables[:] = [{}]
+    narivm.slot_frames.clear()
+    narivm.execution_stack.clear()
+
+
+def time_code_listing(code_listing: List[narivm.Command]) -> float:
+    """Returns the best time the Python NariVM takes to run a loaded program, without
+    showing what it prints.
+    """
+    def execute():
+        with redirect_stdout(io.StringIO()):
+            narivm.execute_code_listing(code_listing)
+    return best_time(execute, reset_vm_state)
+
+
+def compile_program(filename: str) -> List[kat.Instruction]:
+    """Compiles a program and the standard library into unoptimized Nambly, skipping the cache.
+    """
+    with open(filename) as f:
+        code = f.read()
+    kat.global_compiler_state.use_cache = False
+    instructions = kat.file_to_nambly(os.path.join(kat.STDLIB_LOCATION, "stdlib.kat"))
+    instructions += kat.code_to_nambly(code, os.path.abspath(filename))
+    kat.resolve_shadowed_calls(instructions)
+    return instructions
+
+
+def program_filenames() -> List[str]:
+    """Returns the programs given in the command line, or every bundled benchmark program.
+    """
+    filenames = sys.argv[1:] or sorted(glob.glob(os.path.join(BENCHMARK_LOCATION, "*.kat")))
+    return [os.path.abspath(filename) for filename in filenames]
+
+
+def run_script(arguments: List[str], stderr=subprocess.DEVNULL) -> subprocess.CompletedProcess:
+    """Runs a Python script in a new process from the benchmark directory, throwing away
+    what it prints.
+    """
+    return subprocess.run([sys.executable] + arguments, cwd=BENCHMARK_LOCATION,
+                          stdout=subprocess.DEVNULL, stderr=stderr, text=True, check=True)
+
+
+def run_kat(filename: str, vm: str) -> subprocess.CompletedProcess:
+    return run_script([KAT_LOCATION, f"--vm={vm}", filename])
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# Measures how long the Python NariVM takes to run a call-heavy program with
+# and without its small functions inlined into their call sites.
+# Usage: python3 benchmark/inlining.py [source file]
+
+import copy
+import os
+import sys
+
+import harness
+import kat
+import narivm
+
+
+def best_time(instructions) -> float:
+    instructions = kat.use_fast_calls(kat.eliminate_dead_functions(instructions))
+    code_listing = narivm.load_bytecode(kat.instructions_to_bytecode(kat.resolve_variable_slots(kat.optimize_peephole(instructions))))
+    return harness.time_code_listing(code_listing)
+
+
+def main():
+    filename = os.path.join(harness.BENCHMARK_LOCATION, "inlining.kat")
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    instructions = harness.compile_program(filename)
+    call_time = best_time(copy.deepcopy(instructions))
+    inlined_time = best_time(kat.inline_functions(instructions))
+    print(f"Calls:   {call_time:.3f}s.")
+    print(f"Inlined: {inlined_time:.3f}s ({call_time / inlined_time:.2f}x faster).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# Measures how long the Python NariVM takes to load a program from Nambly text
+# and from bytecode (.nvb).
+# Usage: python3 benchmark/loader.py [source file] [repetitions]
+
+import os
+import sys
+
+import harness
+import kat
+import narivm
+
+
+def clear_loaded_program():
+    narivm.label_to_pc.clear()
+    narivm.line_table.clear()
+
+
+def main():
+    filename = os.path.join(kat.STDLIB_LOCATION, "stdlib.kat")
+    repetitions = 10
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    if len(sys.argv) > 2:
+        repetitions = int(sys.argv[2])
+    with open(filename) as f:
+        code = f.read() * repetitions
+    kat.global_compiler_state.use_cache = False
+    instructions = kat.code_to_nambly(code, os.path.abspath(filename))
+    nambly = kat.instructions_to_nambly(instructions)
+    bytecode = kat.instructions_to_bytecode(instructions)
+    text_time = harness.best_time(lambda: narivm.generate_label_map(narivm.split_lines(nambly)), clear_loaded_program)
+    bytecode_time = harness.best_time(lambda: narivm.load_bytecode(bytecode), clear_loaded_program)
+    print(f"Nambly:   {len(nambly)} bytes loaded in {text_time:.3f}s.")
+    print(f"Bytecode: {len(bytecode)} bytes loaded in {bytecode_time:.3f}s ({text_time / bytecode_time:.1f}x faster).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# Measures the throughput of the Katalyn scanner, in lines per second.
+# Usage: python3 benchmark/scanner.py [source file] [repetitions]
+
+import os
+import sys
+
+import harness
+import kat
+
+
+def main():
+    filename = os.path.join(kat.STDLIB_LOCATION, "stdlib.kat")
+    repetitions = 40
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    if len(sys.argv) > 2:
+        repetitions = int(sys.argv[2])
+    with open(filename) as f:
+        code = f.read() * repetitions
+    line_count = code.count("\n")
+    best_time = harness.best_time(lambda: kat.scan_source(code, filename))
+    print(f"Scanned {line_count} lines in {best_time:.3f}s ({int(line_count / best_time)} lines per second).")
+
+
+if __name__ == "__main__":
+    main()
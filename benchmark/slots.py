@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# Measures how long the Python NariVM takes to run a program that looks its
+# variables up by name and the same program compiled with numbered slots.
+# Usage: python3 benchmark/slots.py [source file]
+
+import os
+import sys
+
+import harness
+import kat
+import narivm
+
+
+def main():
+    filename = os.path.join(harness.BENCHMARK_LOCATION, "variables.kat")
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    with open(filename) as f:
+        code = f.read()
+    kat.global_compiler_state.use_cache = False
+    instructions = kat.optimize_peephole(kat.code_to_nambly(code, os.path.abspath(filename)))
+    name_listing = narivm.generate_label_map(narivm.split_lines(kat.instructions_to_nambly(instructions)))
+    name_time = harness.time_code_listing(name_listing)
+    slot_listing = narivm.load_bytecode(kat.instructions_to_bytecode(kat.resolve_variable_slots(instructions)))
+    slot_time = harness.time_code_listing(slot_listing)
+    print(f"Names: {name_time:.3f}s.")
+    print(f"Slots: {slot_time:.3f}s ({name_time / slot_time:.2f}x faster).")
+
+
+if __name__ == "__main__":
+    main()
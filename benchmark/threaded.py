@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# Measures how long the bundled benchmark programs take on the Python NariVM, running
+# each command through the main loop (--vm=python), compiled into closures
+# (--vm=threaded), transpiled into Python (--vm=transpiled) and with its hot loops
+# compiled into Python (--vm=tracing).
+# Usage: python3 benchmark/threaded.py [source files]
+
+import os
+
+import harness
+
+
+def main():
+    loop_vm, *compiled_vms = harness.PYTHON_VMS
+    for filename in harness.program_filenames():
+        loop_time = harness.best_time(lambda: harness.run_kat(filename, loop_vm), runs=3)
+        results = []
+        for vm in compiled_vms:
+            vm_time = harness.best_time(lambda: harness.run_kat(filename, vm), runs=3)
+            results.append(f"{vm} {vm_time:.2f}s ({loop_time / vm_time:.2f}x faster)")
+        print(f"{os.path.basename(filename)}: {loop_time:.2f}s -> {', '.join(results)}.")
+
+
+if __name__ == "__main__":
+    main()
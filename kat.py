@@ -10,7 +10,6 @@
 # Started by Lartu on July 3, 2024 (01:13 AM).
 # 
 # For 0.0.2:
-# TODO: Lógica de cortocircuito para 'and' and 'or' (Es saltar al final del right side si and es false u or es true en el left side)
 # TODO: poder seek en un archivo
 # TODO: and, or e in en lugar de &&, || y :: (opcionales)
 # TODO: Not in operator: !:
@@ -18,15 +17,29 @@
 
 from __future__ import annotations
 import sys
-from typing import Dict, List, Tuple, Optional, Set
+from typing import Callable, Dict, List, Tuple, Optional, Set, Union
 from enum import Enum, auto
 from sys import exit
-import time
-import random
 import os
+import re
+import math
+import hashlib
+import marshal
+import atexit
+import struct
+import time
+import importlib.util
+from types import CodeType
 
 VERSION = "0.1.0"
 OPERATOR_PRESEDENCE = ("*", "^", "/", "%", "//", "+", "&", "-", "::", "!", "<", ">", "<=", ">=", "<>", "!=", "=", "||", "&&")
+# Operators earlier in OPERATOR_PRESEDENCE bind tighter, so they get a higher binding power.
+OPERATOR_BINDING_POWER = {operator: len(OPERATOR_PRESEDENCE) - index for index, operator in enumerate(OPERATOR_PRESEDENCE)}
+OPERATOR_OPCODES = {
+    "*": "MULT", "^": "POWR", "/": "FDIV", "//": "IDIV", "-": "SUBT", "+": "ADDV", "&": "JOIN", "%": "MODL",
+    "=": "ISEQ", "<>": "ISNE", "!=": "ISNE", "<": "ISLT", ">": "ISGT", "<=": "ISLE", ">=": "ISGE",
+    "&&": "LAND", "||": "LGOR", "::": "ISIN"
+}
 LOOP_TAGS = ("while", "until", "for")
 NON_DEF_BLOCK_TAGS = ("if", "unless", "while", "until")
 ARGS_VAR = "$_"
@@ -38,6 +51,39 @@ EXEC_EXITCODE_VAR = "$_exitcode"
 CALLER_VAR = "$_caller"
 CONTEXT_VAR = "$_context"
 STDLIB_LOCATION = os.path.abspath(os.path.dirname(__file__))
+CACHE_LOCATION = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "katalyn")
+CACHE_SIZE_LIMIT = 64 * 1024 * 1024  # Bytes the compilation cache can take before its least recently used entries are deleted
+CACHE_STALE_SECONDS = 24 * 60 * 60  # Time after which entries written by other versions of the compiler are deleted
+CACHE_PREFIX_LENGTH = 16  # Characters of the compiler hash every cache entry name starts with
+# Arguments of these opcodes may be labels or variable names numbered after the block count
+JUMP_OPCODES = ("JUMP", "JPIF", "RNXT", "PNXT")  # Opcodes that jump to the label they take, RNXT and PNXT once their iterator is over
+RELOCATABLE_OPCODES = ("@", "JUMP", "JPIF", "RNXT", "PNXT", "CALL", "VSET", "VGET", "GSET", "NEXT", "UNST")
+BYTECODE_MAGIC = b"NVB\0"
+BYTECODE_VERSION = 3
+BYTECODE_NUMBER_REGEX = re.compile(r"^[+-]?[0-9]*(\.[0-9]*)?$")
+# Opcodes that address variables by slot (see resolve_variable_slots). Their operand is
+# the slot number, or "<frame slot> <global slot>" for the ones that fall back to globals
+GLOBAL_SLOT_OPCODES = ("GGET", "GPUT", "GDEL", "GNXT")
+FALLBACK_SLOT_OPCODES = ("LGET", "LDEL", "LNXT")
+SLOT_OPCODES = ("ADFR", "ARGS", "LPUT") + GLOBAL_SLOT_OPCODES + FALLBACK_SLOT_OPCODES
+# What parse_command_def emits at the start of every function, after its ADSC
+FUNCTION_PROLOGUE = (("ARRR", None), ("VSET", '"_"'), ("VSET", '"_caller"'), ("PUSH", None), ("VSET", '"_context"'), ("PNIL", None))
+NO_INLINE_MODIFIER = "noinline"
+INLINE_SIZE_LIMIT = 40  # Largest function body, in instructions, the optimizer copies into its call sites
+ARGUMENT_INDEX_REGEX = re.compile(r"^[1-9][0-9]*$")
+FUNCTION_LABEL_REGEX = re.compile(r"^FUN_(\d+)_(START|END|POST)$")
+RELOCATABLE_NAME_REGEX = re.compile(r'^("?(?:FUN_|LOOP_|COND_|EXIT_IF_|LOGIC_|_itr))(\d+)((?:_START|_END|_POST|_RIGHT|_TRUE|_FALSE)?"?)$')
+PYTHON_VALUE_OPERATIONS = {  # Opcodes the Python NariVM runs with an apply_ function, and how many values they pop
+    "ADDV": 2, "SUBT": 2, "MULT": 2, "FDIV": 2, "IDIV": 2, "POWR": 2, "MODL": 2, "ISGT": 2, "ISLT": 2, "ISGE": 2, "ISLE": 2,
+    "ISEQ": 2, "ISNE": 2, "JOIN": 2, "PGET": 2, "LAND": 2, "LGOR": 2, "ISIN": 2, "RITR": 2,
+    "NIL?": 1, "LNOT": 1, "TRIM": 1, "SLEN": 1, "FLOR": 1,
+}
+# Opcodes that either fail or leave a value on the stack, so a store right after them always has a value to pop
+VALUE_OPCODES = ("PUSH", "PNIL", "DUPL", "VGET", "TABL", "ARRR") + tuple(PYTHON_VALUE_OPERATIONS)
+# Opcodes that always leave a value other than nil on the stack, or fail
+NON_NIL_OPCODES = ("PUSH", "TABL", "ARRR") + tuple([opcode for opcode in PYTHON_VALUE_OPERATIONS if opcode not in ("PGET", "RITR")])
+PYTHON_NESTING_LIMIT = 40  # Deepest indentation the Python transpiler emits before falling back to a block loop
+PYTHON_LOOP_NESTING_LIMIT = 16  # Python can't compile more than 20 nested loops
 
 
 class ScopeSearchType(Enum):
@@ -49,12 +95,21 @@ class ScopeSearchType(Enum):
 class CompilerState:
     def __init__(self):
         self.block_count: int = 0
-        self.__block_end_code_stack: List[Tuple[str, Token]] = []
+        self.__block_end_code_stack: List[Tuple[List[Instruction], Token, int]] = []
         self.__declared_variables: List[Dict[str, str]] = []
         self.__open_loop_tags: List[Tuple[str, str]] = []
         self.__function_to_labels: Dict[str, Tuple[str, str]] = {}
         self.__expected_functions: Dict[str, Token, Tuple[str, str]] = {}
-        self.shadower_functions: List[Tuple[str, str]] = []  # Must be ordered. Thus, a list.
+        self.shadowed_functions: Dict[str, str] = {}  # Shadowed start label -> shadower start label
+        self.use_cache: bool = True
+        self.optimization_level: int = 1  # 0 disables every optimization
+        self.removed_instructions: Dict[str, int] = {}  # Optimization -> instructions it removed
+        self.peephole_hits: Dict[str, int] = {}  # Peephole rule -> times it was applied
+        self.inlined_calls: Dict[str, int] = {}  # Function name -> calls to it that were inlined
+        self.module_dependencies: List[List[Tuple[str, str]]] = []  # Files read by each module being compiled
+        self.compiled_modules: Set[str] = set()  # Absolute paths of the files already compiled, to import them once
+        self.compiler_file_hashes: Dict[str, str] = {}  # Path -> hash of kat.py and old/narivm.py, read once per run
+        self.cache_pruned: bool = False
         self.add_scope()
 
     def add_open_loop(self, start_label: str, end_label: str) -> None:
@@ -81,10 +136,10 @@ class CompilerState:
     def add_scope(self) -> None:
         self.__declared_variables.append({})
 
-    def del_scope(self, command_token: Token) -> str:
+    def del_scope(self, command_token: Token) -> List[Instruction]:
         """Deletes a variable scope only if the current scope is that of a function
         """
-        compiled_code: str = ""
+        compiled_code: List[Instruction] = []
         if self.__block_end_code_stack:
             if self.__block_end_code_stack[-1][1].value in self.__function_to_labels:
                 self.__declared_variables.pop()
@@ -146,14 +201,14 @@ class CompilerState:
                 del self.__declared_variables[i][var_name]
             i -= 1
 
-    def add_block_end_code(self, code: str, reference_token: Token, group_id: int = -1):
+    def add_block_end_code(self, code: List[Instruction], reference_token: Token, group_id: int = -1):
         """Sets the next block end code to be used when an 'ok;' is found.
         The reference token is there so that if that 'ok;' is missing, we
         can reference which block is missing it.
         """
         self.__block_end_code_stack.append((code, reference_token, group_id))
     
-    def get_block_end_data(self, caller_command: Token) -> Tuple[str, Token, int]:
+    def get_block_end_data(self, caller_command: Token) -> Tuple[List[Instruction], Token, int]:
         """Gets the next block end code to be used when an 'ok;' is found.
         """
         if not self.__block_end_code_stack:
@@ -168,30 +223,33 @@ class CompilerState:
         #    parse_error(f"Duplicate function declaration for '{function_name}'.", caller_command.line, caller_command.file)
         self.__function_to_labels[function_name] = (start_label, end_label, post_label)
 
-    def get_function_label(self, caller_command: Token, force_new: bool = False) -> Tuple[str, str]:
+    def get_function_label(self, caller_command: Token, force_new: bool = False) -> Tuple[str, str, str]:
+        """Returns the start, end and post labels of a function. Calls (not force_new) get
+        the labels of the latest declaration, declarations (force_new) get new ones.
+        """
         function_name: str = caller_command.value
-        if function_name not in self.__function_to_labels or force_new:
-            if force_new and function_name in self.__function_to_labels:
-                #parse_error(
-                #    f"Redefining function '{caller_command.value}'.",
-                #    caller_command.line,
-                #    caller_command.file,
-                #)
-                self.shadower_functions.append((caller_command.value, self.__function_to_labels[caller_command.value]))
-                # This function                 ^^^ is a shadower to  ^^^ this function
-                # The proper way to add function shadowing would be to replace all jumps and calls
-                # to the previous function with calls to the new one
-            if not force_new:  # The force new logic doesn't make sense in function calls, only defs.
-                if function_name in self.__expected_functions:
-                    return self.__expected_functions[caller_command.value][1]
-            block_number: int = self.block_count
-            self.block_count += 1
-            start_label: str = f"FUN_{block_number}_START"
-            end_label: str = f"FUN_{block_number}_END"
-            post_label: str = f"FUN_{block_number}_POST"
-            self.__expected_functions[caller_command.value] = [caller_command, (start_label, end_label, post_label)]
-            return (start_label, end_label, post_label)
-        return self.__function_to_labels[function_name]
+        if function_name in self.__function_to_labels and not force_new:
+            return self.__function_to_labels[function_name]
+        if function_name in self.__expected_functions and function_name not in self.__function_to_labels:
+            # Either a call to a function that hasn't been declared yet or the declaration of
+            # a function that was called before. Both have to use the labels of the first call.
+            return self.__expected_functions[function_name][1]
+        block_number: int = self.block_count
+        self.block_count += 1
+        start_label: str = f"FUN_{block_number}_START"
+        end_label: str = f"FUN_{block_number}_END"
+        post_label: str = f"FUN_{block_number}_POST"
+        if function_name in self.__function_to_labels:
+            #parse_error(
+            #    f"Redefining function '{caller_command.value}'.",
+            #    caller_command.line,
+            #    caller_command.file,
+            #)
+            # This function shadows the previous declaration, so every call to that
+            # declaration (even the ones before this point) must call this one instead.
+            self.shadowed_functions[self.__function_to_labels[function_name][0]] = start_label
+        self.__expected_functions[function_name] = [caller_command, (start_label, end_label, post_label)]
+        return (start_label, end_label, post_label)
     
     def check_for_errors(self):
         """Checks that the state was left in a valid state after compiling.
@@ -206,6 +264,36 @@ class CompilerState:
                     self.__expected_functions[function][0].file,
                 )
 
+    def count_removed_instructions(self, optimization: str, count: int):
+        """Adds to the number of instructions an optimization removed, for the -p switch.
+        """
+        self.removed_instructions[optimization] = self.removed_instructions.get(optimization, 0) + count
+
+    def get_at_top_level(self) -> bool:
+        """Returns if the current code is outside of every block and function.
+        """
+        return not self.__block_end_code_stack and len(self.__declared_variables) == 1
+
+    def get_global_variables(self) -> Dict[str, str]:
+        """Returns a copy of the global scope.
+        """
+        return dict(self.__declared_variables[0])
+
+    def get_declared_functions(self) -> Dict[str, Tuple[str, str, str]]:
+        """Returns a copy of the table of declared functions and their labels.
+        """
+        return dict(self.__function_to_labels)
+
+    def link_module(self, global_variables: Dict[str, str], functions: Dict[str, Tuple[str, str, str]], shadowed_functions: Dict[str, str], filename: str):
+        """Leaves the state as if a module had just been compiled, given the global
+        scope and the functions it left behind. Used for modules loaded from the cache.
+        """
+        self.__declared_variables[0] = global_variables
+        for function_name, labels in functions.items():
+            self.__function_to_labels[function_name] = labels
+            self.__expected_functions[function_name] = [Token(function_name, 0, filename, LexType.WORD), labels]
+        self.shadowed_functions.update(shadowed_functions)
+
     def get_in_function_declaration(self) -> bool:
         """Returns if the current code is inside a function declaration.
         """
@@ -243,11 +331,11 @@ class LexType(Enum):
 
 
 class Token:
-    def __init__(self, value: str, line: int, file: str) -> None:
+    def __init__(self, value: str, line: int, file: str, type: LexType = LexType.UNKNOWN) -> None:
         self.value: str = value
         self.line: int = line
         self.file: str = file
-        self.type: LexType = LexType.UNKNOWN
+        self.type: LexType = type
 
     def set_type(self, type: LexType):
         self.type = type
@@ -296,6 +384,36 @@ class Token:
             parse_error(f"{self} is not a variable.", self.line, self.file)
 
 
+class Instruction:
+    """A single Nambly instruction and the source line it was compiled from.
+    Labels use the opcode '@' and comments the opcode ';'; their argument
+    is the label name or the comment text.
+    """
+    def __init__(self, opcode: str, argument: Optional[str] = None, line: int = 0, file: str = "") -> None:
+        self.opcode: str = opcode
+        self.argument: Optional[str] = argument
+        self.line: int = line
+        self.file: str = file
+        self.argument_count: int = -1  # Number of arguments a CALL pushes, -1 if unknown
+
+    def set_location(self, line: int, file: str):
+        self.line = line
+        self.file = file
+
+    def __repr__(self):
+        return f"{self.to_nambly()} ({self.file}:{self.line})"
+
+    def to_nambly(self) -> str:
+        """Returns the instruction as a line of Nambly code.
+        """
+        if self.opcode in ("@", ";"):
+            return self.opcode + self.argument
+        elif self.argument is None:
+            return self.opcode
+        else:
+            return f"{self.opcode} {self.argument}"
+
+
 def katalyn_error(title: str, lines: List[str]):
     """Prints a Katalyn standard error with the passed lines and exits.
     """
@@ -364,121 +482,200 @@ def parse_error(message: str, line: int, filename: str):
     katalyn_error(error_title, error_lines)
 
 
-def tokenize_source(code: str, filename: str) -> List[List[Token]]:
-    """Takes Katalyn source code and splits it into tokens.
+SCANNER_REGEX = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<block_comment>\(\*)
+  | (?P<inline_comment>\#)
+  | (?P<string>")
+  | (?P<access_string>\{)
+  | (?P<semicolon>;)
+  | (?P<glyph>>=|<=|::|<>|!=|//|&&|\|\||\.\.|[()\[\]=<>!+\-/&%^*:,}])
+  | (?P<word>(?:[^\s(){}\[\]=<>!+\-/&%^*:\#,;"|.]|\|(?!\|)|\.(?!\.))+)
+""", re.VERBOSE)
+WORD_REGEX = re.compile(r"""
+    (?P<VARIABLE>\$[A-Za-z_0-9]+)
+  | (?P<TABLE>table)
+  | (?P<INTEGER>[0-9]+)
+  | (?P<FLOAT>[0-9]+\.[0-9]+)
+  | (?P<WORD>[A-Za-z_][A-Za-z_0-9]*)
+""", re.VERBOSE)
+GLYPH_TYPES = {
+    "(": LexType.PAR_OPEN,
+    ")": LexType.PAR_CLOSE,
+    "[": LexType.ACCESS_OPEN,
+    "]": LexType.ACCESS_CLOSE,
+    ":": LexType.DECORATION,
+    ",": LexType.DECORATION,
+    "..": LexType.DECORATION,
+}
+STRING_BODY_REGEX = re.compile(r'[^"\\]*')
+ACCESS_STRING_BODY_REGEX = re.compile(r'[^}\\]*')
+INLINE_COMMENT_END_REGEX = re.compile(r"\n|\(\*")
+BLOCK_COMMENT_MARK_REGEX = re.compile(r"\n|\(\*|\*\)")
+WHITESPACE_REGEX = re.compile(r"\s*")
+STRING_ESCAPES = {"n": "\n", "t": "\t"}
+
+
+def classify_word(word: str, line: int, filename: str) -> Token:
+    """Returns a typed token for a word (anything that is not a string or a glyph).
+    Invalid words are returned with the UNKNOWN type.
+    """
+    match = WORD_REGEX.fullmatch(word)
+    if match is None:
+        return Token(word, line, filename)
+    return Token(word, line, filename, LexType[match.lastgroup])
+
+
+def classify_glyph(glyph: str, line: int, filename: str) -> Token:
+    """Returns a typed token for one of the one or two character glyphs.
+    Invalid glyphs are returned with the UNKNOWN type.
+    """
+    if glyph in GLYPH_TYPES:
+        return Token(glyph, line, filename, GLYPH_TYPES[glyph])
+    elif glyph in OPERATOR_PRESEDENCE:
+        return Token(glyph, line, filename, LexType.OPERATOR)
+    return Token(glyph, line, filename)
+
+
+def invalid_token_error(token: Token):
+    """Prints the lexing error for a token that couldn't be classified and exits.
+    """
+    if token.value[0] == "$":
+        lexing_error(f"The string '{token.value}' is not a valid variable name.", token.line, token.file)
+    elif is_almost_number(token.value):
+        lexing_error(f"The string '{token.value}' is not a valid number.", token.line, token.file)
+    else:
+        lexing_error(f"The string '{token.value}' is not a valid identifier.", token.line, token.file)
+
+
+def scan_string(code: str, i: int, line_num: int, body_regex: re.Pattern, terminator: str) -> Tuple[str, int, int]:
+    """Scans the body of a string (or access string) starting right after its opening
+    character. Returns the unescaped value, the position after the terminator (or -1
+    if the string is never closed) and the updated line number.
+    """
+    chunks: List[str] = []
+    code_length: int = len(code)
+    while True:
+        match = body_regex.match(code, i)
+        chunk = match.group()
+        if chunk:
+            chunks.append(chunk)
+            line_num += chunk.count("\n")
+        i = match.end()
+        if i >= code_length:
+            return "".join(chunks), -1, line_num
+        if code[i] == terminator:
+            return "".join(chunks), i + 1, line_num
+        # Escape sequence
+        if i + 1 >= code_length:
+            return "".join(chunks), -1, line_num
+        escaped_char = code[i + 1]
+        if escaped_char.isspace():
+            # A backslash followed by whitespace skips all that whitespace
+            match = WHITESPACE_REGEX.match(code, i + 1)
+            line_num += match.group().count("\n")
+            i = match.end()
+        else:
+            chunks.append(STRING_ESCAPES.get(escaped_char, escaped_char))
+            i += 2
+
+
+def skip_comment(code: str, i: int, line_num: int, depth: int) -> Tuple[int, int]:
+    """Skips an inline comment (depth 0) or a (*...*) comment (depth 1). (*...*) comments
+    can be opened and closed from within an inline comment, and an inline comment only
+    ends on a newline. Returns the position after the comment and the updated line number.
+    """
+    in_inline_comment: bool = depth == 0
+    code_length: int = len(code)
+    while i < code_length:
+        if depth == 0:
+            if not in_inline_comment:
+                break
+            match = INLINE_COMMENT_END_REGEX.search(code, i)
+        else:
+            match = BLOCK_COMMENT_MARK_REGEX.search(code, i)
+        if match is None:
+            return code_length, line_num
+        mark = match.group()
+        if mark == "\n":
+            line_num += 1
+            in_inline_comment = False
+        elif mark == "(*":
+            depth += 1
+        else:
+            depth -= 1
+        i = match.end()
+    return i, line_num
+
+
+def scan_source(code: str, filename: str) -> List[List[Token]]:
+    """Takes Katalyn source code and splits it into lines of typed tokens in a single pass.
     """
-    last_string_open_line = 1  # For error reporting purposes
-    line_num = 1
     lines: List[List[Token]] = []
     current_line: List[Token] = []
-    code += " "  # To simplify tokenization
-    current_token = ""
-    in_string = False
-    in_access_string = False
-    comment_depth: int = 0
-    in_inline_comment: bool = False
-    # Katalyn supports nested comments, but doesn't make any distinction between (* ... *) inside strings
-    # once that string is inside an already open comment (such as (* "(* *)" *))
-    i = 0
-    while i < len(code) - 1:
-        current_char = code[i]
-        next_char = code[i + 1]
-        if not in_inline_comment and not in_string and not in_access_string and comment_depth == 0 and current_char == "#":
-            # Inline comment
-            in_inline_comment = True
-        elif not in_string and not in_access_string and current_char == "(" and next_char == "*":
-            # (*...*) comments can be opened and closed from within an inline comment
-            comment_depth += 1
-            i += 1
-        elif comment_depth > 0 and not in_string and not in_access_string and current_char == "*" and next_char == ")":
-            # (*...*) comments can be opened and closed from within an inline comment
-            comment_depth -= 1
-            i += 1
-        elif not in_inline_comment and comment_depth == 0 and (in_string or in_access_string) and current_char == '\\':
-            # This block should always go before any that match "" or {}
-            if next_char == "n":
-                current_token += "\n"
-            elif next_char == "t":
-                current_token += "\t"
-            elif next_char == '"':
-                current_token += '"'
-            elif next_char.isspace():
-                idx: int = i + 1
-                while code[idx].isspace():
-                    idx += 1
-                    i += 1
-                i -= 1
-            else:
-                current_token += next_char
-            i += 1
-        elif not in_inline_comment and comment_depth == 0 and not in_string and not in_access_string and current_char == '"':
-            if len(current_token):
-                current_line.append(Token(current_token, line_num, filename))
-            current_token = ""
-            current_token += current_char
-            in_string = True
-            last_string_open_line = line_num
-        elif not in_inline_comment and comment_depth == 0 and in_string and not in_access_string and current_char == '"':
-            current_token += current_char
-            in_string = False
-            if len(current_token):
-                current_line.append(Token(current_token, last_string_open_line, filename))
-            current_token = ""
-        elif not in_inline_comment and comment_depth == 0 and not in_string and not in_access_string and current_char == '{':
-            if len(current_token):
-                current_line.append(Token(current_token, line_num, filename))
-            current_token = ""
-            current_line.append(Token("[", line_num, filename))
-            current_token += '"'
-            in_access_string = True
-            last_string_open_line = line_num
-        elif not in_inline_comment and comment_depth == 0 and not in_string and in_access_string and current_char == '}':
-            current_token += '"'
-            in_access_string = False
-            if len(current_token):
-                current_line.append(Token(current_token, last_string_open_line, filename))
-            current_token = ""
-            current_line.append(Token("]", line_num, filename))
-        elif not in_inline_comment and comment_depth == 0 and not in_string and not in_access_string and current_char == ";":
-            if len(current_token):
-                current_line.append(Token(current_token, line_num, filename))
-            current_token = ""
-            if len(current_line):
+    # Comments don't break words, so word fragments are kept here until something else does
+    pending_word: str = ""
+    # Tokenization errors take precedence over lexing errors, so those are reported at the end
+    invalid_token: Optional[Token] = None
+    line_num: int = 1
+    i: int = 0
+    code_length: int = len(code)
+    scanner_match = SCANNER_REGEX.match
+    while i < code_length:
+        match = scanner_match(code, i)
+        kind = match.lastgroup
+        text = match.group()
+        if kind == "word":
+            pending_word += text
+            i = match.end()
+            continue
+        if kind == "block_comment" or kind == "inline_comment":
+            # Katalyn supports nested comments, but doesn't make any distinction between (* ... *) inside strings
+            # once that string is inside an already open comment (such as (* "(* *)" *))
+            i, line_num = skip_comment(code, match.end(), line_num, 1 if kind == "block_comment" else 0)
+            continue
+        if pending_word:
+            token = classify_word(pending_word, line_num, filename)
+            if token.type == LexType.UNKNOWN and invalid_token is None:
+                invalid_token = token
+            current_line.append(token)
+            pending_word = ""
+        if kind == "space":
+            line_num += text.count("\n")
+        elif kind == "glyph":
+            token = classify_glyph(text, line_num, filename)
+            if token.type == LexType.UNKNOWN and invalid_token is None:
+                invalid_token = token
+            current_line.append(token)
+        elif kind == "semicolon":
+            if current_line:
                 lines.append(current_line)
             current_line = []
-        elif not in_inline_comment and comment_depth == 0 and not in_string and not in_access_string and current_char + next_char in (">=", "<=", "::", "<>", "!=", "//", "&&", "||"):
-            # Biglyphs
-            if len(current_token):
-                current_line.append(Token(current_token, line_num, filename))
-            current_token = ""
-            current_line.append(Token(current_char + next_char, line_num, filename))
-            i += 1
-        elif not in_inline_comment and comment_depth == 0 and not in_string and not in_access_string and current_char in "(){}[]=<>!+-/&%^*:#,":
-            # Single glyphs
-            if len(current_token):
-                current_line.append(Token(current_token, line_num, filename))
-            current_token = ""
-            current_line.append(Token(current_char, line_num, filename))
-        elif not in_inline_comment and comment_depth == 0 and not in_string and not in_access_string and current_char.isspace():
-            if len(current_token):
-                current_line.append(Token(current_token, line_num, filename))
-            current_token = ""
-        elif not in_inline_comment and comment_depth == 0:
-            current_token += current_char
-        if current_char == "\n":
-            line_num += 1
-            in_inline_comment = False
-        i += 1
+        elif kind == "string":
+            open_line: int = line_num
+            value, i, line_num = scan_string(code, match.end(), line_num, STRING_BODY_REGEX, '"')
+            if i < 0:
+                tokenization_error("Open string, missing '\"'", open_line, filename)
+            current_line.append(Token(value, open_line, filename, LexType.STRING))
+            continue
+        elif kind == "access_string":
+            open_line: int = line_num
+            current_line.append(Token("[", open_line, filename, LexType.ACCESS_OPEN))
+            value, i, line_num = scan_string(code, match.end(), line_num, ACCESS_STRING_BODY_REGEX, "}")
+            if i < 0:
+                tokenization_error("Open access string, missing '}'", open_line, filename)
+            current_line.append(Token(value, open_line, filename, LexType.STRING))
+            current_line.append(Token("]", line_num, filename, LexType.ACCESS_CLOSE))
+            continue
+        i = match.end()
     # Check for consistency
     # I want to be able to leave comments open til the end of the file
-    if in_string:
-        tokenization_error("Open string, missing '\"'", last_string_open_line, filename)
-    if in_access_string:
-        tokenization_error("Open access string, missing '}'", last_string_open_line, filename)
-    if len(current_line):
+    if current_line:
         tokenization_error("Missing ';'", current_line[-1].line, filename)
-    if len(current_token):
+    if pending_word:
         tokenization_error("Missing ';'", line_num, filename)
+    if invalid_token is not None:
+        invalid_token_error(invalid_token)
     return lines
 
 
@@ -517,465 +714,1933 @@ def is_integer(text: str) -> bool:
     return True
         
 
-def is_float(text: str) -> bool:
-    """Returns true if the string represents an floating point number.
+def is_almost_number(text: str) -> bool:
+    """Returns true if the string almost represents a valid number.
     """
     if not len(text):
         return False
-    found_point = False
     for char in text:
-        if char == ".":
-            if found_point:
-                return False
-            else:
-                found_point = True
-                continue
-        elif char not in "0987654321":
+        if char not in "0123456789.":
             return False
-    if text[0] == "." or text[-1] == ".":
-        return False
-    return found_point
+    return True
 
 
-def is_valid_variable(text: str) -> bool:
-    """Returns true if the string represents a valid variable name.
-    """
-    if len(text) < 2:
-        return False
-    if text[0] != "$":
-        return False
-    for char in text[1:]:
-        if char not in "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_0123456789":
-            return False
-    return True
+def get_debug_info(token: Token) -> List[Instruction]:
+    return [Instruction(";", f"line {token.line}"), Instruction(";", f"file {token.file}")]
 
 
-def is_valid_identifier(text: str) -> bool:
-    """Returns true if the string represents a valid identifier name.
-    """
-    if not len(text):
-        return False
-    if text[0] not in "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_":
-        return False
-    for char in text[1:]:
-        if char not in "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_0123456789":
-            return False
-    return True
+class NodeType(Enum):
+    LITERAL = auto()
+    VARIABLE = auto()
+    TABLE = auto()
+    CALL = auto()
+    ACCESS = auto()
+    UNARY = auto()
+    BINARY = auto()
 
 
-def is_almost_number(text: str) -> bool:
-    """Returns true if the string almost represents a valid number.
+class ExpressionNode:
+    """A node of an expression AST. Literals, variables and tables are leaves,
+    accesses hold [table, index], unary and binary operations hold their operands
+    and calls hold one node per argument.
     """
-    if not len(text):
-        return False
-    for char in text:
-        if char not in "0123456789.":
-            return False
-    return True
+    def __init__(self, type: NodeType, token: Token, children: Optional[List[ExpressionNode]] = None) -> None:
+        self.type: NodeType = type
+        self.token: Token = token
+        self.children: List[ExpressionNode] = children if children is not None else []
+        self.source: List[Token] = []
+        self.start: int = 0
+        self.end: int = 0
+
+    def get_tokens(self) -> List[Token]:
+        """Returns the tokens this node was parsed from.
+        """
+        return self.source[self.start:self.end]
 
 
-def lex_tokens(tokenized_lines: List[List[Token]]) -> List[List[Token]]:
-    """Given a list of tokenized lines, lexes each token attatching extra information
-    to make the parsing simpler. It modifies the list in place.
+class ExpressionParser:
+    """Single-pass precedence-climbing parser that turns the tokens of
+    an expression into an ExpressionNode tree.
     """
-    for line in tokenized_lines:
-        for token in line:
-            if token.value[0] == '"' and token.value[-1] == '"':
-                token.value = token.value[1:-1]
-                token.type = LexType.STRING
-            elif is_valid_variable(token.value):
-                token.type = LexType.VARIABLE
-            elif token.value == "(":
-                token.type = LexType.PAR_OPEN
-            elif token.value == ")":
-                token.type = LexType.PAR_CLOSE
-            elif token.value == "[":
-                token.type = LexType.ACCESS_OPEN
-            elif token.value == "]":
-                token.type = LexType.ACCESS_CLOSE
-            elif token.value in (":", ","):
-                token.type = LexType.DECORATION
-            elif token.value == "table":
-                token.type = LexType.TABLE
-            elif is_integer(token.value):
-                token.type = LexType.INTEGER
-            elif is_float(token.value):
-                token.type = LexType.FLOAT
-            elif token.value in OPERATOR_PRESEDENCE:
-                token.type = LexType.OPERATOR
-            elif is_valid_identifier(token.value):
-                token.type = LexType.WORD
-            else:
-                # If we reached this point, there's an error
-                if token.value[0] == "$":
-                    lexing_error(f"The string '{token.value}' is not a valid variable name.", token.line, token.file)
-                elif is_almost_number(token.value):
-                    lexing_error(f"The string '{token.value}' is not a valid number.", token.line, token.file)
-                else:                   
-                    lexing_error(f"The string '{token.value}' is not a valid identifier.", token.line, token.file)
-    return tokenized_lines
-
-
-def get_debug_info(token: Token):
-    return f"\n;line {token.line}\n;file {token.file}"
-
-
-def compile_expression(expr_tokens: List[Token], discard_return_value: bool = False, unsafe: bool = False) -> str:
-    """Takes an expression and turns it into Nambly code.
-    Terminators are not compiled by this function.
-    This is the flojest part of the code and should probably
-    be turned into an AST first.
-    """
-    compiled_code: str = ""
-    depth_0_token_count: int = 0
-    left_side_tokens: List[Token] = []
-    right_side_tokens: List[Token] = []
-    operator: Optional[Token] = None
-    par_depth: int = 0
-    access_depth: int = 0
-    last_line: int = 0
-    last_file: str = ""
-    for token in expr_tokens:
-        last_line = token.line
-        last_file = token.file
-        initial_depth: int = par_depth + access_depth
-        if token.type == LexType.PAR_OPEN:
-            par_depth += 1
+    def __init__(self, tokens: List[Token]) -> None:
+        self.__tokens: List[Token] = tokens
+        self.__position: int = 0
+
+    def parse(self) -> ExpressionNode:
+        node: ExpressionNode = self.__parse_binary(0)
+        if self.__position < len(self.__tokens):
+            self.__unexpected_token_error(self.__position)
+        return node
+
+    def __make_node(self, type: NodeType, token: Token, start: int, children: Optional[List[ExpressionNode]] = None) -> ExpressionNode:
+        node: ExpressionNode = ExpressionNode(type, token, children)
+        node.source = self.__tokens
+        node.start = start
+        node.end = self.__position
+        return node
+
+    def __last_token(self) -> Token:
+        return self.__tokens[min(self.__position, len(self.__tokens)) - 1]
+
+    def __unexpected_token_error(self, index: int):
+        token: Token = self.__tokens[index]
+        previous: Optional[Token] = self.__tokens[index - 1] if index > 0 else None
+        if token.type in (LexType.PAR_CLOSE, LexType.ACCESS_CLOSE) and previous is not None \
+                and previous.type in (LexType.PAR_OPEN, LexType.ACCESS_OPEN):
+            expression_error("Expecting an expression.", token.line, token.file)
         elif token.type == LexType.PAR_CLOSE:
-            par_depth -= 1
-            if par_depth < 0:
+            expression_error("')' before '('", token.line, token.file)
+        elif token.type == LexType.ACCESS_CLOSE:
+            expression_error("']' before '['", token.line, token.file)
+        elif token.type == LexType.DECORATION:
+            expression_error(f"Unexpected string '{token.value}'", token.line, token.file)
+        elif previous is not None and previous.type in (LexType.PAR_CLOSE, LexType.ACCESS_CLOSE):
+            expression_error(
+                f"Unexpected expression element: {token.value} (did you forget a ';'?)",
+                token.line,
+                token.file
+            )
+        else:
+            expression_error(f"Unexpected token '{token.value}'.", token.line, token.file)
+
+    def __parse_binary(self, min_power: int) -> ExpressionNode:
+        """Parses operands joined by operators that bind tighter than min_power.
+        Operators of equal power stop the loop, so every operator is left associative.
+        """
+        start: int = self.__position
+        left: ExpressionNode = self.__parse_unary()
+        while self.__position < len(self.__tokens):
+            operator: Token = self.__tokens[self.__position]
+            if operator.type != LexType.OPERATOR:
+                break
+            power: int = OPERATOR_BINDING_POWER[operator.value]
+            if power <= min_power:
+                break
+            if operator.value == "!":
                 expression_error(
-                    "')' before '('",
-                    token.line,
-                    token.file
+                    f"The operator {operator.value} can only be used as an infix operator.",
+                    operator.line,
+                    operator.file
                 )
-        elif token.type == LexType.ACCESS_OPEN:
-            access_depth += 1
-        elif token.type == LexType.ACCESS_CLOSE:
-            access_depth -= 1
-            if access_depth < 0:
+            self.__position += 1
+            if self.__position == len(self.__tokens):
                 expression_error(
-                    "']' before '['",
-                    token.line,
-                    token.file
+                    f"Expecting expression after operator {operator.value}",
+                    operator.line,
+                    operator.file
                 )
-        if par_depth + access_depth == 0 and token.type == LexType.OPERATOR:
-            if operator is None:
-                operator = token
-            else:
-                if OPERATOR_PRESEDENCE.index(operator.value) <= OPERATOR_PRESEDENCE.index(token.value):
-                    left_side_tokens.append(operator)
-                    left_side_tokens += right_side_tokens
-                    right_side_tokens = []
-                    operator = token
-                else:
-                    right_side_tokens.append(token)
+            right: ExpressionNode = self.__parse_binary(power)
+            left = self.__make_node(NodeType.BINARY, operator, start, [left, right])
+        return left
+
+    def __parse_unary(self) -> ExpressionNode:
+        """Parses a terminator, optionally preceded by '-' or '!'.
+        '-' only negates the terminator that follows it, '!' negates
+        everything that binds tighter than itself.
+        """
+        if self.__position == len(self.__tokens):
+            token: Token = self.__last_token()
+            expression_error("Expecting an expression.", token.line, token.file)
+        start: int = self.__position
+        token: Token = self.__tokens[self.__position]
+        if token.type != LexType.OPERATOR:
+            return self.__parse_terminator()
+        self.__position += 1
+        if token.value == "-":
+            if self.__position == len(self.__tokens):
+                expression_error(f"Expecting expression after operator {token.value}", token.line, token.file)
+            operand: ExpressionNode = self.__parse_unary()
+        elif token.value == "!":
+            if self.__position == len(self.__tokens):
+                expression_error(f"Expecting expression after operator {token.value}", token.line, token.file)
+            operand: ExpressionNode = self.__parse_binary(OPERATOR_BINDING_POWER[token.value])
         else:
-            if operator is None:
-                left_side_tokens.append(token)
-            else:
-                right_side_tokens.append(token)
-        if initial_depth == 0 or par_depth + access_depth == 0:
-            depth_0_token_count += 1
-    if par_depth > 0:
-        expression_error(
-            "Missing ')'",
-            last_line,
-            last_file
-        )
-    if access_depth > 0:
-        expression_error(
-            "Missing ']'",
-            last_line,
-            last_file
-        )
-    if False:
-        # print(depth_0_token_count)
-        print("-------------")
-        print("OPERATOR:", operator)
-        if left_side_tokens:
-            print("LSIDE: ", end = "")
-            for token in left_side_tokens:
-                print(token, end="")
-            print("")
-        if right_side_tokens:
-            print("RSIDE: ", end = "")
-            for token in right_side_tokens:
-                print(token, end="")
-            print("")
-    # Reevaluate expressions completely enclosed by parenthesis
-    if depth_0_token_count == 2 and expr_tokens[0].type == LexType.PAR_OPEN and expr_tokens[-1].type == LexType.PAR_CLOSE:
-        compiled_code += "\n" + compile_expression(expr_tokens[1:-1])
-    else:
-        if operator is not None and not right_side_tokens:
-            expression_error(
-                f"Expecting expression after operator {operator.value}",
-                operator.line,
-                operator.file
-            )
-        elif operator is None: # Caso de los function calls
-            compiled_code += "\n" + compile_terminator(left_side_tokens, unsafe)
-        elif operator.value == "-" and not left_side_tokens:
-            compiled_code += "\n" + compile_terminator([operator] + right_side_tokens, unsafe)
-            operator = None
+            expression_error(f"Expecting expression before operator {token.value}", token.line, token.file)
+        return self.__make_node(NodeType.UNARY, token, start, [operand])
+
+    def __parse_terminator(self) -> ExpressionNode:
+        """Parses a value (literal, variable, table, call or parenthesized
+        expression) followed by any number of table accesses.
+        """
+        start: int = self.__position
+        token: Token = self.__tokens[self.__position]
+        self.__position += 1
+        if token.type in (LexType.INTEGER, LexType.FLOAT, LexType.STRING):
+            node: ExpressionNode = self.__make_node(NodeType.LITERAL, token, start)
+        elif token.type == LexType.TABLE:
+            node: ExpressionNode = self.__make_node(NodeType.TABLE, token, start)
+        elif token.type == LexType.VARIABLE:
+            node: ExpressionNode = self.__make_node(NodeType.VARIABLE, token, start)
+        elif token.type == LexType.WORD:
+            if self.__position == len(self.__tokens) or self.__tokens[self.__position].type != LexType.PAR_OPEN:
+                expression_error("Expecting argument list after function call.", token.line, token.file)
+            arguments: List[ExpressionNode] = self.__parse_arguments()
+            node: ExpressionNode = self.__make_node(NodeType.CALL, token, start, arguments)
+        elif token.type == LexType.PAR_OPEN:
+            node: ExpressionNode = self.__parse_binary(0)
+            self.__expect_close(LexType.PAR_CLOSE, "Missing ')'")
+        elif token.type == LexType.ACCESS_OPEN:
+            expression_error("Found a table access without a variable or a function.", token.line, token.file)
+        elif token.type == LexType.OPERATOR:
+            expression_error(f"Unexpected operator: '{token.value}'", token.line, token.file)
         else:
-            compiled_code += "\n" + compile_expression(left_side_tokens)
-            compiled_code += "\n" + compile_expression(right_side_tokens)
-    if operator:
-        infix: bool = False
-        if operator.value == "*":
-            compiled_code += "\nMULT" 
-        elif operator.value == "^":
-            compiled_code += "\nPOWR" 
-        elif operator.value == "/":
-            compiled_code += "\nFDIV" 
-        elif operator.value == "//":
-            compiled_code += "\nIDIV" 
-        elif operator.value == "-":
-            compiled_code += "\nSUBT" 
-        elif operator.value == "+":
-            compiled_code += "\nADDV" 
-        elif operator.value == "&":
-            compiled_code += "\nJOIN" 
-        elif operator.value == "%":
-            compiled_code += "\nMODL" 
-        elif operator.value == "=":
-            compiled_code += "\nISEQ" 
-        elif operator.value in ("<>", "!="):
-            compiled_code += "\nISNE" 
-        elif operator.value == "<":
-            compiled_code += "\nISLT" 
-        elif operator.value == ">":
-            compiled_code += "\nISGT" 
-        elif operator.value == "<=":
-            compiled_code += "\nISLE" 
-        elif operator.value == ">=":
-            compiled_code += "\nISGE" 
-        elif operator.value == "&&":
-            compiled_code += "\nLAND" 
-        elif operator.value == "||":
-            compiled_code += "\nLGOR" 
-        elif operator.value == "::":
-            compiled_code += "\nISIN" 
-        elif operator.value == "!":
-            compiled_code += "\nLNOT" 
-            infix = True
+            self.__unexpected_token_error(start)
+        while self.__position < len(self.__tokens):
+            next_token: Token = self.__tokens[self.__position]
+            if next_token.type == LexType.ACCESS_OPEN:
+                self.__position += 1
+                index: ExpressionNode = self.__parse_binary(0)
+                self.__expect_close(LexType.ACCESS_CLOSE, "Missing ']'")
+                node = self.__make_node(NodeType.ACCESS, next_token, start, [node, index])
+            elif next_token.type == LexType.PAR_OPEN:
+                if node.type not in (NodeType.VARIABLE, NodeType.ACCESS):
+                    expression_error("Calling non-functional value.", next_token.line, next_token.file)
+                # TODO $a(2, 3, 4)
+                self.__parse_arguments()
+            else:
+                break
+        return node
+
+    def __expect_close(self, type: LexType, missing_message: str):
+        if self.__position == len(self.__tokens):
+            token: Token = self.__last_token()
+            expression_error(missing_message, token.line, token.file)
+        token: Token = self.__tokens[self.__position]
+        if token.type != type:
+            self.__unexpected_token_error(self.__position)
+        self.__position += 1
+
+    def __parse_arguments(self) -> List[ExpressionNode]:
+        """Parses a parenthesized, comma separated argument list.
+        A trailing comma before the closing parenthesis is allowed.
+        """
+        arguments: List[ExpressionNode] = []
+        self.__position += 1
+        if self.__position < len(self.__tokens) and self.__tokens[self.__position].type == LexType.PAR_CLOSE:
+            self.__position += 1
+            return arguments
+        while True:
+            if self.__position == len(self.__tokens):
+                token: Token = self.__last_token()
+                expression_error("Missing ')'", token.line, token.file)
+            token: Token = self.__tokens[self.__position]
+            if token.type == LexType.DECORATION and token.value == ",":
+                expression_error("Empty argument for function call", token.line, token.file)
+            arguments.append(self.__parse_binary(0))
+            if self.__position == len(self.__tokens):
+                token = self.__last_token()
+                expression_error("Missing ')'", token.line, token.file)
+            token = self.__tokens[self.__position]
+            self.__position += 1
+            if token.type == LexType.PAR_CLOSE:
+                return arguments
+            if token.type != LexType.DECORATION or token.value != ",":
+                self.__unexpected_token_error(self.__position - 1)
+            if self.__position < len(self.__tokens) and self.__tokens[self.__position].type == LexType.PAR_CLOSE:
+                self.__position += 1
+                return arguments
+
+
+def parse_expression(expr_tokens: List[Token]) -> ExpressionNode:
+    """Parses the tokens of an expression into an AST.
+    """
+    return ExpressionParser(expr_tokens).parse()
+
+
+def compile_expression(expr: Union[ExpressionNode, List[Token]], discard_return_value: bool = False, unsafe: bool = False) -> List[Instruction]:
+    """Takes an expression (either its tokens or its AST) and turns it into Nambly code.
+    The tree is walked with an explicit stack, so very long expressions don't
+    hit the recursion limit. If unsafe, variables are read without checking
+    that they have been declared.
+    """
+    if isinstance(expr, list):
+        if not expr:
+            return []
+        expr = parse_expression(expr)
+        if global_compiler_state.optimization_level >= 1:
+            expr = fold_constants(expr)
+    compiled_code: List[Instruction] = []
+    # Instructions in the stack are emitted as they are, between the code of two children
+    pending: List[Union[Tuple[ExpressionNode, bool], Instruction]] = [(expr, False)]
+    while pending:
+        entry: Union[Tuple[ExpressionNode, bool], Instruction] = pending.pop()
+        if isinstance(entry, Instruction):
+            compiled_code.append(entry)
+            continue
+        node, children_compiled = entry
+        if node.type == NodeType.LITERAL:
+            if node.token.type == LexType.STRING:
+                compiled_code.append(Instruction("PUSH", f'"{node.token.get_nambly_string()}"'))
+            else:
+                compiled_code.append(Instruction("PUSH", node.token.value))
+        elif node.type == NodeType.VARIABLE:
+            var_id: Optional[str] = global_compiler_state.get_var_identifier(node.token, True, unsafe=unsafe)
+            compiled_code.append(Instruction("VGET", f'"{var_id}"'))
+        elif node.type == NodeType.TABLE:
+            compiled_code.append(Instruction("TABL"))
+        elif node.type == NodeType.CALL:
+            compiled_code += compile_function_call(node.token, node.children)
+        elif node.type == NodeType.UNARY and node.token.value == "-" and is_number_literal(node.children[0]):
+            compiled_code.append(Instruction("PUSH", f"-{node.children[0].token.value}"))
+        elif node.type == NodeType.BINARY and node.token.value in ("&&", "||"):
+            for item in reversed(get_short_circuit_code(node)):
+                pending.append((item, False) if isinstance(item, ExpressionNode) else item)
+        elif not children_compiled:
+            pending.append((node, True))
+            for child in reversed(node.children):
+                pending.append((child, False))
+        elif node.type == NodeType.ACCESS:
+            compiled_code.append(Instruction("PGET"))
+        elif node.type == NodeType.UNARY:
+            if node.token.value == "-":
+                compiled_code.append(Instruction("PUSH", "-1"))
+                compiled_code.append(Instruction("MULT"))
+            else:
+                compiled_code.append(Instruction("LNOT"))
         else:
-            expression_error(
-                f"The operator {operator.value} cannot be used as an infix operator.",
-                operator.line,
-                operator.file
-            )
-        if infix and left_side_tokens:
-            expression_error(
-                f"The operator {operator.value} can only be used as an infix operator.",
-                operator.line,
-                operator.file
-            )
+            compiled_code.append(Instruction(OPERATOR_OPCODES[node.token.value]))
     if discard_return_value:
-        compiled_code += "\nPOPV"
+        compiled_code.append(Instruction("POPV"))
     return compiled_code
 
 
+def get_short_circuit_code(node: ExpressionNode) -> List[Union[ExpressionNode, Instruction]]:
+    """Returns the code for a && or || node, with its operands as nodes still to
+    be compiled. The right operand is skipped when the left one decides the result,
+    which is always 1 or 0, like what LAND and LGOR push.
+    """
+    block_number: int = global_compiler_state.block_count
+    global_compiler_state.block_count += 1
+    right_tag: str = f"LOGIC_{block_number}_RIGHT"
+    true_tag: str = f"LOGIC_{block_number}_TRUE"
+    false_tag: str = f"LOGIC_{block_number}_FALSE"
+    end_tag: str = f"LOGIC_{block_number}_END"
+    left, right = node.children
+    code: List[Union[ExpressionNode, Instruction]] = []
+    if node.token.value == "&&":
+        code += [left, Instruction("JPIF", false_tag)]
+    else:
+        code += [left, Instruction("JPIF", right_tag), Instruction("JUMP", true_tag), Instruction("@", right_tag)]
+    code += [right, Instruction("JPIF", false_tag)]
+    if node.token.value == "||":
+        code.append(Instruction("@", true_tag))
+    code += [
+        Instruction("PUSH", "1"),
+        Instruction("JUMP", end_tag),
+        Instruction("@", false_tag),
+        Instruction("PUSH", "0"),
+        Instruction("@", end_tag),
+    ]
+    return code
+
+
+def is_number_literal(node: ExpressionNode) -> bool:
+    """Returns true if the node is an integer or float literal.
+    """
+    return node.type == NodeType.LITERAL and node.token.type in (LexType.INTEGER, LexType.FLOAT)
+
 
-def compile_terminator(expr_tokens: List[Token], unsafe: bool = False) -> str:
-    """Generates Nambly for an expression terminator.
-    This is the second flojest part of the code and should
-    probably be turned into an AST first.
+def get_literal_value(node: ExpressionNode) -> Union[float, str, None]:
+    """Returns the value the NariVM pushes for a literal node, or None if the node isn't a literal.
     """
-    compiled_code: str = ""
-    add_minus_code: bool = False
-    
-    access_depth: int = 0
-    access_tokens: List[Token] = []
-    terminator_type: LexType = LexType.UNKNOWN
-    function_call_token: Optional[Token] = None
-    while expr_tokens:
-        token = expr_tokens.pop(0)
-        if access_depth > 0:
-            if token.type == LexType.ACCESS_OPEN:
-                access_depth += 1
-                access_tokens.append(token)
-            elif token.type == LexType.ACCESS_CLOSE:
-                access_depth -= 1
-                if access_depth == 0:
-                    compiled_code += "\n" + compile_expression(access_tokens)
-                    compiled_code += "\nPGET" 
-                    if expr_tokens:
-                        if expr_tokens[0].type not in (LexType.ACCESS_OPEN, LexType.PAR_OPEN):
-                            expression_error(
-                                f"Unexpected expression element: {expr_tokens[0].value} (did you forget a ';'?)",
-                                token.line,
-                                token.file
-                            )
-                else:
-                    access_tokens.append(token)
+    if node.type != NodeType.LITERAL:
+        return None
+    if node.token.type == LexType.STRING:
+        return node.token.value
+    return float(node.token.value)
+
+
+def number_to_vm_string(value: float) -> Optional[str]:
+    """Returns the text the NariVM turns a number into, or None where its
+    conversion is undefined. Mirrors double_to_string, trailing zero quirk included.
+    """
+    if abs(value - math.floor(value)) < sys.float_info.epsilon:
+        if abs(value) >= 2 ** 63:
+            return None
+        return str(int(value))
+    text: str = f"{value:f}".rstrip("0.")
+    return text if text else None
+
+
+def number_to_literal(value: float) -> Optional[str]:
+    """Returns a Nambly number literal that the NariVM parses back into exactly
+    this value, or None if there is no such literal.
+    """
+    if not math.isfinite(value) or (value == 0 and math.copysign(1, value) < 0):
+        return None
+    if value == math.floor(value) and abs(value) < 2 ** 53:
+        return str(int(value))
+    text: str = repr(value)
+    return None if "e" in text else text
+
+
+def is_vm_true(value: Union[float, str]) -> bool:
+    """Returns if the NariVM considers a value true, like its is_true function.
+    """
+    if isinstance(value, str):
+        return len(value) > 0
+    return abs(value) >= sys.float_info.epsilon
+
+
+def fold_operation(operator: Token, operands: List[Union[float, str, None]]) -> Union[float, str, None]:
+    """Evaluates an operation on literal operands exactly like the NariVM would.
+    Operands that aren't literals are None. Returns None if the operation can't
+    be folded without changing its result (text used as a number, division by
+    zero, undefined conversions and so on).
+    """
+    if len(operands) == 1:
+        value = operands[0]
+        if value is None:
+            return None
+        if operator.value == "!":
+            return 0.0 if is_vm_true(value) else 1.0
+        if isinstance(value, str):
+            return None
+        return value * -1.0
+    left, right = operands
+    opcode: str = OPERATOR_OPCODES[operator.value]
+    if opcode in ("LAND", "LGOR"):
+        # The right operand is never evaluated if the left one decides the result
+        if left is None:
+            return None
+        if opcode == "LAND" and not is_vm_true(left):
+            return 0.0
+        if opcode == "LGOR" and is_vm_true(left):
+            return 1.0
+        if right is None:
+            return None
+        return 1.0 if is_vm_true(right) else 0.0
+    if left is None or right is None:
+        return None
+    if opcode == "JOIN":
+        left_text: Optional[str] = left if isinstance(left, str) else number_to_vm_string(left)
+        right_text: Optional[str] = right if isinstance(right, str) else number_to_vm_string(right)
+        if left_text is None or right_text is None:
+            return None
+        return left_text + right_text
+    if opcode in ("ISEQ", "ISNE"):
+        if isinstance(left, str) != isinstance(right, str):
+            return None
+        return 1.0 if (left == right) == (opcode == "ISEQ") else 0.0
+    if isinstance(left, str) or isinstance(right, str) or opcode == "ISIN":
+        return None
+    result: Optional[float] = None
+    if opcode == "ADDV":
+        result = left + right
+    elif opcode == "SUBT":
+        result = left - right
+    elif opcode == "MULT":
+        result = left * right
+    elif opcode == "FDIV" and right != 0:
+        result = left / right
+    elif opcode == "IDIV" and right != 0:
+        result = float(math.floor(left / right))
+    elif opcode == "POWR":
+        try:
+            result = math.pow(left, right)
+        except (OverflowError, ValueError):
+            return None
+    elif opcode == "MODL":
+        # (int)floor(a) % (int)floor(b), so the sign follows the dividend, on the C++ and Python NariVMs alike
+        int_left: int = math.floor(left)
+        int_right: int = math.floor(right)
+        if int_right != 0 and -2 ** 31 < int_left < 2 ** 31 and -2 ** 31 < int_right < 2 ** 31:
+            result = float(int(math.fmod(int_left, int_right)))
+    elif opcode == "ISLT":
+        result = 1.0 if left < right else 0.0
+    elif opcode == "ISGT":
+        result = 1.0 if left > right else 0.0
+    elif opcode == "ISLE":
+        result = 1.0 if left <= right else 0.0
+    elif opcode == "ISGE":
+        result = 1.0 if left >= right else 0.0
+    return result
+
+
+def get_compiled_size(node: ExpressionNode, children: List[ExpressionNode], sizes: Dict[int, int]) -> int:
+    """Returns how many instructions compile_expression emits for a node with the
+    given children, knowing how many each child compiles to.
+    """
+    if node.type == NodeType.CALL:
+        return 0  # Unknown until compiled, so calls skipped by && and || aren't counted
+    if node.type == NodeType.UNARY and node.token.value == "-":
+        return 1 if is_number_literal(children[0]) else sizes[id(children[0])] + 2
+    children_size: int = sum([sizes[id(child)] for child in children])
+    if node.type == NodeType.BINARY and node.token.value == "&&":
+        return children_size + 7
+    if node.type == NodeType.BINARY and node.token.value == "||":
+        return children_size + 10
+    return children_size + 1
+
+
+def fold_constants(root: ExpressionNode) -> ExpressionNode:
+    """Replaces every operation whose operands are all literals (after folding
+    its own operands) with a literal holding its result. && and || are also
+    folded when their left operand decides the result, after compiling the
+    right one anyway so it gets the same checks as without folding. The tree
+    is walked with an explicit stack, like in compile_expression.
+    """
+    folded_nodes: Dict[int, ExpressionNode] = {}
+    # Instructions each node compiles to before and after folding, to count the ones removed
+    original_sizes: Dict[int, int] = {}
+    folded_sizes: Dict[int, int] = {}
+    pending: List[Tuple[ExpressionNode, bool]] = [(root, False)]
+    while pending:
+        node, children_folded = pending.pop()
+        if not children_folded and node.children:
+            pending.append((node, True))
+            for child in node.children:
+                pending.append((child, False))
+            continue
+        original_children: List[ExpressionNode] = node.children
+        original_sizes[id(node)] = get_compiled_size(node, original_children, original_sizes)
+        node.children = [folded_nodes[id(child)] for child in original_children]
+        folded_nodes[id(node)] = node
+        folded_sizes[id(node)] = get_compiled_size(node, node.children, folded_sizes)
+        if node.type not in (NodeType.UNARY, NodeType.BINARY):
+            continue
+        operands: List[Union[float, str, None]] = [get_literal_value(child) for child in node.children]
+        result: Union[float, str, None] = fold_operation(node.token, operands)
+        if result is None:
+            continue
+        if node.token.value in ("&&", "||") and operands[1] is None:
+            compile_expression(node.children[1])
+        if isinstance(result, str):
+            token: Token = Token(result, node.token.line, node.token.file, LexType.STRING)
+        else:
+            literal: Optional[str] = number_to_literal(result)
+            if literal is None:
+                continue
+            literal_type: LexType = LexType.INTEGER if literal.lstrip("-").isdigit() else LexType.FLOAT
+            token: Token = Token(literal, node.token.line, node.token.file, literal_type)
+        folded_node: ExpressionNode = ExpressionNode(NodeType.LITERAL, token)
+        folded_node.source = node.source
+        folded_node.start = node.start
+        folded_node.end = node.end
+        folded_nodes[id(node)] = folded_node
+        folded_sizes[id(folded_node)] = 1
+    global_compiler_state.count_removed_instructions("Constant folding", original_sizes[id(root)] - folded_sizes[id(folded_nodes[id(root)])])
+    return folded_nodes[id(root)]
+
+
+def resolve_shadowed_calls(instructions: List[Instruction]):
+    """Redirects every call to a shadowed function to the latest function that shadows it.
+    """
+    shadowed_functions: Dict[str, str] = global_compiler_state.shadowed_functions
+    if not shadowed_functions:
+        return
+    for instruction in instructions:
+        if instruction.opcode == "CALL":
+            while instruction.argument in shadowed_functions:
+                instruction.argument = shadowed_functions[instruction.argument]
+
+
+def eliminate_dead_functions(instructions: List[Instruction]) -> List[Instruction]:
+    """Removes the declarations of the functions that can't be reached by following
+    calls from the code outside of every function. Must run after resolve_shadowed_calls,
+    so calls to shadowed functions already point to their shadowers.
+    """
+    # Find every declaration, from the jump over its body to its post label
+    declarations: Dict[str, Tuple[int, int]] = {}  # Start label -> first and last index
+    enclosing_function: Dict[str, Optional[str]] = {}
+    called_functions: Dict[Optional[str], List[str]] = {None: []}  # None is the code outside functions
+    open_functions: List[Tuple[str, str, int]] = []
+    for index, instruction in enumerate(instructions):
+        if instruction.opcode == "JUMP" and index + 1 < len(instructions):
+            match = FUNCTION_LABEL_REGEX.match(instruction.argument)
+            next_instruction: Instruction = instructions[index + 1]
+            if match and match.group(2) == "POST" and next_instruction.opcode == "@" \
+                    and next_instruction.argument == f"FUN_{match.group(1)}_START":
+                enclosing_function[next_instruction.argument] = open_functions[-1][0] if open_functions else None
+                called_functions[next_instruction.argument] = []
+                open_functions.append((next_instruction.argument, instruction.argument, index))
+        elif instruction.opcode == "@" and open_functions and instruction.argument == open_functions[-1][1]:
+            start_label, _, first_index = open_functions.pop()
+            declarations[start_label] = (first_index, index)
+        elif instruction.opcode == "CALL":
+            called_functions[open_functions[-1][0] if open_functions else None].append(instruction.argument)
+    # Mark every function reachable from the code outside functions
+    reachable: Set[str] = set()
+    pending: List[str] = list(called_functions[None])
+    while pending:
+        start_label: str = pending.pop()
+        if start_label in reachable or start_label not in declarations:
+            continue
+        reachable.add(start_label)
+        pending += called_functions[start_label]
+        # Nested declarations are only kept if the declarations around them are
+        if enclosing_function[start_label] is not None:
+            pending.append(enclosing_function[start_label])
+    dead_declarations: Dict[int, int] = {}
+    for start_label, (first_index, last_index) in declarations.items():
+        if start_label not in reachable:
+            dead_declarations[first_index] = last_index
+    if not dead_declarations:
+        return instructions
+    removed_count: int = 0
+    kept_instructions: List[Instruction] = []
+    index: int = 0
+    while index < len(instructions):
+        instruction: Instruction = instructions[index]
+        if index in dead_declarations:
+            # Drop the debug info of the def line too
+            while kept_instructions and kept_instructions[-1].opcode == ";" \
+                    and kept_instructions[-1].line == instruction.line and kept_instructions[-1].file == instruction.file:
+                kept_instructions.pop()
+            removed_count += dead_declarations[index] + 1 - index
+            index = dead_declarations[index] + 1
+        else:
+            kept_instructions.append(instruction)
+            index += 1
+    global_compiler_state.count_removed_instructions("Dead function elimination", removed_count)
+    return kept_instructions
+
+
+def rewrite_print_swap(matched: List[Instruction], read_variables: Set[str]) -> Optional[List[Instruction]]:
+    """print and printc keep each argument in $swap while displaying it, DISP
+    only consumes the copy made by DUPL so the variable isn't needed.
+    """
+    if matched[1].argument == '"$swap"' and matched[3].argument == '"$swap"':
+        return [matched[0], matched[2]]
+    return None
+
+
+def rewrite_dead_duplicated_store(matched: List[Instruction], read_variables: Set[str]) -> Optional[List[Instruction]]:
+    """The instruction before the DUPL is known to push a value, so dropping the
+    DUPL and the store can't hide an empty stack error.
+    """
+    if matched[2].argument not in read_variables:
+        return [matched[0]]
+    return None
+
+
+def rewrite_dead_store(matched: List[Instruction], read_variables: Set[str]) -> Optional[List[Instruction]]:
+    """Like rewrite_dead_duplicated_store, the stored value is known to be there for POPV.
+    POPV does nothing on an empty stack, while a VSET would fail.
+    """
+    if matched[1].argument not in read_variables:
+        return [matched[0], Instruction("POPV", None, matched[1].line, matched[1].file)]
+    return None
+
+
+def rewrite_stored_value_load(matched: List[Instruction], read_variables: Set[str]) -> Optional[List[Instruction]]:
+    """Reading a variable right after setting it reads the value that was just stored.
+    """
+    if matched[0].argument == matched[1].argument:
+        return [Instruction("DUPL", None, matched[0].line, matched[0].file), matched[0]]
+    return None
+
+
+def rewrite_tail_call(matched: List[Instruction], read_variables: Set[str]) -> Optional[List[Instruction]]:
+    """A call whose result is returned right away can delete the scope of the caller
+    and jump to the function, which then returns straight to the caller's caller.
+    """
+    return [matched[1], Instruction("JUMP", matched[0].argument, matched[0].line, matched[0].file)]
+
+
+def rewrite_discarded_value(matched: List[Instruction], read_variables: Set[str]) -> Optional[List[Instruction]]:
+    return []
+
+
+def rewrite_known_value_nil_check(matched: List[Instruction], read_variables: Set[str]) -> Optional[List[Instruction]]:
+    """The argument checks of inlined calls never fail on values that can't be nil.
+    """
+    return [matched[0], Instruction("JUMP", matched[3].argument, matched[3].line, matched[3].file)]
+
+
+# Name, opcodes each instruction of the window can have and rewrite function.
+# Rewrite functions get the matched instructions and the variables read anywhere
+# in the program and return their replacement, or None to leave them as they are.
+PEEPHOLE_RULES: Tuple[Tuple[str, Tuple[Tuple[str, ...], ...], Callable], ...] = (
+    ("Print swap variable", (("DUPL",), ("VSET",), ("DISP",), ("VGET",)), rewrite_print_swap),
+    ("Dead store", (VALUE_OPCODES, ("DUPL",), ("VSET",)), rewrite_dead_duplicated_store),
+    ("Dead store", (VALUE_OPCODES, ("VSET",)), rewrite_dead_store),
+    ("Discarded value", (("PUSH", "PNIL", "DUPL"), ("POPV",)), rewrite_discarded_value),
+    ("Nil check of a known value", (NON_NIL_OPCODES, ("DUPL",), ("NIL?",), ("JPIF",)), rewrite_known_value_nil_check),
+    ("Stored value load", (("VSET",), ("VGET",)), rewrite_stored_value_load),
+    ("Tail call", (("CALL",), ("DLSC",), ("RTRN",)), rewrite_tail_call),
+)
+
+
+def match_peephole_pattern(instructions: List[Instruction], index: int, pattern: Tuple[Tuple[str, ...], ...]) -> Optional[List[int]]:
+    """Returns the indices of the instructions from index on that match the pattern,
+    skipping debug comments, or None if they don't match. Labels never match, as
+    something could jump between the instructions.
+    """
+    matched_indices: List[int] = []
+    for opcodes in pattern:
+        while index < len(instructions) and instructions[index].opcode == ";":
+            index += 1
+        if index >= len(instructions) or instructions[index].opcode not in opcodes:
+            return None
+        matched_indices.append(index)
+        index += 1
+    return matched_indices
+
+
+def apply_peephole_rules(instructions: List[Instruction], hits: Dict[str, int]) -> List[Instruction]:
+    """Rewrites every window of instructions that matches one of the PEEPHOLE_RULES.
+    """
+    read_variables: Set[str] = {instruction.argument for instruction in instructions if instruction.opcode in ("VGET", "NEXT")}
+    optimized_instructions: List[Instruction] = []
+    index: int = 0
+    while index < len(instructions):
+        instruction: Instruction = instructions[index]
+        if instruction.opcode in (";", "@"):
+            optimized_instructions.append(instruction)
+            index += 1
+            continue
+        for name, pattern, rewrite in PEEPHOLE_RULES:
+            matched_indices: Optional[List[int]] = match_peephole_pattern(instructions, index, pattern)
+            if matched_indices is None:
+                continue
+            replacement: Optional[List[Instruction]] = rewrite([instructions[i] for i in matched_indices], read_variables)
+            if replacement is None:
+                continue
+            optimized_instructions += replacement
+            # Keep the debug comments that were between the matched instructions
+            optimized_instructions += [instructions[i] for i in range(index, matched_indices[-1]) if instructions[i].opcode == ";"]
+            index = matched_indices[-1] + 1
+            hits[name] = hits.get(name, 0) + 1
+            break
+        else:
+            optimized_instructions.append(instruction)
+            index += 1
+    return optimized_instructions
+
+
+def thread_jumps(instructions: List[Instruction]) -> Tuple[List[Instruction], int]:
+    """Makes jumps to a label followed by another jump go straight to the last label of the chain.
+    """
+    label_targets: Dict[str, int] = {}  # Label -> index of the first instruction it executes
+    pending_labels: List[str] = []
+    for index, instruction in enumerate(instructions):
+        if instruction.opcode == "@":
+            pending_labels.append(instruction.argument)
+        elif instruction.opcode != ";":
+            for label in pending_labels:
+                label_targets[label] = index
+            pending_labels = []
+    hit_count: int = 0
+    for instruction in instructions:
+        if instruction.opcode not in JUMP_OPCODES:
+            continue
+        target: str = instruction.argument
+        visited_labels: Set[str] = {target}
+        while target in label_targets and instructions[label_targets[target]].opcode == "JUMP" \
+                and instructions[label_targets[target]].argument not in visited_labels:
+            target = instructions[label_targets[target]].argument
+            visited_labels.add(target)
+        if target != instruction.argument:
+            instruction.argument = target
+            hit_count += 1
+    return instructions, hit_count
+
+
+def remove_jumps_to_next(instructions: List[Instruction]) -> Tuple[List[Instruction], int]:
+    """Removes jumps to a label that comes right after them. Conditional
+    jumps still have to pop their condition.
+    """
+    optimized_instructions: List[Instruction] = []
+    hit_count: int = 0
+    for index, instruction in enumerate(instructions):
+        if instruction.opcode in ("JUMP", "JPIF"):
+            next_index: int = index + 1
+            while next_index < len(instructions) and instructions[next_index].opcode in (";", "@") \
+                    and instructions[next_index].argument != instruction.argument:
+                next_index += 1
+            if next_index < len(instructions) and instructions[next_index].opcode == "@":
+                hit_count += 1
+                if instruction.opcode == "JPIF":
+                    optimized_instructions.append(Instruction("POPV", None, instruction.line, instruction.file))
+                continue
+        optimized_instructions.append(instruction)
+    return optimized_instructions, hit_count
+
+
+def remove_unreachable_code(instructions: List[Instruction]) -> Tuple[List[Instruction], int]:
+    """Removes the instructions between a jump or a return and the next label.
+    """
+    optimized_instructions: List[Instruction] = []
+    hit_count: int = 0
+    reachable: bool = True
+    removing: bool = False
+    for instruction in instructions:
+        if instruction.opcode == "@":
+            reachable = True
+            removing = False
+        elif instruction.opcode != ";" and not reachable:
+            if not removing:
+                hit_count += 1
+                removing = True
+            continue
+        elif instruction.opcode in ("JUMP", "RTRN"):
+            reachable = False
+        optimized_instructions.append(instruction)
+    return optimized_instructions, hit_count
+
+
+def remove_unused_labels(instructions: List[Instruction]) -> Tuple[List[Instruction], int]:
+    """Removes labels nothing jumps to, so they don't split windows of the other rules.
+    """
+    used_labels: Set[str] = {instruction.argument for instruction in instructions if instruction.opcode in JUMP_OPCODES + ("CALL",)}
+    optimized_instructions: List[Instruction] = [
+        instruction for instruction in instructions if instruction.opcode != "@" or instruction.argument in used_labels
+    ]
+    return optimized_instructions, len(instructions) - len(optimized_instructions)
+
+
+PEEPHOLE_PASSES: Tuple[Tuple[str, Callable], ...] = (
+    ("Jump threading", thread_jumps),
+    ("Jump to next instruction", remove_jumps_to_next),
+    ("Unreachable code", remove_unreachable_code),
+    ("Unused label", remove_unused_labels),
+)
+
+
+def optimize_peephole(instructions: List[Instruction]) -> List[Instruction]:
+    """Applies the PEEPHOLE_RULES and PEEPHOLE_PASSES to the whole program until
+    none of them changes it anymore. Must run after eliminate_dead_functions, as
+    function declarations lose the labels it looks for.
+    """
+    hits: Dict[str, int] = global_compiler_state.peephole_hits
+    original_size: int = len(instructions)
+    while True:
+        previous_hit_count: int = sum(hits.values())
+        instructions = apply_peephole_rules(instructions, hits)
+        for name, peephole_pass in PEEPHOLE_PASSES:
+            instructions, hit_count = peephole_pass(instructions)
+            if hit_count:
+                hits[name] = hits.get(name, 0) + hit_count
+        if sum(hits.values()) == previous_hit_count:
+            break
+    global_compiler_state.count_removed_instructions("Peephole optimization", original_size - len(instructions))
+    return instructions
+
+
+def is_tail_call(instruction: Instruction) -> bool:
+    """Returns if the instruction is a jump to the start of a function, left by the
+    Tail call peephole rule in place of a call.
+    """
+    if instruction.opcode != "JUMP":
+        return False
+    match = FUNCTION_LABEL_REGEX.match(instruction.argument)
+    return match is not None and match.group(2) == "START"
+
+
+def get_instruction_frames(instructions: List[Instruction]) -> List[Optional[str]]:
+    """Returns the start label of the function each instruction runs in, or None for the
+    code outside of every function, by following the control flow from the start of the
+    program and from every label that is called or tail called. Unreachable instructions
+    are left outside.
+    """
+    label_to_index: Dict[str, int] = {}
+    for index, instruction in enumerate(instructions):
+        if instruction.opcode == "@":
+            label_to_index[instruction.argument] = index
+    frames: List[Optional[str]] = [None] * len(instructions)
+    visited: List[bool] = [False] * len(instructions)
+    entries: List[Tuple[Optional[str], int]] = [(None, 0)]
+    for instruction in instructions:
+        if instruction.opcode == "CALL" or is_tail_call(instruction):
+            entries.append((instruction.argument, label_to_index[instruction.argument]))
+    for frame, entry in entries:
+        pending: List[int] = [entry]
+        while pending:
+            index: int = pending.pop()
+            while index < len(instructions) and not visited[index]:
+                visited[index] = True
+                frames[index] = frame
+                instruction: Instruction = instructions[index]
+                if instruction.opcode in JUMP_OPCODES and not is_tail_call(instruction):
+                    pending.append(label_to_index[instruction.argument])
+                if instruction.opcode in ("JUMP", "RTRN"):
+                    break
+                index += 1
+    return frames
+
+
+def get_function_prologues(instructions: List[Instruction]) -> Dict[str, int]:
+    """Returns the index of the first prologue instruction of every function that
+    starts with the usual FUNCTION_PROLOGUE, by start label.
+    """
+    prologues: Dict[str, int] = {}
+    for index, instruction in enumerate(instructions):
+        if instruction.opcode == "@" and instruction.argument.endswith("_START") \
+                and index + 2 + len(FUNCTION_PROLOGUE) <= len(instructions) and instructions[index + 1].opcode == "ADSC":
+            prologue: List[Instruction] = instructions[index + 2:index + 2 + len(FUNCTION_PROLOGUE)]
+            if all(instruction.opcode == opcode and argument in (None, instruction.argument) for instruction, (opcode, argument) in zip(prologue, FUNCTION_PROLOGUE)):
+                prologues[instruction.argument] = index + 2
+    return prologues
+
+
+def get_argument_limits(instructions: List[Instruction]) -> Dict[int, int]:
+    """Returns the index of the PLIM that starts the arguments of each CALL. The PLIMs
+    of table constructors are matched with their ARRR. The caller's context is pushed
+    right before the PLIM.
+    """
+    open_limits: List[int] = []
+    argument_limits: Dict[int, int] = {}
+    for index, instruction in enumerate(instructions):
+        if instruction.opcode == "PLIM":
+            open_limits.append(index)
+        elif instruction.opcode == "ARRR" and open_limits:
+            # The ARRR of a function prologue has its PLIM at the call site
+            open_limits.pop()
+        elif instruction.opcode == "CALL" and open_limits:
+            argument_limits[index] = open_limits.pop()
+    return argument_limits
+
+
+class InlinableFunction:
+    """The body of a function that inline_functions can copy into its call sites,
+    and what that body needs from them.
+    """
+    def __init__(self, name: str, body: List[Instruction]) -> None:
+        self.name: str = name
+        self.body: List[Instruction] = body  # Everything between the prologue and the end label
+        self.uses_table: bool = False  # If it uses $_ other than as $_[n], with a constant n
+        self.reads_caller: bool = False
+        self.local_variables: Set[str] = {'"_"', '"_caller"', '"_context"'}
+        self.free_variables: Set[str] = set()  # Read or unset but never set, so global
+
+
+def find_inlinable_function(instructions: List[Instruction], prologue_index: int, end_index: int) -> Optional[InlinableFunction]:
+    """Returns the function whose prologue and end label are at the given indices, or None
+    if it can't be inlined: it opts out with noinline, declares other functions, is bigger
+    than INLINE_SIZE_LIMIT or could read or unset one of its variables before setting it,
+    which would find the global variable of the same name instead.
+    """
+    body: List[Instruction] = instructions[prologue_index + len(FUNCTION_PROLOGUE):end_index]
+    if len([instruction for instruction in body if instruction.opcode not in (";", "@")]) > INLINE_SIZE_LIMIT:
+        return None
+    function: InlinableFunction = InlinableFunction(instructions[prologue_index + 3].argument, body)
+    label_to_index: Dict[str, int] = {}
+    for index, instruction in enumerate(body):
+        if instruction.opcode == ";" and instruction.argument == NO_INLINE_MODIFIER:
+            return None
+        elif instruction.opcode == "@":
+            if FUNCTION_LABEL_REGEX.match(instruction.argument):
+                return None
+            label_to_index[instruction.argument] = index
+        elif instruction.opcode == "ADSC":
+            return None
+        elif instruction.opcode == "VSET":
+            function.local_variables.add(instruction.argument)
+    for index, instruction in enumerate(body):
+        if instruction.opcode in JUMP_OPCODES and instruction.argument not in label_to_index:
+            return None
+        # Returns become jumps to the end of the inlined copy
+        if instruction.opcode in ("DLSC", "RTRN"):
+            neighbour_index: int = index + 1 if instruction.opcode == "DLSC" else index - 1
+            if not 0 <= neighbour_index < len(body) or body[neighbour_index].opcode != ("RTRN" if instruction.opcode == "DLSC" else "DLSC"):
+                return None
+        if instruction.opcode not in ("VGET", "UNST", "NEXT"):
+            continue
+        if instruction.argument == '"_"':
+            if instruction.opcode != "VGET" or index + 2 >= len(body) or body[index + 1].opcode != "PUSH" \
+                    or not ARGUMENT_INDEX_REGEX.match(body[index + 1].argument) or body[index + 2].opcode != "PGET":
+                function.uses_table = True
+        elif instruction.argument == '"_caller"':
+            function.reads_caller = True
+        elif instruction.argument not in function.local_variables:
+            function.free_variables.add(instruction.argument)
+    # Follow the control flow with the variables that are set on every path to each instruction
+    assigned_variables: List[Optional[Set[str]]] = [None] * (len(body) + 1)
+    assigned_variables[0] = {'"_"', '"_caller"', '"_context"'}
+    pending: List[int] = [0]
+    while pending:
+        index: int = pending.pop()
+        if index == len(body):
+            continue
+        instruction: Instruction = body[index]
+        variables: Set[str] = set(assigned_variables[index])
+        if instruction.opcode in ("VGET", "UNST", "NEXT") and instruction.argument in function.local_variables \
+                and instruction.argument not in variables:
+            return None
+        if instruction.opcode == "VSET":
+            variables.add(instruction.argument)
+        elif instruction.opcode == "UNST":
+            variables.discard(instruction.argument)
+        successors: List[int] = []
+        if instruction.opcode in JUMP_OPCODES:
+            successors.append(label_to_index[instruction.argument])
+        if instruction.opcode not in ("JUMP", "RTRN"):
+            successors.append(index + 1)
+        for successor in successors:
+            if assigned_variables[successor] is None:
+                assigned_variables[successor] = variables
+                pending.append(successor)
+            elif not assigned_variables[successor] <= variables:
+                assigned_variables[successor] &= variables
+                pending.append(successor)
+    return function
+
+
+def get_recursive_functions(instructions: List[Instruction], frames: List[Optional[str]]) -> Set[str]:
+    """Returns the start labels of the functions that can end up calling themselves.
+    """
+    called_functions: Dict[Optional[str], Set[str]] = {}
+    for instruction, frame in zip(instructions, frames):
+        if instruction.opcode == "CALL":
+            called_functions.setdefault(frame, set()).add(instruction.argument)
+    recursive_functions: Set[str] = set()
+    for start_label in called_functions:
+        if start_label is None:
+            continue
+        reached: Set[str] = set()
+        pending: List[str] = list(called_functions[start_label])
+        while pending and start_label not in reached:
+            callee: str = pending.pop()
+            if callee not in reached:
+                reached.add(callee)
+                pending += called_functions.get(callee, set())
+        if start_label in reached:
+            recursive_functions.add(start_label)
+    return recursive_functions
+
+
+def copy_inlined_function(function: InlinableFunction, call: Instruction, context_push: Instruction, copy_id: int, variables_id: int) -> List[Instruction]:
+    """Returns the code that replaces a call to the function once its arguments are on the stack.
+    Labels get names of their own for each copy, and variables for each function: copies of
+    one function never run inside each other, so they can share them instead of leaving a new
+    global behind at every call site. Each $_[n] reads the variable the nth argument was stored
+    in, unless the function uses $_ as a table.
+    """
+    def rename_variable(argument: str) -> str:
+        return f'"$inl{variables_id}_{argument[1:-1]}"'
+
+    def rename_label(label: str) -> str:
+        return f"INLINE_{copy_id}_{label}"
+
+    end_label: str = rename_label("END")
+    inlined_code: List[Instruction] = []
+    if function.uses_table:
+        inlined_code.append(Instruction("ARRR", None, call.line, call.file))
+        inlined_code.append(Instruction("VSET", rename_variable('"_"'), call.line, call.file))
+    else:
+        for argument_index in range(call.argument_count, 0, -1):
+            # A nil argument fails like in the ARRR of a call: the ARRR of an empty table
+            # constructor holding a nil. Expressions can't give iterators, so only nil is checked.
+            checked_label: str = rename_label(f"ARG{argument_index}")
+            inlined_code.append(Instruction("DUPL", None, call.line, call.file))
+            inlined_code.append(Instruction("NIL?", None, call.line, call.file))
+            inlined_code.append(Instruction("JPIF", checked_label, call.line, call.file))
+            inlined_code.append(Instruction("PLIM", None, call.line, call.file))
+            inlined_code.append(Instruction("PNIL", None, call.line, call.file))
+            inlined_code.append(Instruction("ARRR", None, call.line, call.file))
+            inlined_code.append(Instruction("@", checked_label, call.line, call.file))
+            inlined_code.append(Instruction("VSET", rename_variable(f'"arg{argument_index}"'), call.line, call.file))
+    if function.reads_caller:
+        inlined_code.append(Instruction("VSET", rename_variable('"_caller"'), call.line, call.file))
+    inlined_code.append(Instruction("PUSH", function.name, context_push.line, context_push.file))
+    inlined_code.append(Instruction("VSET", rename_variable('"_context"'), context_push.line, context_push.file))
+    inlined_code.append(Instruction("PNIL", None, call.line, call.file))
+    index: int = 0
+    while index < len(function.body):
+        instruction: Instruction = function.body[index]
+        opcode: str = instruction.opcode
+        argument: Optional[str] = instruction.argument
+        if opcode == "VGET" and argument == '"_"' and not function.uses_table:
+            argument_index: int = int(function.body[index + 1].argument)
+            if argument_index > call.argument_count:
+                opcode, argument = "PNIL", None
+            else:
+                argument = rename_variable(f'"arg{argument_index}"')
+            index += 2
+        elif opcode in ("VGET", "VSET", "UNST", "NEXT") and argument in function.local_variables:
+            argument = rename_variable(argument)
+        elif opcode == "@" or opcode in JUMP_OPCODES:
+            argument = rename_label(argument)
+        elif opcode == "DLSC":
+            opcode, argument = "JUMP", end_label
+        elif opcode == "RTRN":
+            index += 1
+            continue
+        inlined_code.append(Instruction(opcode, argument, instruction.line, instruction.file))
+        inlined_code[-1].argument_count = instruction.argument_count
+        index += 1
+    inlined_code.append(Instruction("@", end_label, call.line, call.file))
+    # Errors after the copy happen in the line of the call again
+    inlined_code.append(Instruction(";", f"line {call.line}", call.line, call.file))
+    inlined_code.append(Instruction(";", f"file {call.file}", call.line, call.file))
+    return inlined_code
+
+
+def inline_functions(instructions: List[Instruction]) -> List[Instruction]:
+    """Replaces the calls to small, non-recursive functions with a copy of their body.
+    Arguments are evaluated once, into variables of the copy. Only calls from frames that
+    don't set any of the global variables the function reads are inlined. Must run after
+    resolve_shadowed_calls, so every call already points to the body that runs, and before
+    eliminate_dead_functions, which removes the functions no longer called.
+    """
+    copy_count: int = 0
+    variables_ids: Dict[str, int] = {}  # Start label -> number in the names of the variables of its copies
+    inlined_calls: Dict[str, int] = global_compiler_state.inlined_calls
+    while True:
+        frames: List[Optional[str]] = get_instruction_frames(instructions)
+        recursive_functions: Set[str] = get_recursive_functions(instructions, frames)
+        label_to_index: Dict[str, int] = {}
+        for index, instruction in enumerate(instructions):
+            if instruction.opcode == "@":
+                label_to_index[instruction.argument] = index
+        functions: Dict[str, InlinableFunction] = {}
+        for start_label, prologue_index in get_function_prologues(instructions).items():
+            match = FUNCTION_LABEL_REGEX.match(start_label)
+            end_label: str = f"FUN_{match.group(1)}_END" if match else ""
+            if start_label not in recursive_functions and end_label in label_to_index:
+                function: Optional[InlinableFunction] = find_inlinable_function(instructions, prologue_index, label_to_index[end_label])
+                if function is not None:
+                    functions[start_label] = function
+        frame_variables: Dict[Optional[str], Set[str]] = {}
+        for instruction, frame in zip(instructions, frames):
+            if instruction.opcode == "VSET":
+                frame_variables.setdefault(frame, set()).add(instruction.argument)
+        # Pick the calls to inline, by the index of their PLIM
+        inlined_limits: Dict[int, int] = {}
+        for call_index, limit_index in get_argument_limits(instructions).items():
+            function: Optional[InlinableFunction] = functions.get(instructions[call_index].argument)
+            frame: Optional[str] = frames[call_index]
+            if function is None or instructions[limit_index - 1].opcode != "VGET" \
+                    or (instructions[call_index].argument_count < 0 and not function.uses_table) \
+                    or (frame is not None and function.free_variables & frame_variables.get(frame, set())):
+                continue
+            inlined_limits[limit_index] = call_index
+        if not inlined_limits:
+            break
+        inlined_calls_by_index: Dict[int, int] = {call_index: limit_index for limit_index, call_index in inlined_limits.items()}
+        inlined_instructions: List[Instruction] = []
+        for index, instruction in enumerate(instructions):
+            if index + 1 in inlined_limits:
+                # The caller's context is only kept for functions that read $_caller
+                if functions[instructions[inlined_limits[index + 1]].argument].reads_caller:
+                    inlined_instructions.append(instruction)
+            elif index in inlined_limits:
+                if functions[instructions[inlined_limits[index]].argument].uses_table:
+                    inlined_instructions.append(instruction)
+            elif index in inlined_calls_by_index:
+                function: InlinableFunction = functions[instruction.argument]
+                context_push: Instruction = instructions[inlined_calls_by_index[index] - 1]
+                variables_id: int = variables_ids.setdefault(instruction.argument, len(variables_ids))
+                inlined_instructions += copy_inlined_function(function, instruction, context_push, copy_count, variables_id)
+                inlined_calls[function.name] = inlined_calls.get(function.name, 0) + 1
+                copy_count += 1
+            else:
+                inlined_instructions.append(instruction)
+        instructions = inlined_instructions
+    return instructions
+
+
+def use_fast_calls(instructions: List[Instruction]) -> List[Instruction]:
+    """Switches the functions that only read their arguments as $_[n], with a constant n,
+    to a call convention for the Python NariVM where ARGS pops the arguments straight
+    into the first frame slots instead of building the $_ table. $_caller is only passed
+    to the functions that read it, and $_context is only set by the functions that read
+    it or pass it on. Must run before optimize_peephole and resolve_variable_slots.
+    """
+    frames: List[Optional[str]] = get_instruction_frames(instructions)
+    prologues: Dict[str, int] = get_function_prologues(instructions)
+    # See how each function uses $_ and $_caller
+    argument_counts: Dict[str, int] = {start_label: 0 for start_label in prologues}
+    needs_table: Set[str] = set()
+    reads_caller: Set[str] = set()
+    for index, (instruction, frame) in enumerate(zip(instructions, frames)):
+        if frame not in prologues or prologues[frame] <= index < prologues[frame] + len(FUNCTION_PROLOGUE):
+            continue
+        if instruction.opcode not in ("VGET", "VSET", "GSET", "UNST", "NEXT"):
+            continue
+        if instruction.argument == '"_"':
+            if instruction.opcode == "VGET" and index + 2 < len(instructions) and instructions[index + 1].opcode == "PUSH" \
+                    and ARGUMENT_INDEX_REGEX.match(instructions[index + 1].argument) and instructions[index + 2].opcode == "PGET":
+                argument_counts[frame] = max(argument_counts[frame], int(instructions[index + 1].argument))
             else:
-                access_tokens.append(token)
+                needs_table.add(frame)
+        elif instruction.argument == '"_caller"':
+            reads_caller.add(frame)
+    # Match every call with the instruction that pushes the caller's context for it
+    argument_limits: Dict[int, int] = get_argument_limits(instructions)
+    caller_pushes: List[Tuple[int, str]] = []
+    for index, instruction in enumerate(instructions):
+        if instruction.opcode == "CALL":
+            if index not in argument_limits or instructions[argument_limits[index] - 1].opcode != "VGET" or instruction.argument not in prologues:
+                reads_caller.add(instruction.argument)
+            else:
+                caller_pushes.append((argument_limits[index] - 1, instruction.argument))
+    dropped_indices: Set[int] = {index for index, start_label in caller_pushes if start_label not in reads_caller}
+    # Functions still pushing their context, or reading it, have to set it
+    needs_context: Set[Optional[str]] = set()
+    for index, (instruction, frame) in enumerate(zip(instructions, frames)):
+        if instruction.argument == '"_context"' and instruction.opcode in ("VGET", "UNST", "NEXT") and index not in dropped_indices:
+            needs_context.add(frame)
+    fast_instructions: List[Instruction] = []
+    index: int = 0
+    while index < len(instructions):
+        instruction: Instruction = instructions[index]
+        frame: Optional[str] = frames[index]
+        if index in dropped_indices:
+            index += 1
+            continue
+        if frame not in prologues:
+            fast_instructions.append(instruction)
+            index += 1
+            continue
+        prologue_offset: int = index - prologues[frame]
+        if prologue_offset == 0 and frame not in needs_table:
+            fast_instructions.append(Instruction("ARGS", str(argument_counts[frame]), instruction.line, instruction.file))
+        elif prologue_offset == 1 and frame not in needs_table:
+            pass
+        elif prologue_offset == 2 and frame not in reads_caller:
+            pass
+        elif prologue_offset in (3, 4) and frame not in needs_context:
+            pass
+        elif frame not in needs_table and instruction.opcode == "VGET" and instruction.argument == '"_"' and prologue_offset >= len(FUNCTION_PROLOGUE):
+            # $_[n] reads the frame slot ARGS left the argument in
+            fast_instructions.append(Instruction("VGET", f'"$arg{instructions[index + 1].argument}"', instruction.line, instruction.file))
+            index += 2
         else:
-            next_token = None
-            if len(expr_tokens) > 0:
-                next_token = expr_tokens[0]
-            if token.type == LexType.OPERATOR and token.value == "-":
-                if next_token is None:
-                    expression_error(
-                        "Missing value after '-'",
-                        token.line,
-                        token.file
-                    )
-                if next_token.type in [LexType.INTEGER, LexType.FLOAT]:
-                    if terminator_type != LexType.UNKNOWN:
-                        expression_error(f"Unexpected token '{token.value}'.", token.line, token.file)
-                    compiled_code += f"\nPUSH -{next_token.value}" 
-                    terminator_type = next_token.type
-                    expr_tokens.pop(0)
+            fast_instructions.append(instruction)
+        index += 1
+    global_compiler_state.count_removed_instructions("Fast calls", len(instructions) - len(fast_instructions))
+    return fast_instructions
+
+
+def resolve_variable_slots(instructions: List[Instruction]) -> List[Instruction]:
+    """Replaces variable names with numbered slots, for the Python NariVM. Every variable
+    gets a slot in the global table, and every function a frame with a slot for each
+    variable it sets. As with names, reading or unsetting an empty frame slot falls back
+    to the global slot of the same variable.
+    """
+    frames: List[Optional[str]] = get_instruction_frames(instructions)
+    global_slots: Dict[str, int] = {}
+    frame_slots: Dict[Optional[str], Dict[str, int]] = {}
+    for instruction, frame in zip(instructions, frames):
+        if instruction.opcode == "ARGS":
+            # ARGS leaves the arguments the function reads in the first slots of its frame
+            local_slots: Dict[str, int] = frame_slots.setdefault(frame, {})
+            for argument_index in range(1, int(instruction.argument) + 1):
+                global_slots.setdefault(f'"$arg{argument_index}"', len(global_slots))
+                local_slots[f'"$arg{argument_index}"'] = argument_index - 1
+    for instruction, frame in zip(instructions, frames):
+        if instruction.opcode in ("VGET", "VSET", "GSET", "UNST", "NEXT"):
+            global_slots.setdefault(instruction.argument, len(global_slots))
+            if instruction.opcode == "VSET" and frame is not None:
+                local_slots: Dict[str, int] = frame_slots.setdefault(frame, {})
+                local_slots.setdefault(instruction.argument, len(local_slots))
+    global_opcodes: Dict[str, str] = {"VGET": "GGET", "VSET": "GPUT", "GSET": "GPUT", "UNST": "GDEL", "NEXT": "GNXT"}
+    fallback_opcodes: Dict[str, str] = {"VGET": "LGET", "UNST": "LDEL", "NEXT": "LNXT"}
+    resolved_instructions: List[Instruction] = []
+    for instruction, frame in zip(instructions, frames):
+        opcode: str = instruction.opcode
+        argument: Optional[str] = instruction.argument
+        local_slots: Dict[str, int] = frame_slots.get(frame, {})
+        if opcode == "ADSC":
+            opcode, argument = "ADFR", str(len(local_slots))
+        elif opcode == "DLSC":
+            opcode = "DLFR"
+        elif opcode == "VSET" and argument in local_slots:
+            opcode, argument = "LPUT", str(local_slots[argument])
+        elif opcode in fallback_opcodes and argument in local_slots:
+            opcode, argument = fallback_opcodes[opcode], f"{local_slots[argument]} {global_slots[argument]}"
+        elif opcode in global_opcodes:
+            opcode, argument = global_opcodes[opcode], str(global_slots[argument])
+        else:
+            resolved_instructions.append(instruction)
+            continue
+        resolved_instructions.append(Instruction(opcode, argument, instruction.line, instruction.file))
+    return resolved_instructions
+
+
+def print_removed_instructions():
+    """Prints how many instructions each optimization removed from the program
+    and how many times each peephole rule was applied.
+    """
+    for optimization, count in global_compiler_state.removed_instructions.items():
+        print(f"{optimization}: {count} instructions removed.", file=sys.stderr)
+    for rule, count in global_compiler_state.peephole_hits.items():
+        print(f"Peephole rule '{rule}': {count} hits.", file=sys.stderr)
+    for function_name, count in global_compiler_state.inlined_calls.items():
+        print(f"Inlined calls to {function_name}: {count}.", file=sys.stderr)
+
+
+def instructions_to_nambly(instructions: List[Instruction]) -> str:
+    """Serializes a list of instructions into Nambly code, one instruction per line.
+    """
+    return "".join([instruction.to_nambly() + "\n" for instruction in instructions])
+
+
+def get_bytecode_constant(argument: str) -> Tuple[int, str]:
+    """Returns the type (as numbered by the NariVM) and the text of the value a
+    Nambly argument stands for, unescaping strings like the NariVM does.
+    """
+    if argument.startswith('"'):
+        text: str = re.sub(r"\\(.)", lambda match: STRING_ESCAPES.get(match.group(1), match.group(1)), argument[1:-1], flags=re.DOTALL)
+        return 3, text
+    match = BYTECODE_NUMBER_REGEX.match(argument)
+    if match is None:
+        return 5, argument
+    return (1 if match.group(1) is None else 2), argument
+
+
+def instructions_to_bytecode(instructions: List[Instruction]) -> bytes:
+    """Serializes a list of instructions into NariVM bytecode (.nvb). It has a table
+    of the opcodes used, a deduplicated constant pool, one opcode byte and one
+    32 bit operand per instruction (jumps hold the index of their target and slot
+    opcodes their slot), the global slots of the commands that fall back to one,
+    and a line table with the first instruction of each source line.
+    """
+    label_to_pc: Dict[str, int] = {}
+    pc: int = 0
+    for instruction in instructions:
+        if instruction.opcode == "@":
+            label_to_pc[instruction.argument] = pc
+        elif instruction.opcode != ";":
+            pc += 1
+    opcode_indices: Dict[str, int] = {}
+    constant_indices: Dict[Tuple[int, str], int] = {}
+    opcodes: bytearray = bytearray()
+    operands: List[int] = []
+    fallback_slots: List[int] = []
+    lines: List[int] = []
+    last_location: Optional[Tuple[int, str]] = None
+    for instruction in instructions:
+        if instruction.opcode in (";", "@"):
+            continue
+        opcodes.append(opcode_indices.setdefault(instruction.opcode, len(opcode_indices)))
+        if instruction.opcode in JUMP_OPCODES + ("CALL",):
+            operands.append(label_to_pc[instruction.argument])
+        elif instruction.opcode in SLOT_OPCODES:
+            # Fallback slots keep the frame slot as their operand and the global one in a table of its own
+            slots: List[int] = [int(slot) for slot in instruction.argument.split()]
+            operands.append(slots[0])
+            fallback_slots += slots[1:]
+        elif instruction.argument is None:
+            operands.append(-1)
+        else:
+            operands.append(constant_indices.setdefault(get_bytecode_constant(instruction.argument), len(constant_indices)))
+        if (instruction.line, instruction.file) != last_location:
+            last_location = (instruction.line, instruction.file)
+            lines += [len(operands) - 1, instruction.line, constant_indices.setdefault((3, instruction.file), len(constant_indices))]
+    encoded_constants: List[bytes] = [text.encode() for _, text in constant_indices]
+    bytecode: List[bytes] = [struct.pack("<4sH", BYTECODE_MAGIC, BYTECODE_VERSION)]
+    bytecode.append(struct.pack("<I", len(opcode_indices)))
+    bytecode += [opcode.encode() for opcode in opcode_indices]
+    bytecode.append(struct.pack("<I", len(constant_indices)))
+    bytecode.append(bytes([constant_type for constant_type, _ in constant_indices]))
+    bytecode.append(struct.pack(f"<{len(encoded_constants)}I", *[len(constant) for constant in encoded_constants]))
+    bytecode += encoded_constants
+    bytecode.append(struct.pack("<I", len(opcodes)))
+    bytecode.append(bytes(opcodes))
+    bytecode.append(struct.pack(f"<{len(operands)}i", *operands))
+    bytecode.append(struct.pack("<I", len(fallback_slots)))
+    bytecode.append(struct.pack(f"<{len(fallback_slots)}I", *fallback_slots))
+    bytecode.append(struct.pack("<I", len(lines) // 3))
+    bytecode.append(struct.pack(f"<{len(lines)}I", *lines))
+    return b"".join(bytecode)
+
+
+class UnstructuredCode(Exception):
+    """Raised by the Python transpiler when the jumps of a function don't nest like
+    the loops and conditionals of Python do.
+    """
+
+
+class PythonBlock:
+    """A run of instructions of a function that always run together, as seen by the
+    Python transpiler. It ends with a jump or a return, or falls into the next block.
+    """
+    def __init__(self) -> None:
+        self.body: List[Instruction] = []
+        self.end: Optional[Instruction] = None  # JUMP, JPIF, RNXT, PNXT or RTRN that ends the block
+        self.target: int = -1  # Block the end instruction jumps to, -1 for RTRN and tail calls
+        self.landing: List[Instruction] = []  # Values pushed before jumping to the target
+        self.entries: List[int] = []  # Live blocks that jump or fall into this one
+        self.live: bool = False
+
+    def get_falls(self) -> bool:
+        return self.end is None or self.end.opcode in ("JPIF", "RNXT", "PNXT")
+
+
+class PythonLoop:
+    """A loop the Python transpiler emits as a while loop: the blocks from its head to
+    the last block that jumps back to it. Jumps out of it to anywhere but the block
+    after its last one set its exit variable before breaking.
+    """
+    def __init__(self, head: int, last: int, exit_variable: str) -> None:
+        self.head: int = head
+        self.last: int = last
+        self.exit_variable: str = exit_variable
+        self.exits: Dict[int, int] = {}  # Block -> number the exit variable takes to go there
+
+
+class PythonTranspiler:
+    """Turns a Nambly program (with its variables resolved to slots) into the source of a
+    Python module that runs it with the values and command handlers of the Python NariVM.
+    Every function becomes a Python function and the code outside of them becomes main().
+    Loops become while loops and conditional jumps become if statements where the jumps
+    nest like they do in Python; the functions where they don't become a loop that picks
+    the next block to run. Values that are pushed and popped within the same run of
+    instructions are kept in local variables instead of the execution stack.
+    """
+    def __init__(self, instructions: List[Instruction]) -> None:
+        self.__instructions: List[Instruction] = [instruction for instruction in instructions if instruction.opcode != ";"]
+        self.__label_to_index: Dict[str, int] = {}
+        for index, instruction in enumerate(self.__instructions):
+            if instruction.opcode == "@":
+                self.__label_to_index[instruction.argument] = index
+        self.__entries: Set[str] = {instruction.argument for instruction in self.__instructions if instruction.opcode == "CALL" or is_tail_call(instruction)}
+        self.__lines: List[Tuple[int, str, Optional[Instruction]]] = []  # Indentation, code and the instruction it runs
+        self.__constants: Dict[str, str] = {}  # Nambly argument -> name of its value
+        self.__commands: List[Tuple[str, Instruction]] = []  # Names and instructions of the commands handlers get
+        self.__handlers: Dict[str, str] = {}  # Opcode -> name of its handler
+        self.__trampolines: bool = False
+        self.__blocks: List[PythonBlock] = []
+        self.__block_labels: Dict[str, int] = {}
+        self.__loop_lasts: Dict[int, int] = {}  # Head -> last block of each loop
+        self.__loops: List[PythonLoop] = []  # Loops being emitted, innermost last
+        self.__loop_count: int = 0
+        self.__pending: List[str] = []  # Values pushed but not yet on the execution stack
+        self.__temporary_count: int = 0
+        self.__frame: str = "slot_frames[-1]"  # Where the function keeps its frame slots
+        self.__current: Optional[Instruction] = None  # Instruction the emitted lines run
+        self.__indentation: int = 0
+
+    def transpile(self) -> str:
+        frames: List[Tuple[Optional[str], List[int]]] = [(None, self.__get_frame_indices(0, None))]
+        for label in sorted(self.__entries, key=lambda label: self.__label_to_index[label]):
+            frames.append((label, self.__get_frame_indices(self.__label_to_index[label], label)))
+        for frame, indices in frames:
+            for index in indices:
+                instruction: Instruction = self.__instructions[index]
+                if is_tail_call(instruction) and instruction.argument != frame:
+                    self.__trampolines = True
+        for frame, indices in reversed(frames):
+            self.__emit_function(frame, indices)
+        return self.__get_module()
+
+    def __get_frame_indices(self, entry: int, frame: Optional[str]) -> List[int]:
+        """Returns the indices of the instructions a function can run, in order, without
+        following calls or tail calls into other functions.
+        """
+        visited: Set[int] = set()
+        pending: List[int] = [entry]
+        while pending:
+            index: int = pending.pop()
+            while index < len(self.__instructions) and index not in visited:
+                visited.add(index)
+                instruction: Instruction = self.__instructions[index]
+                if instruction.opcode in JUMP_OPCODES and not self.__is_other_function(instruction, frame):
+                    pending.append(self.__label_to_index[instruction.argument])
+                if instruction.opcode in ("JUMP", "RTRN"):
+                    break
+                index += 1
+        return sorted(visited)
+
+    def __is_other_function(self, instruction: Instruction, frame: Optional[str]) -> bool:
+        return is_tail_call(instruction) and instruction.argument != frame
+
+    def __get_module(self) -> str:
+        header: List[str] = ["# Katalyn program transpiled to Python by kat.py", "from narivm import *", "", "stack_push = execution_stack.append"]
+        for argument, name in self.__constants.items():
+            header.append(f"{name} = make_constant{get_bytecode_constant(argument)!r}")
+        for opcode, name in self.__handlers.items():
+            header.append(f"{name} = COMMAND_HANDLERS.get({opcode!r}, execute_unknown)")
+        for name, instruction in self.__commands:
+            slots: List[int] = [int(slot) for slot in instruction.argument.split()] if instruction.opcode in SLOT_OPCODES else []
+            arguments: str = "" if instruction.argument is None or slots else f"make_constant{get_bytecode_constant(instruction.argument)!r}"
+            slot: int = slots[0] if slots and instruction.opcode not in GLOBAL_SLOT_OPCODES else -1
+            global_slot: int = slots[-1] if instruction.opcode in GLOBAL_SLOT_OPCODES + FALLBACK_SLOT_OPCODES else -1
+            header.append(f"{name} = make_command({instruction.opcode!r}, [{arguments}], {slot}, {global_slot})")
+        source: List[str] = header + [""]
+        source_lines: Dict[int, Tuple[int, str]] = {}
+        for indentation, code, instruction in self.__lines:
+            source.append("    " * indentation + code)
+            if instruction is not None:
+                source_lines[len(source)] = (instruction.line, instruction.file)
+        source.append(f"SOURCE_LINES = {source_lines!r}")
+        return "\n".join(source) + "\n"
+
+    def __line(self, indentation: int, code: str) -> None:
+        self.__lines.append((indentation, code, self.__current))
+
+    def __constant(self, argument: str) -> str:
+        return self.__constants.setdefault(argument, f"K{len(self.__constants)}")
+
+    def __command(self, instruction: Instruction) -> str:
+        self.__commands.append((f"C{len(self.__commands)}", instruction))
+        return self.__commands[-1][0]
+
+    def __handler(self, opcode: str) -> str:
+        return self.__handlers.setdefault(opcode, f"run_{re.sub(r'[^a-z]', '_', opcode.lower())}")
+
+    def __temporary(self) -> str:
+        self.__temporary_count += 1
+        return f"t{self.__temporary_count}"
+
+    def __function_name(self, label: Optional[str]) -> str:
+        return "main" if label is None else "fun_" + re.sub(r"\W", "_", label.lower())
+
+    def __flush(self, indentation: int) -> None:
+        """Pushes the values kept in local variables to the execution stack.
+        """
+        if len(self.__pending) == 1:
+            self.__line(indentation, f"stack_push({self.__pending[0]})")
+        elif self.__pending:
+            self.__line(indentation, f"execution_stack.extend(({', '.join(self.__pending)},))")
+        self.__pending = []
+
+    def __operand(self, instruction: Instruction) -> str:
+        if self.__pending:
+            return self.__pending.pop()
+        temporary: str = self.__temporary()
+        self.__line(self.__indentation, f"{temporary} = pop({self.__command(instruction)})")
+        return temporary
+
+    def __emit_function(self, frame: Optional[str], indices: List[int]) -> None:
+        """Emits a function, structured if possible and as a loop over its blocks otherwise.
+        """
+        self.__split_blocks(indices)
+        first_line: int = len(self.__lines)
+        self.__current = self.__instructions[indices[0]]
+        self.__line(0, f"def {self.__function_name(frame)}():")
+        adfr_count: int = sum(1 for index in indices if self.__instructions[index].opcode == "ADFR")
+        self.__frame = "frame" if adfr_count == 1 and self.__blocks[0].body and self.__blocks[0].body[0].opcode == "ADFR" else "slot_frames[-1]"
+        if frame is None:
+            global_slots: List[int] = [int(instruction.argument.split()[-1]) for instruction in self.__instructions if instruction.opcode in GLOBAL_SLOT_OPCODES + FALLBACK_SLOT_OPCODES]
+            self.__line(1, f"global_slots[:] = [None] * {max(global_slots, default=-1) + 1}")
+        body_line: int = len(self.__lines)
+        try:
+            self.__find_loops()
+            self.__loops = []
+            self.__pending = []
+            self.__emit_window(0, len(self.__blocks), len(self.__blocks), 1, -1, frame)
+        except UnstructuredCode:
+            del self.__lines[body_line:]
+            self.__pending = []
+            self.__emit_state_machine(frame)
+        if len(self.__lines) == first_line + 1:
+            self.__line(1, "pass")
+        self.__line(0, "")
+
+    def __split_blocks(self, indices: List[int]) -> None:
+        """Splits the instructions of a function into blocks, at the labels jumped to and
+        after every jump, then finds which blocks run and what runs before each of them.
+        """
+        targets: Set[str] = {self.__instructions[index].argument for index in indices if self.__instructions[index].opcode in JUMP_OPCODES}
+        self.__blocks = [PythonBlock()]
+        self.__block_labels = {}
+        for index in indices:
+            instruction: Instruction = self.__instructions[index]
+            if instruction.opcode == "@":
+                if instruction.argument in targets:
+                    if self.__blocks[-1].body or self.__blocks[-1].end is not None:
+                        self.__blocks.append(PythonBlock())
+                    self.__block_labels[instruction.argument] = len(self.__blocks) - 1
+                continue
+            if self.__blocks[-1].end is not None:
+                self.__blocks.append(PythonBlock())
+            if instruction.opcode in JUMP_OPCODES or instruction.opcode == "RTRN":
+                self.__blocks[-1].end = instruction
+            else:
+                self.__blocks[-1].body.append(instruction)
+        for block in self.__blocks:
+            if block.end is not None and block.end.opcode in JUMP_OPCODES and block.end.argument in self.__block_labels:
+                block.target = self.__block_labels[block.end.argument]
+        # Jumps to a block that only pushes constants push them themselves and skip it
+        for block in self.__blocks:
+            if block.target < 0 or block.end.opcode in ("RNXT", "PNXT"):
+                continue
+            landing_block: PythonBlock = self.__blocks[block.target]
+            if 0 < len(landing_block.body) <= 2 and landing_block.end is None and block.target + 1 < len(self.__blocks) \
+                    and all(instruction.opcode == "PUSH" for instruction in landing_block.body):
+                block.landing = landing_block.body
+                block.target += 1
+        # Find the blocks that run, and where they are entered from
+        pending: List[int] = [0]
+        self.__blocks[0].live = True
+        while pending:
+            index: int = pending.pop()
+            block: PythonBlock = self.__blocks[index]
+            successors: List[int] = []
+            if block.get_falls() and index + 1 < len(self.__blocks):
+                successors.append(index + 1)
+            if block.target >= 0:
+                successors.append(block.target)
+            for successor in successors:
+                self.__blocks[successor].entries.append(index)
+                if not self.__blocks[successor].live:
+                    self.__blocks[successor].live = True
+                    pending.append(successor)
+
+    def __find_loops(self) -> None:
+        """Finds the loops of the current function: every block jumped to from a block that
+        comes after it is the head of a loop that lasts until the last of those blocks.
+        """
+        self.__loop_lasts = {}
+        for index, block in enumerate(self.__blocks):
+            if block.live and 0 <= block.target <= index:
+                self.__loop_lasts[block.target] = max(self.__loop_lasts.get(block.target, index), index)
+        for head, last in self.__loop_lasts.items():
+            for other_head, other_last in self.__loop_lasts.items():
+                if head < other_head <= last < other_last:
+                    raise UnstructuredCode()
+            for index in range(head + 1, last + 1):
+                if any(entry < head or entry > last for entry in self.__blocks[index].entries):
+                    raise UnstructuredCode()
+
+    def __is_closed(self, first: int, end: int, sources: Tuple[int, int]) -> bool:
+        """Returns if the blocks from first to end (not included) are only entered from
+        each other, and the first one also from the given range of blocks.
+        """
+        for index in range(first, end):
+            for entry in self.__blocks[index].entries:
+                if not (first <= entry < end or (index == first and sources[0] <= entry <= sources[1])):
+                    return False
+        for head, last in self.__loop_lasts.items():
+            if (first <= head < end and last >= end) or (head < first <= last < end - 1):
+                return False
+        return True
+
+    def __resolve(self, target: int, first: int, end: int, follow: int) -> Tuple[str, Union[int, List[str]]]:
+        """Returns what a jump to a block does from a window of blocks: a statement
+        ("statement", lines), leaving the window ("end", follow) or going to one of the
+        blocks in it ("local", block).
+        """
+        if self.__loops and self.__loops[-1].head <= first:
+            loop: PythonLoop = self.__loops[-1]
+            if target == loop.head:
+                return "statement", ["continue"]
+            if target == loop.last + 1:
+                return "statement", ["break"]
+            if target < loop.head or target > loop.last + 1:
+                number: int = loop.exits.setdefault(target, len(loop.exits) + 1)
+                return "statement", [f"{loop.exit_variable} = {number}", "break"]
+        if target == follow:
+            return "end", follow
+        if first < target < end:
+            return "local", target
+        raise UnstructuredCode()
+
+    def __push_landing(self, landing: List[Instruction], indentation: int) -> None:
+        for instruction in landing:
+            self.__current = instruction
+            self.__line(indentation, f"stack_push({self.__constant(instruction.argument)})")
+
+    def __emit_window(self, first: int, end: int, follow: int, indentation: int, loop_body: int, frame: Optional[str]) -> None:
+        """Emits the blocks from first to end (not included), which continue into the
+        follow block once they are done. If loop_body is first, they are the body of the
+        loop that starts there.
+        """
+        if indentation > PYTHON_NESTING_LIMIT:
+            raise UnstructuredCode()
+        index: int = first
+        while index < end:
+            block: PythonBlock = self.__blocks[index]
+            if not block.live:
+                index += 1
+                continue
+            if index in self.__loop_lasts and not (index == first and loop_body == first):
+                index = self.__emit_loop(index, first, end, follow, indentation, frame)
+                continue
+            self.__indentation = indentation
+            for instruction in block.body:
+                self.__current = instruction
+                self.__emit_instruction(instruction, indentation)
+            if block.end is not None:
+                self.__current = block.end
+            if block.end is None:
+                index += 1
+                if not (index < end and self.__blocks[index].entries == [index - 1] and index not in self.__loop_lasts):
+                    self.__flush(indentation)
+            elif block.end.opcode in ("JPIF", "RNXT", "PNXT"):
+                value: str = self.__operand(block.end)
+                carry: List[str] = []
+                if block.end.opcode == "JPIF":
+                    condition: str = f"is_false({value})"
+                elif block.end.opcode == "RNXT":
+                    carry = [self.__temporary()]
+                    self.__line(indentation, f"{carry[0]} = next_range_value({value})")
+                    condition = f"{carry[0]} is None"
                 else:
-                    add_minus_code = True
-            elif token.type == LexType.TABLE:
-                if terminator_type != LexType.UNKNOWN:
-                    expression_error(f"Unexpected token '{token.value}'.", token.line, token.file)
-                compiled_code += f'\nTABL' 
-                terminator_type = token.type
-            elif token.type == LexType.VARIABLE:
-                if terminator_type != LexType.UNKNOWN:
-                    expression_error(f"Unexpected token '{token.value}'.", token.line, token.file)
-                var_id: Optional[str] = global_compiler_state.get_var_identifier(token, True, unsafe=unsafe)
-                compiled_code += f'\nVGET "{var_id}"' 
-                terminator_type = token.type
-            elif token.type == LexType.STRING:
-                if terminator_type != LexType.UNKNOWN:
-                    expression_error(f"Unexpected token '{token.value}'.", token.line, token.file)
-                compiled_code += f'\nPUSH "{token.get_nambly_string()}"' 
-                terminator_type = token.type
-            elif token.type == LexType.ACCESS_OPEN:
-                if terminator_type == LexType.UNKNOWN:
-                    expression_error(
-                        "Found a table access without a variable or a function.",
-                        token.line,
-                        token.file
-                    )
-                elif terminator_type not in [LexType.VARIABLE, LexType.WORD, LexType.STRING, LexType.FLOAT, LexType.INTEGER, LexType.TABLE]:
-                    expression_error(
-                        "Attempting to access something that cannot be a table.",
-                        token.line,
-                        token.file
-                    )
-                access_tokens = []
-                access_depth += 1
-            elif token.type in [LexType.INTEGER, LexType.FLOAT]:
-                if terminator_type != LexType.UNKNOWN:
-                    expression_error(f"Unexpected token '{token.value}'.", token.line, token.file)
-                compiled_code += f"\nPUSH {token.value}" 
-                terminator_type = token.type
-            elif token.type == LexType.WORD:
-                if terminator_type != LexType.UNKNOWN:
-                    expression_error(f"Unexpected token '{token.value}'.", token.line, token.file)
-                terminator_type = token.type
-                function_call_token = token
-                if next_token is None or next_token.type != LexType.PAR_OPEN:
-                    expression_error(
-                        "Expecting argument list after function call.",
-                        token.line,
-                        token.file
-                    )
-            elif token.type == LexType.PAR_OPEN:
-                if terminator_type not in [LexType.VARIABLE, LexType.WORD]:
-                    expression_error(
-                        "Calling non-functional value.",
-                        token.line,
-                        token.file
-                    )
-                arguments_list: List[List[Token]] = []
-                arguments: List[Token] = []
-                open_pars: int = 1
-                prev_token: Optional[Token] = None
-                while expr_tokens:
-                    token: Token = expr_tokens[0]
-                    if token.type == LexType.PAR_OPEN:
-                        open_pars += 1
-                        if open_pars > 1:
-                            arguments.append(token)
-                    elif token.type == LexType.PAR_CLOSE:
-                        if open_pars > 1:
-                            arguments.append(token)
-                        open_pars -= 1
-                        if open_pars == 0:
-                            if not arguments and (prev_token is not None and prev_token.type == LexType.DECORATION and prev_token.value == ","):
-                                #expression_error(
-                                #    f"Empty argument for function call",
-                                #    token.line,
-                                #    token.file
-                                #)
-                                pass
-                            else:
-                                if arguments:
-                                    arguments_list.append(arguments)
-                                arguments = []
-                                expr_tokens.pop(0)
-                                break
-                    elif open_pars > 1:
-                        arguments.append(token)
-                    elif token.type == LexType.DECORATION:
-                        if token.value != ",":
-                            expression_error(
-                                f"Unexpected string '{token.value}'",
-                                token.line,
-                                token.file
-                            )
-                        elif not arguments:
-                            expression_error(
-                                f"Empty argument for function call",
-                                token.line,
-                                token.file
-                            )
-                        else:
-                            if arguments:
-                                arguments_list.append(arguments)
-                            arguments = []
-                    else:
-                        arguments.append(token)
-                    prev_token = token
-                    expr_tokens.pop(0)
-                if expr_tokens:
-                    if expr_tokens[0].type not in (LexType.ACCESS_OPEN, LexType.PAR_OPEN):
-                        expression_error(
-                            f"Unexpected expression element: {expr_tokens[0].value} (did you forget a ';'?)",
-                            token.line,
-                            token.file
-                        )
-                # Call the function
-                if terminator_type == LexType.WORD:
-                    compiled_code += "\n" + compile_function_call(function_call_token, arguments_list)
-                # TODO $a(2, 3, 4)
+                    pair: str = self.__temporary()
+                    self.__line(indentation, f"{pair} = next_iterator_pair({value})")
+                    carry = [f"{pair}[0]", f"{pair}[1]"]
+                    condition = f"{pair} is None"
+                self.__flush(indentation)
+                index = self.__emit_conditional((index, index), condition, block.target, block.landing, index + 1, carry, first, end, follow, indentation, frame)
             else:
-                expression_error(
-                    f"Unexpected operator: '{token.value}'",
-                    token.line,
-                    token.file
-                )
-    if add_minus_code:
-        compiled_code += "\nPUSH -1"
-        compiled_code += "\nMULT"
-    return compiled_code
+                self.__flush(indentation)
+                next_index: int = self.__emit_transfer(index, first, end, follow, indentation, frame)
+                # Nothing falls into the blocks skipped, so they can't be emitted here
+                if any(self.__blocks[skipped].live for skipped in range(index + 1, min(next_index, end))):
+                    raise UnstructuredCode()
+                index = next_index
+
+    def __emit_transfer(self, index: int, first: int, end: int, follow: int, indentation: int, frame: Optional[str]) -> int:
+        """Emits the unconditional jump, tail call or return that ends a block, and returns
+        the block the window goes on from.
+        """
+        block: PythonBlock = self.__blocks[index]
+        if block.end.opcode == "RTRN":
+            self.__line(indentation, "return" if frame is not None else 'nambly_error("Empty return stack.")')
+            return index + 1
+        if block.target < 0:
+            # Tail call to another function, run by the trampoline of the caller
+            self.__line(indentation, f"return {self.__function_name(block.end.argument)}")
+            return index + 1
+        self.__push_landing(block.landing, indentation)
+        kind, result = self.__resolve(block.target, first, end, follow)
+        if kind == "statement":
+            for code in result:
+                self.__line(indentation, code)
+            return index + 1
+        if kind == "end":
+            return end
+        if result < index:
+            raise UnstructuredCode()
+        return result
+
+    def __emit_branch(self, first: int, end: int, follow: int, indentation: int, frame: Optional[str]) -> None:
+        """Emits the blocks of one branch of an if or else, and a pass if they leave it empty.
+        """
+        self.__emit_window(first, end, follow, indentation, -1, frame)
+        if self.__lines[-1][0] < indentation:
+            self.__line(indentation, "pass")
+
+    def __emit_conditional(self, sources: Tuple[int, int], condition: str, target: int, landing: List[Instruction], fall: int, carry: List[str],
+                           first: int, end: int, follow: int, indentation: int, frame: Optional[str]) -> int:
+        """Emits a jump to the target block taken if the condition holds, coming from the
+        given range of blocks, and returns the block to go on from. Otherwise the code goes
+        on from the fall block, with the carried values pushed.
+        """
+        kind, result = self.__resolve(target, first, end, follow)
+        if kind == "statement":
+            self.__line(indentation, f"if {condition}:")
+            self.__push_landing(landing, indentation + 1)
+            for code in result:
+                self.__line(indentation + 1, code)
+            self.__pending = carry
+            if not (fall < end and self.__blocks[fall].entries == [sources[1]] and fall not in self.__loop_lasts):
+                self.__flush(indentation)
+            return fall
+        branch: int = end if kind == "end" else result
+        if branch < fall or not self.__is_closed(fall, branch, sources):
+            raise UnstructuredCode()
+        if branch == fall:
+            self.__line(indentation, f"if {condition}:")
+            self.__push_landing(landing, indentation + 1)
+            if not landing:
+                self.__line(indentation + 1, "pass")
+            if carry:
+                self.__line(indentation, "else:")
+                self.__pending = carry
+                self.__flush(indentation + 1)
+            return fall
+        else_end: int = -1
+        else_follow: int = -1
+        last_then: int = max([index for index in range(fall, branch) if self.__blocks[index].live], default=-1)
+        if last_then >= 0 and self.__blocks[last_then].end is not None and self.__blocks[last_then].end.opcode == "JUMP" and self.__blocks[last_then].target > branch:
+            jump_target: int = self.__blocks[last_then].target
+            try:
+                jump_kind, _ = self.__resolve(jump_target, first, end, follow)
+            except UnstructuredCode:
+                jump_kind = ""
+            if jump_kind in ("local", "end"):
+                else_end, else_follow = (jump_target, jump_target) if jump_target <= end else (end, follow)
+                if not self.__is_closed(branch, else_end, sources):
+                    else_end = -1
+        if else_end >= 0:
+            self.__line(indentation, f"if {condition}:")
+            self.__push_landing(landing, indentation + 1)
+            self.__emit_branch(branch, else_end, else_follow, indentation + 1, frame)
+            self.__line(indentation, "else:")
+            self.__pending = carry
+            self.__emit_branch(fall, branch, else_follow, indentation + 1, frame)
+            return else_end
+        if landing or carry:
+            self.__line(indentation, f"if {condition}:")
+            self.__push_landing(landing, indentation + 1)
+            if not landing:
+                self.__line(indentation + 1, "pass")
+            self.__line(indentation, "else:")
+        else:
+            self.__line(indentation, f"if not {condition}:")
+        self.__pending = carry
+        self.__emit_branch(fall, branch, branch, indentation + 1, frame)
+        return branch
+
+    def __emit_loop(self, head: int, first: int, end: int, follow: int, indentation: int, frame: Optional[str]) -> int:
+        """Emits the loop that starts at a block as a while loop, and returns the block
+        to go on from.
+        """
+        last: int = self.__loop_lasts[head]
+        if last >= end or len(self.__loops) >= PYTHON_LOOP_NESTING_LIMIT:
+            raise UnstructuredCode()
+        self.__flush(indentation)
+        loop = PythonLoop(head, last, f"exit_{self.__loop_count}")
+        self.__loop_count += 1
+        while_line: int = len(self.__lines)
+        self.__line(indentation, "while True:")
+        self.__loops.append(loop)
+        self.__emit_window(head, last + 1, -1, indentation + 1, head, frame)
+        self.__flush(indentation + 1)
+        self.__line(indentation + 1, "break")
+        self.__loops.pop()
+        if not loop.exits:
+            return last + 1
+        self.__lines.insert(while_line, (indentation, f"{loop.exit_variable} = 0", self.__lines[while_line][2]))
+        local_exits: List[Tuple[int, int]] = []
+        for target, number in loop.exits.items():
+            kind, result = self.__resolve(target, first, end, follow)
+            if kind == "statement":
+                self.__line(indentation, f"if {loop.exit_variable} == {number}:")
+                for code in result:
+                    self.__line(indentation + 1, code)
+            else:
+                local_exits.append((target, number))
+        if not local_exits:
+            return last + 1
+        if len(local_exits) > 1:
+            raise UnstructuredCode()
+        target, number = local_exits[0]
+        return self.__emit_conditional((head, last), f"{loop.exit_variable} == {number}", target, [], last + 1, [], first, end, follow, indentation, frame)
+
+    def __emit_state_machine(self, frame: Optional[str]) -> None:
+        """Emits a function as a loop that runs one block each time, picking it by number.
+        """
+        self.__line(1, "block = 0")
+        self.__line(1, "while True:")
+        self.__emit_block_choice([index for index, block in enumerate(self.__blocks) if block.live], 2, frame)
+
+    def __emit_block_choice(self, indices: List[int], indentation: int, frame: Optional[str]) -> None:
+        if len(indices) > 1:
+            middle: int = len(indices) // 2
+            self.__line(indentation, f"if block < {indices[middle]}:")
+            self.__emit_block_choice(indices[:middle], indentation + 1, frame)
+            self.__line(indentation, "else:")
+            self.__emit_block_choice(indices[middle:], indentation + 1, frame)
+            return
+        index: int = indices[0]
+        block: PythonBlock = self.__blocks[index]
+        self.__indentation = indentation
+        for instruction in block.body:
+            self.__current = instruction
+            self.__emit_instruction(instruction, indentation)
+        if block.end is not None:
+            self.__current = block.end
+        if block.end is not None and block.end.opcode in ("JPIF", "RNXT", "PNXT"):
+            value: str = self.__operand(block.end)
+            self.__flush(indentation)
+            if block.end.opcode == "JPIF":
+                self.__line(indentation, f"if is_false({value}):")
+            else:
+                iterator: str = value
+                value = self.__temporary()
+                next_function: str = "next_range_value" if block.end.opcode == "RNXT" else "next_iterator_pair"
+                self.__line(indentation, f"{value} = {next_function}({iterator})")
+                self.__line(indentation, f"if {value} is None:")
+            self.__push_landing(block.landing, indentation + 1)
+            self.__line(indentation + 1, f"block = {block.target}")
+            self.__line(indentation + 1, "continue")
+            if block.end.opcode == "RNXT":
+                self.__line(indentation, f"stack_push({value})")
+            elif block.end.opcode == "PNXT":
+                self.__line(indentation, f"stack_push({value}[0])")
+                self.__line(indentation, f"stack_push({value}[1])")
+        elif block.end is not None:
+            self.__flush(indentation)
+            if block.end.opcode == "RTRN" or block.target < 0:
+                self.__emit_transfer(index, 0, 0, -1, indentation, frame)
+                return
+            self.__push_landing(block.landing, indentation)
+            self.__line(indentation, f"block = {block.target}")
+            self.__line(indentation, "continue")
+            return
+        self.__flush(indentation)
+        if index + 1 >= len(self.__blocks):
+            self.__line(indentation, "return")
+        else:
+            self.__line(indentation, f"block = {index + 1}")
+
+    def __emit_call(self, label: str, indentation: int) -> None:
+        function_name: str = self.__function_name(label)
+        if self.__trampolines:
+            self.__line(indentation, f"tail = {function_name}()")
+            self.__line(indentation, "while tail is not None:")
+            self.__line(indentation + 1, "tail = tail()")
+        else:
+            self.__line(indentation, f"{function_name}()")
+
+    def __emit_instruction(self, instruction: Instruction, indentation: int) -> None:
+        """Emits an instruction that doesn't jump, keeping the values it pushes in local
+        variables where it can.
+        """
+        opcode: str = instruction.opcode
+        pending: List[str] = self.__pending
+        self.__indentation = indentation
+        if opcode == "PUSH":
+            pending.append(self.__constant(instruction.argument))
+        elif opcode == "POPV":
+            if pending:
+                pending.pop()
+            else:
+                self.__line(indentation, "if execution_stack:")
+                self.__line(indentation + 1, "execution_stack.pop()")
+        elif opcode == "DUPL" and pending:
+            pending.append(pending[-1])
+        elif opcode == "SWAP" and len(pending) >= 2:
+            pending[-1], pending[-2] = pending[-2], pending[-1]
+        elif opcode in PYTHON_VALUE_OPERATIONS:
+            operands: List[str] = [self.__operand(instruction) for _ in range(PYTHON_VALUE_OPERATIONS[opcode])]
+            temporary: str = self.__temporary()
+            self.__line(indentation, f"{temporary} = apply_{'isnil' if opcode == 'NIL?' else opcode.lower()}({', '.join(reversed(operands))})")
+            pending.append(temporary)
+        elif opcode in ("PNIL", "LGET", "GGET", "VGET"):
+            temporary = self.__temporary()
+            if opcode == "PNIL":
+                value: str = "get_nil_value()"
+            elif opcode == "LGET":
+                slot, global_slot = instruction.argument.split()
+                value = f"{self.__frame}[{slot}] or global_slots[{global_slot}] or get_nil_value()"
+            elif opcode == "GGET":
+                value = f"global_slots[{instruction.argument}] or get_nil_value()"
+            else:
+                value = f"get_variable({get_bytecode_constant(instruction.argument)[1]!r}) or get_nil_value()"
+            self.__line(indentation, f"{temporary} = {value}")
+            pending.append(temporary)
+        elif opcode == "LPUT":
+            self.__line(indentation, f"{self.__frame}[{instruction.argument}] = {self.__operand(instruction)}")
+        elif opcode == "GPUT":
+            self.__line(indentation, f"global_slots[{instruction.argument}] = {self.__operand(instruction)}")
+        elif opcode == "VSET":
+            self.__line(indentation, f"variable_tables[-1][{get_bytecode_constant(instruction.argument)[1]!r}] = {self.__operand(instruction)}")
+        elif opcode == "DISP":
+            self.__line(indentation, f"display({self.__operand(instruction)})")
+        elif opcode == "ADFR" and self.__frame == "frame":
+            self.__line(indentation, f"frame = [None] * {instruction.argument}")
+            self.__line(indentation, "slot_frames.append(frame)")
+        elif opcode == "CALL":
+            self.__flush(indentation)
+            self.__emit_call(instruction.argument, indentation)
+        else:
+            self.__flush(indentation)
+            self.__line(indentation, f"{self.__handler(opcode)}({self.__command(instruction)}, 0)")
 
 
-def stylize_namby(code: str) -> str:
-    """Stilizes the nambly code by removing unnecessary breaks.
+def instructions_to_python(instructions: List[Instruction]) -> str:
+    """Transpiles a list of instructions into the source of a Python module for the
+    Python NariVM. See PythonTranspiler.
     """
-    new_lines = ""
-    for line in code.split("\n"):
-        if line:
-            new_lines += line + "\n"
-    return new_lines
+    return PythonTranspiler(instructions).transpile()
 
 
-def compile_lines(tokenized_lines: List[List[Token]]) -> str:
+def compile_lines(tokenized_lines: List[List[Token]]) -> List[Instruction]:
     """Takes a list of list of lexed tokens and compiles them into Nambly code.
     """
-    compiled_code: str = ""
+    compiled_code: List[Instruction] = []
     for line in tokenized_lines:
         # Check first token in the line, this is our command
         command = line[0]
+        line_start: int = len(compiled_code)
         compiled_code += get_debug_info(command)
         args = []
         if len(line) > 1:
@@ -983,50 +2648,54 @@ def compile_lines(tokenized_lines: List[List[Token]]) -> str:
         if command.type == LexType.WORD:
             # --- in command ---
             if command.value == "in":
-                compiled_code += "\n" + parse_command_in(command, args, False)
+                compiled_code += parse_command_in(command, args, False)
             elif command.value == "global":
-                compiled_code += "\n" + parse_command_in(command, args, True)
+                compiled_code += parse_command_in(command, args, True)
             elif command.value == "while":
-                compiled_code += "\n" + parse_command_while(command, args)
+                compiled_code += parse_command_while(command, args)
             elif command.value == "whileis":
-                compiled_code += "\n" + parse_command_whileis(command, args)
+                compiled_code += parse_command_whileis(command, args)
             elif command.value == "for":
-                compiled_code += "\n" + parse_command_for(command, args)
+                compiled_code += parse_command_for(command, args)
             elif command.value == "until":
-                compiled_code += "\n" + parse_command_until(command, args)
+                compiled_code += parse_command_until(command, args)
             elif command.value == "if":
-                compiled_code += "\n" + parse_command_if(command, args)
+                compiled_code += parse_command_if(command, args)
             elif command.value == "elif":
-                compiled_code += "\n" + parse_command_elif(command, args)
+                compiled_code += parse_command_elif(command, args)
             elif command.value == "else":
-                compiled_code += "\n" + parse_command_else(command, args)
+                compiled_code += parse_command_else(command, args)
             elif command.value == "unless":
-                compiled_code += "\n" + parse_command_unless(command, args)
+                compiled_code += parse_command_unless(command, args)
             elif command.value == "ok":
-                compiled_code += "\n" + parse_command_ok(command, args)
+                compiled_code += parse_command_ok(command, args)
             elif command.value == "continue":
-                compiled_code += "\n" + parse_command_continue(command, args)
+                compiled_code += parse_command_continue(command, args)
             elif command.value == "break":
-                compiled_code += "\n" + parse_command_break(command, args)
+                compiled_code += parse_command_break(command, args)
             elif command.value == "def":
-                compiled_code += "\n" + parse_command_def(command, args)
+                compiled_code += parse_command_def(command, args)
             elif command.value == "return":
-                compiled_code += "\n" + parse_command_return(command, args)
+                compiled_code += parse_command_return(command, args)
             elif command.value == "sleep":
-                compiled_code += "\n" + parse_command_sleep(command, args)
+                compiled_code += parse_command_sleep(command, args)
             elif command.value == "import":
-                compiled_code += "\n" + parse_command_import(command, args)
+                compiled_code += parse_command_import(command, args)
             else:
                 # Commands that are "function-like" such as print
-                compiled_code += "\n" + compile_expression(line, True)
+                compiled_code += compile_expression(line, True)
         elif command.type == LexType.VARIABLE:
-            compiled_code += "\n" + parse_command_in(command, [command] + args, False)
+            compiled_code += parse_command_in(command, [command] + args, False)
         else:
             parse_error(f"Unexpected command '{command.value}'.", command.line, command.file)
+        # Instructions that come from imported files already have a location
+        for instruction in compiled_code[line_start:]:
+            if not instruction.line:
+                instruction.set_location(command.line, command.file)
     return compiled_code
 
 
-def compile_function_call(command: Token, args_list: List[List[Token]]):
+def compile_function_call(command: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
     if command.value == "print":
         return parse_command_print(command, args_list)
     elif command.value == "printc":
@@ -1082,10 +2751,10 @@ def compile_function_call(command: Token, args_list: List[List[Token]]):
     
 
 
-def parse_command_in(command_token: Token, args: List[Token], global_var: bool) -> str:
-    access_compiled_code: str = ""
-    set_compiled_code: str = ""
-    value_compiled_code: str = ""
+def parse_command_in(command_token: Token, args: List[Token], global_var: bool) -> List[Instruction]:
+    access_compiled_code: List[Instruction] = []
+    set_compiled_code: List[Instruction] = []
+    value_compiled_code: List[Instruction] = []
     left_side: List[Token] = []
     right_side: List[Token] = []
     found_colon: bool = False
@@ -1101,7 +2770,7 @@ def parse_command_in(command_token: Token, args: List[Token], global_var: bool)
     if not right_side:
         parse_error("Empty right side for 'in' statement (are you using '=' instead of ':'?)", command_token.line, command_token.file)
     else:
-        value_compiled_code += "\n" + compile_expression(right_side)
+        value_compiled_code += compile_expression(right_side)
 
     # Compile lefthand side
     if not left_side:
@@ -1129,12 +2798,12 @@ def parse_command_in(command_token: Token, args: List[Token], global_var: bool)
                 else:
                     var_id = global_compiler_state.declare_variable(var, global_var)
                     if global_var:
-                        set_compiled_code += f'\nGSET "{var_id}"'
+                        set_compiled_code.append(Instruction("GSET", f'"{var_id}"'))
                     else:
-                        set_compiled_code += f'\nVSET "{var_id}"'
+                        set_compiled_code.append(Instruction("VSET", f'"{var_id}"'))
             else:
                 var_id = global_compiler_state.declare_variable(var, global_var)
-                access_compiled_code += f'\nVGET "{var_id}"'
+                access_compiled_code.append(Instruction("VGET", f'"{var_id}"'))
                 access_tokens: List[Token] = []
                 access_depth: int = 0
                 access_count: int = 0
@@ -1153,8 +2822,8 @@ def parse_command_in(command_token: Token, args: List[Token], global_var: bool)
                             )
                         else:
                             if access_count > 0:
-                                access_compiled_code += f'\nPGET'
-                            access_compiled_code += "\n" + compile_expression(access_tokens[1:-1])
+                                access_compiled_code.append(Instruction("PGET"))
+                            access_compiled_code += compile_expression(access_tokens[1:-1])
                             access_count += 1
                             access_tokens = []
                 if access_depth > 0:
@@ -1169,259 +2838,265 @@ def parse_command_in(command_token: Token, args: List[Token], global_var: bool)
                         access_tokens[0].line,
                         access_tokens[0].file
                     )
-                set_compiled_code += '\nPSET'
+                set_compiled_code.append(Instruction("PSET"))
     return access_compiled_code + value_compiled_code + set_compiled_code
 
 
-def parse_command_print(command_token: Token, args_list: List[List[Token]]) -> str:
+def parse_command_print(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
     if not args_list:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1+).", command_token.line, command_token.file)
-    compiled_code: str = ""
-    compiled_code += '\nPUSH ""'
+    compiled_code: List[Instruction] = []
+    compiled_code.append(Instruction("PUSH", '""'))
     for args in args_list:
-        compiled_code += "\n" + compile_expression(args)
-        compiled_code += "\nDUPL"
-        compiled_code += "\nVSET \"$swap\""  # Only system vars start with $ in nambly
-        compiled_code += "\nDISP"
-        compiled_code += "\nVGET \"$swap\""  # Only system vars start with $ in nambly
-        compiled_code += "\nJOIN"
-    compiled_code += '\nPUSH "\\n"'
-    compiled_code += "\nDISP"
+        compiled_code += compile_expression(args)
+        compiled_code.append(Instruction("DUPL"))
+        compiled_code.append(Instruction("VSET", '"$swap"'))  # Only system vars start with $ in nambly
+        compiled_code.append(Instruction("DISP"))
+        compiled_code.append(Instruction("VGET", '"$swap"'))  # Only system vars start with $ in nambly
+        compiled_code.append(Instruction("JOIN"))
+    compiled_code.append(Instruction("PUSH", '"\\n"'))
+    compiled_code.append(Instruction("DISP"))
     return compiled_code
     
 
-def parse_command_accept(command_token: Token, args_list: List[List[Token]]) -> str:
+def parse_command_accept(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
     if len(args_list) > 1:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 0 or 1).", command_token.line, command_token.file)
-    compiled_code: str = ""
+    compiled_code: List[Instruction] = []
     if len(args_list) >= 1:  # Default Prompt
-        compiled_code += "\n" + compile_expression(args_list[0])
+        compiled_code += compile_expression(args_list[0])
     else:
-        compiled_code += '\nPUSH ""'
-    compiled_code += "\nACCP"
+        compiled_code.append(Instruction("PUSH", '""'))
+    compiled_code.append(Instruction("ACCP"))
     return compiled_code
 
 
-def parse_command_printc(command_token: Token, args_list: List[List[Token]]) -> str:
+def parse_command_printc(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
     if not args_list:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1+).", command_token.line, command_token.file)
-    compiled_code: str = ""
-    compiled_code += '\nPUSH ""'
+    compiled_code: List[Instruction] = []
+    compiled_code.append(Instruction("PUSH", '""'))
     for args in args_list:
-        compiled_code += "\n" + compile_expression(args)
-        compiled_code += "\nDUPL"
-        compiled_code += "\nVSET \"$swap\""  # Only system vars start with $ in nambly
-        compiled_code += "\nDISP"
-        compiled_code += "\nVGET \"$swap\""  # Only system vars start with $ in nambly
-        compiled_code += "\nJOIN"
+        compiled_code += compile_expression(args)
+        compiled_code.append(Instruction("DUPL"))
+        compiled_code.append(Instruction("VSET", '"$swap"'))  # Only system vars start with $ in nambly
+        compiled_code.append(Instruction("DISP"))
+        compiled_code.append(Instruction("VGET", '"$swap"'))  # Only system vars start with $ in nambly
+        compiled_code.append(Instruction("JOIN"))
     return compiled_code
     
 
-def parse_command_is(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_is(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 1:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += "\nNIL?"
-    compiled_code += "\nLNOT"
+    compiled_code += compile_expression(args_list[0])
+    compiled_code.append(Instruction("NIL?"))
+    compiled_code.append(Instruction("LNOT"))
     return compiled_code
 
 
-def parse_command_del(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_del(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 2:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 2: variable and index).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += "\n" + compile_expression(args_list[1])
-    compiled_code += "\nPUST"
+    compiled_code += compile_expression(args_list[0])
+    compiled_code += compile_expression(args_list[1])
+    compiled_code.append(Instruction("PUST"))
     # TODO: Does this return anything? What happens if I assign this to a variable?
     return compiled_code
 
 
-def parse_command_unset(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_unset(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) == 0:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1+).", command_token.line, command_token.file)
-    for arg in args_list:
+    for arg_node in args_list:
+        arg: List[Token] = arg_node.get_tokens()
         if len(arg) > 1:
             parse_error(f"Unexpected token {arg[1]}", arg[1].line, arg[1].file)
         if arg[0].type != LexType.VARIABLE:
             parse_error(f"Variable expected, got {arg[0]}.", arg[0].line, arg[0].file)
-        compiled_code += f"\n UNST {global_compiler_state.get_var_identifier(arg[0], True)}"
+        compiled_code.append(Instruction("UNST", f'"{global_compiler_state.get_var_identifier(arg[0], True)}"'))
         global_compiler_state.unset_variable(arg[0], False)
     # TODO: Does this return anything? What happens if I assign this to a variable?
     return compiled_code
 
 
-def parse_command_set(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_set(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 2:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 2).", command_token.line, command_token.file)
-    new_arguments: List[Token] = list(args_list[0])
+    new_arguments: List[Token] = args_list[0].get_tokens()
     separator: Token = Token(":", command_token.line, command_token.file)
     separator.set_type(LexType.DECORATION)
     new_arguments.append(separator)
-    new_arguments += args_list[1]
-    compiled_code += "\n" + parse_command_in(command_token, new_arguments, False)
-    compiled_code += "\n" + compile_expression(args_list[0])
+    new_arguments += args_list[1].get_tokens()
+    compiled_code += parse_command_in(command_token, new_arguments, False)
+    compiled_code += compile_expression(args_list[0])
     return compiled_code
 
 
-def parse_command_unsafe(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_unsafe(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 1:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1).", command_token.line, command_token.file)
-    for arg in args_list:
+    for arg_node in args_list:
+        arg: List[Token] = arg_node.get_tokens()
         if arg[0].type != LexType.VARIABLE:
             parse_error(f"Variable expected, got {arg[0]}.", arg[0].line, arg[0].file)
-    compiled_code += f"\n" + compile_expression(args_list[0], discard_return_value=False, unsafe=True)
+    compiled_code += compile_expression(args_list[0], discard_return_value=False, unsafe=True)
     return compiled_code
 
 
-def parse_command_exit(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_exit(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 1:
         parse_error("Wrong number of arguments for function exit (expected 1).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += "\nEXIT"
+    compiled_code += compile_expression(args_list[0])
+    compiled_code.append(Instruction("EXIT"))
     # TODO: Does this return anything? What happens if I assign this to a variable?
     return compiled_code
 
 
-def parse_command_open_rw(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_open_rw(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 1:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += f"\nDUPL"
-    compiled_code += f"\nFORW"
+    compiled_code += compile_expression(args_list[0])
+    compiled_code.append(Instruction("DUPL"))
+    compiled_code.append(Instruction("FORW"))
     return compiled_code
 
 
-def parse_command_write(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_write(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 2:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 2).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[1])
-    compiled_code += f"\nDUPL"
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += f"\nFWRT"
+    compiled_code += compile_expression(args_list[1])
+    compiled_code.append(Instruction("DUPL"))
+    compiled_code += compile_expression(args_list[0])
+    compiled_code.append(Instruction("FWRT"))
     return compiled_code
 
 
-def parse_command_open_ra(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_open_ra(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 1:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += f"\nDUPL"
-    compiled_code += f"\nFORA"
+    compiled_code += compile_expression(args_list[0])
+    compiled_code.append(Instruction("DUPL"))
+    compiled_code.append(Instruction("FORA"))
     return compiled_code
 
 
-def parse_command_open_r(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_open_r(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 1:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += f"\nDUPL"
-    compiled_code += f"\nFORE"
+    compiled_code += compile_expression(args_list[0])
+    compiled_code.append(Instruction("DUPL"))
+    compiled_code.append(Instruction("FORE"))
     return compiled_code
 
 
-def parse_command_is_open(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_is_open(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 1:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += f"\nISOP"
+    compiled_code += compile_expression(args_list[0])
+    compiled_code.append(Instruction("ISOP"))
     return compiled_code
 
 
-def parse_command_close(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_close(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 1:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += f"\nDUPL"
-    compiled_code += f"\nFCLS"
+    compiled_code += compile_expression(args_list[0])
+    compiled_code.append(Instruction("DUPL"))
+    compiled_code.append(Instruction("FCLS"))
     return compiled_code
 
 
-def parse_command_read(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_read(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 1:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += f"\nRFIL"
+    compiled_code += compile_expression(args_list[0])
+    compiled_code.append(Instruction("RFIL"))
     return compiled_code
 
 
-def parse_command_read_line(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_read_line(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 1:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += f"\nRLNE"
+    compiled_code += compile_expression(args_list[0])
+    compiled_code.append(Instruction("RLNE"))
     return compiled_code
 
 
-def parse_command_while(command_token: Token, args: List[Token]) -> str:
+def parse_command_while(command_token: Token, args: List[Token]) -> List[Instruction]:
     if not args:
         parse_error(f"Command '{command_token.value}' expects an expression to evaluate.", command_token.line, command_token.file)
     block_number: int = global_compiler_state.block_count
     global_compiler_state.block_count += 1
     start_tag: str = f"LOOP_{block_number}_START"
     end_tag: str = f"LOOP_{block_number}_END"
-    compiled_code: str = ""
-    block_end_code: str = ""
-    compiled_code += f"\n@{start_tag}"
-    compiled_code += "\n" + compile_expression(args)
-    compiled_code += "\nDUPL"
+    compiled_code: List[Instruction] = []
+    block_end_code: List[Instruction] = []
+    compiled_code.append(Instruction("@", start_tag))
+    compiled_code += compile_expression(args)
+    compiled_code.append(Instruction("DUPL"))
     it_var: Token = Token(RESULT_VAR, command_token.line, command_token.file)
     it_var.type = LexType.VARIABLE
     it_var_id: str = global_compiler_state.declare_variable(it_var, True)
-    compiled_code += f'\nVSET "{it_var_id}"'
-    compiled_code += f"\nJPIF {end_tag}"
+    compiled_code.append(Instruction("VSET", f'"{it_var_id}"'))
+    compiled_code.append(Instruction("JPIF", end_tag))
     # Push end code to state for it to be used on next ok;
-    block_end_code += f"\nJUMP {start_tag}"
-    block_end_code += f"\n@{end_tag}"
+    block_end_code.append(Instruction("JUMP", start_tag))
+    block_end_code.append(Instruction("@", end_tag))
     global_compiler_state.add_open_loop(start_tag, end_tag)
     global_compiler_state.add_block_end_code(block_end_code, command_token)
     return compiled_code
 
 
-def parse_command_whileis(command_token: Token, args: List[Token]) -> str:
+def parse_command_whileis(command_token: Token, args: List[Token]) -> List[Instruction]:
     if not args:
         parse_error(f"Command '{command_token.value}' expects an expression to evaluate.", command_token.line, command_token.file)
     block_number: int = global_compiler_state.block_count
     global_compiler_state.block_count += 1
     start_tag: str = f"LOOP_{block_number}_START"
     end_tag: str = f"LOOP_{block_number}_END"
-    compiled_code: str = ""
-    block_end_code: str = ""
-    compiled_code += f"\n@{start_tag}"
-    compiled_code += "\n" + compile_expression(args)
-    compiled_code += "\nDUPL"
-    compiled_code += "\nNIL?"
-    compiled_code += "\nLNOT"
-    compiled_code += "\nSWAP"
+    compiled_code: List[Instruction] = []
+    block_end_code: List[Instruction] = []
+    compiled_code.append(Instruction("@", start_tag))
+    compiled_code += compile_expression(args)
+    compiled_code.append(Instruction("DUPL"))
+    compiled_code.append(Instruction("NIL?"))
+    compiled_code.append(Instruction("LNOT"))
+    compiled_code.append(Instruction("SWAP"))
     it_var: Token = Token(RESULT_VAR, command_token.line, command_token.file)
     it_var.type = LexType.VARIABLE
     it_var_id: str = global_compiler_state.declare_variable(it_var, True)
-    compiled_code += f'\nVSET "{it_var_id}"'
-    compiled_code += f"\nJPIF {end_tag}"
+    compiled_code.append(Instruction("VSET", f'"{it_var_id}"'))
+    compiled_code.append(Instruction("JPIF", end_tag))
     # Push end code to state for it to be used on next ok;
-    block_end_code += f"\nJUMP {start_tag}"
-    block_end_code += f"\n@{end_tag}"
+    block_end_code.append(Instruction("JUMP", start_tag))
+    block_end_code.append(Instruction("@", end_tag))
     global_compiler_state.add_open_loop(start_tag, end_tag)
     global_compiler_state.add_block_end_code(block_end_code, command_token)
     return compiled_code
 
 
-def parse_command_for(command_token: Token, args: List[Token]) -> str:
+def parse_command_for(command_token: Token, args: List[Token]) -> List[Instruction]:
     if not args:
         parse_error(f"Command '{command_token.value}' expects an expression to evaluate.", command_token.line, command_token.file)
+    if len(args) > 1 and args[1].type == LexType.DECORATION and args[1].value == ":":
+        return parse_command_for_range(command_token, args)
+    if len(args) > 1 and args[1].type == LexType.WORD and args[1].value == "in":
+        return parse_command_for_each(command_token, args)
     block_number: int = global_compiler_state.block_count
     global_compiler_state.block_count += 1
     start_tag: str = f"LOOP_{block_number}_START"
@@ -1430,55 +3105,135 @@ def parse_command_for(command_token: Token, args: List[Token]) -> str:
     it_var: Token = Token(iterator_var_name, command_token.line, command_token.file)
     it_var.type = LexType.VARIABLE
     it_var_id: str = global_compiler_state.declare_variable(it_var, True)
-    compiled_code: str = ""
-    block_end_code: str = ""
-    compiled_code += "\n" + compile_expression(args)
-    compiled_code += "\nGITR"
-    compiled_code += f"\nVSET \"{it_var_id}\""
-    compiled_code += f"\n@{start_tag}"
-    compiled_code += f"\nNEXT \"{it_var_id}\""
-    compiled_code += "\nDUPL"
+    compiled_code: List[Instruction] = []
+    block_end_code: List[Instruction] = []
+    compiled_code += compile_expression(args)
+    compiled_code.append(Instruction("GITR"))
+    compiled_code.append(Instruction("VSET", f'"{it_var_id}"'))
+    compiled_code.append(Instruction("@", start_tag))
+    compiled_code.append(Instruction("NEXT", f'"{it_var_id}"'))
+    compiled_code.append(Instruction("DUPL"))
     res_var: Token = Token(RESULT_VAR, command_token.line, command_token.file)
     res_var.type = LexType.VARIABLE
     res_var_id: str = global_compiler_state.declare_variable(res_var, True)
-    compiled_code += f'\nVSET "{res_var_id}"'
-    compiled_code += f"\nJPIF {end_tag}"
+    compiled_code.append(Instruction("VSET", f'"{res_var_id}"'))
+    compiled_code.append(Instruction("JPIF", end_tag))
+    # Push end code to state for it to be used on next ok;
+    block_end_code.append(Instruction("JUMP", start_tag))
+    block_end_code.append(Instruction("@", end_tag))
+    block_end_code.append(Instruction("UNST", f'"{it_var_id}"'))
+    global_compiler_state.add_open_loop(start_tag, end_tag)
+    global_compiler_state.add_block_end_code(block_end_code, command_token)
+    return compiled_code
+
+
+def parse_command_for_range(command_token: Token, args: List[Token]) -> List[Instruction]:
+    # for $i: first .. last; counts from first to last (both included) without building a table
+    if args[0].type != LexType.VARIABLE:
+        parse_error(f"Variable expected ('{args[0].value}' found).", args[0].line, args[0].file)
+    first_value: List[Token] = []
+    last_value: List[Token] = []
+    depth: int = 0
+    for token in args[2:]:
+        if token.type in (LexType.PAR_OPEN, LexType.ACCESS_OPEN):
+            depth += 1
+        elif token.type in (LexType.PAR_CLOSE, LexType.ACCESS_CLOSE):
+            depth -= 1
+        if token.type == LexType.DECORATION and token.value == ".." and depth == 0 and not last_value:
+            last_value.append(token)
+        elif last_value:
+            last_value.append(token)
+        else:
+            first_value.append(token)
+    if not first_value or len(last_value) < 2:
+        parse_error(f"Range loops expect a first and a last value separated by '..'.", command_token.line, command_token.file)
+    block_number: int = global_compiler_state.block_count
+    global_compiler_state.block_count += 1
+    start_tag: str = f"LOOP_{block_number}_START"
+    end_tag: str = f"LOOP_{block_number}_END"
+    it_var: Token = Token(f"$_itr{block_number}", command_token.line, command_token.file)
+    it_var.type = LexType.VARIABLE
+    it_var_id: str = global_compiler_state.declare_variable(it_var, True)
+    compiled_code: List[Instruction] = []
+    block_end_code: List[Instruction] = []
+    compiled_code += compile_expression(first_value)
+    compiled_code += compile_expression(last_value[1:])
+    compiled_code.append(Instruction("RITR"))
+    compiled_code.append(Instruction("VSET", f'"{it_var_id}"'))
+    compiled_code.append(Instruction("@", start_tag))
+    compiled_code.append(Instruction("VGET", f'"{it_var_id}"'))
+    compiled_code.append(Instruction("RNXT", end_tag))
+    compiled_code.append(Instruction("VSET", f'"{global_compiler_state.declare_variable(args[0], False)}"'))
+    # Push end code to state for it to be used on next ok;
+    block_end_code.append(Instruction("JUMP", start_tag))
+    block_end_code.append(Instruction("@", end_tag))
+    block_end_code.append(Instruction("UNST", f'"{it_var_id}"'))
+    global_compiler_state.add_open_loop(start_tag, end_tag)
+    global_compiler_state.add_block_end_code(block_end_code, command_token)
+    return compiled_code
+
+
+def parse_command_for_each(command_token: Token, args: List[Token]) -> List[Instruction]:
+    # for $v in expression; goes through the values of a table or the characters of a text, with their keys in $_r
+    if args[0].type != LexType.VARIABLE:
+        parse_error(f"Variable expected ('{args[0].value}' found).", args[0].line, args[0].file)
+    if len(args) < 3:
+        parse_error(f"Command '{command_token.value}' expects an expression to evaluate after 'in'.", command_token.line, command_token.file)
+    block_number: int = global_compiler_state.block_count
+    global_compiler_state.block_count += 1
+    start_tag: str = f"LOOP_{block_number}_START"
+    end_tag: str = f"LOOP_{block_number}_END"
+    it_var: Token = Token(f"$_itr{block_number}", command_token.line, command_token.file)
+    it_var.type = LexType.VARIABLE
+    it_var_id: str = global_compiler_state.declare_variable(it_var, True)
+    res_var: Token = Token(RESULT_VAR, command_token.line, command_token.file)
+    res_var.type = LexType.VARIABLE
+    compiled_code: List[Instruction] = []
+    block_end_code: List[Instruction] = []
+    compiled_code += compile_expression(args[2:])
+    compiled_code.append(Instruction("GITR"))
+    compiled_code.append(Instruction("VSET", f'"{it_var_id}"'))
+    compiled_code.append(Instruction("@", start_tag))
+    compiled_code.append(Instruction("VGET", f'"{it_var_id}"'))
+    compiled_code.append(Instruction("PNXT", end_tag))
+    compiled_code.append(Instruction("VSET", f'"{global_compiler_state.declare_variable(args[0], False)}"'))
+    compiled_code.append(Instruction("VSET", f'"{global_compiler_state.declare_variable(res_var, True)}"'))
     # Push end code to state for it to be used on next ok;
-    block_end_code += f"\nJUMP {start_tag}"
-    block_end_code += f"\n@{end_tag}"
-    block_end_code += f"\nUNST \"{it_var_id}\""
+    block_end_code.append(Instruction("JUMP", start_tag))
+    block_end_code.append(Instruction("@", end_tag))
+    block_end_code.append(Instruction("UNST", f'"{it_var_id}"'))
     global_compiler_state.add_open_loop(start_tag, end_tag)
     global_compiler_state.add_block_end_code(block_end_code, command_token)
     return compiled_code
 
 
-def parse_command_until(command_token: Token, args: List[Token]) -> str:
+def parse_command_until(command_token: Token, args: List[Token]) -> List[Instruction]:
     if not args:
         parse_error(f"Command '{command_token.value}' expects an expression to evaluate.", command_token.line, command_token.file)
     block_number: int = global_compiler_state.block_count
     global_compiler_state.block_count += 1
     start_tag: str = f"LOOP_{block_number}_START"
     end_tag: str = f"LOOP_{block_number}_END"
-    compiled_code: str = ""
-    block_end_code: str = ""
-    compiled_code += f"\n@{start_tag}"
-    compiled_code += "\n" + compile_expression(args)
-    compiled_code += "\nDUPL"
+    compiled_code: List[Instruction] = []
+    block_end_code: List[Instruction] = []
+    compiled_code.append(Instruction("@", start_tag))
+    compiled_code += compile_expression(args)
+    compiled_code.append(Instruction("DUPL"))
     it_var: Token = Token(RESULT_VAR, command_token.line, command_token.file)
     it_var.type = LexType.VARIABLE
     it_var_id: str = global_compiler_state.declare_variable(it_var, True)
-    compiled_code += f'\nVSET "{it_var_id}"'
-    compiled_code += f"\nLNOT"
-    compiled_code += f"\nJPIF {end_tag}"
+    compiled_code.append(Instruction("VSET", f'"{it_var_id}"'))
+    compiled_code.append(Instruction("LNOT"))
+    compiled_code.append(Instruction("JPIF", end_tag))
     # Push end code to state for it to be used on next ok;
-    block_end_code += f"\nJUMP {start_tag}"
-    block_end_code += f"\n@{end_tag}"
+    block_end_code.append(Instruction("JUMP", start_tag))
+    block_end_code.append(Instruction("@", end_tag))
     global_compiler_state.add_open_loop(start_tag, end_tag)
     global_compiler_state.add_block_end_code(block_end_code, command_token)
     return compiled_code
 
 
-def parse_command_if(command_token: Token, args: List[Token]) -> str:
+def parse_command_if(command_token: Token, args: List[Token]) -> List[Instruction]:
     if not args:
         parse_error(f"Command '{command_token.value}' expects an expression to evaluate.", command_token.line, command_token.file)
     block_number: int = global_compiler_state.block_count
@@ -1486,24 +3241,24 @@ def parse_command_if(command_token: Token, args: List[Token]) -> str:
     # start_tag: str = f"COND_{block_number}_START"
     end_tag: str = f"COND_{block_number}_END"
     if_final_tag: str = f"EXIT_IF_{block_number}"
-    compiled_code: str = ""
-    block_end_code: str = ""
+    compiled_code: List[Instruction] = []
+    block_end_code: List[Instruction] = []
     # compiled_code += f"\n@{start_tag}"
-    compiled_code += "\n" + compile_expression(args)
-    compiled_code += "\nDUPL"
+    compiled_code += compile_expression(args)
+    compiled_code.append(Instruction("DUPL"))
     it_var: Token = Token(RESULT_VAR, command_token.line, command_token.file)
     it_var.type = LexType.VARIABLE
     it_var_id: str = global_compiler_state.declare_variable(it_var, True)
-    compiled_code += f'\nVSET "{it_var_id}"'
-    compiled_code += f"\nJPIF {end_tag}"
+    compiled_code.append(Instruction("VSET", f'"{it_var_id}"'))
+    compiled_code.append(Instruction("JPIF", end_tag))
     # Push end code to state for it to be used on next ok;
-    block_end_code += f"\nJUMP {if_final_tag}"
-    block_end_code += f"\n@{end_tag}"
+    block_end_code.append(Instruction("JUMP", if_final_tag))
+    block_end_code.append(Instruction("@", end_tag))
     global_compiler_state.add_block_end_code(block_end_code, command_token, block_number)
     return compiled_code
 
 
-def parse_command_elif(command_token: Token, args: List[Token]) -> str:
+def parse_command_elif(command_token: Token, args: List[Token]) -> List[Instruction]:
     if not args:
         parse_error(f"Command '{command_token.value}' expects an expression to evaluate.", command_token.line, command_token.file)
     if not global_compiler_state.get_in_if_chain():
@@ -1513,87 +3268,87 @@ def parse_command_elif(command_token: Token, args: List[Token]) -> str:
     group_id: int = global_compiler_state.get_group_id()
     end_tag: str = f"COND_{block_number}_END"
     if_final_tag: str = f"EXIT_IF_{group_id}"
-    compiled_code: str = ""
+    compiled_code: List[Instruction] = []
     compiled_code += global_compiler_state.get_block_end_data(command_token)[0]
-    block_end_code: str = ""
+    block_end_code: List[Instruction] = []
     # compiled_code += f"\n@{start_tag}"
-    compiled_code += "\n" + compile_expression(args)
-    compiled_code += "\nDUPL"
+    compiled_code += compile_expression(args)
+    compiled_code.append(Instruction("DUPL"))
     it_var: Token = Token(RESULT_VAR, command_token.line, command_token.file)
     it_var.type = LexType.VARIABLE
     it_var_id: str = global_compiler_state.declare_variable(it_var, True)
-    compiled_code += f'\nVSET "{it_var_id}"'
-    compiled_code += f"\nJPIF {end_tag}"
+    compiled_code.append(Instruction("VSET", f'"{it_var_id}"'))
+    compiled_code.append(Instruction("JPIF", end_tag))
     # Push end code to state for it to be used on next ok;
-    block_end_code += f"\nJUMP {if_final_tag}"
-    block_end_code += f"\n@{end_tag}"
+    block_end_code.append(Instruction("JUMP", if_final_tag))
+    block_end_code.append(Instruction("@", end_tag))
     global_compiler_state.add_block_end_code(block_end_code, command_token, group_id)
     return compiled_code
 
 
-def parse_command_else(command_token: Token, args: List[Token]) -> str:
+def parse_command_else(command_token: Token, args: List[Token]) -> List[Instruction]:
     if args:
         parse_error(f"Command '{command_token.value}' doesn't expect any arguments.", command_token.line, command_token.file)
     if not global_compiler_state.get_in_if_chain():
         parse_error(f"Command '{command_token.value}' can only be used after an if block.", command_token.line, command_token.file)
     group_id: int = global_compiler_state.get_group_id()
-    compiled_code: str = ""
+    compiled_code: List[Instruction] = []
     compiled_code += global_compiler_state.get_block_end_data(command_token)[0]
-    block_end_code: str = ""
+    block_end_code: List[Instruction] = []
     # Push end code to state for it to be used on next ok;
     global_compiler_state.add_block_end_code(block_end_code, command_token, group_id)
     return compiled_code
 
 
-def parse_command_unless(command_token: Token, args: List[Token]) -> str:
+def parse_command_unless(command_token: Token, args: List[Token]) -> List[Instruction]:
     block_number: int = global_compiler_state.block_count
     global_compiler_state.block_count += 1
     start_tag: str = f"COND_{block_number}_START"
     end_tag: str = f"COND_{block_number}_END"
-    compiled_code: str = ""
-    block_end_code: str = ""
-    compiled_code += f"\n@{start_tag}"
-    compiled_code += "\n" + compile_expression(args)
-    compiled_code += "\nDUPL"
+    compiled_code: List[Instruction] = []
+    block_end_code: List[Instruction] = []
+    compiled_code.append(Instruction("@", start_tag))
+    compiled_code += compile_expression(args)
+    compiled_code.append(Instruction("DUPL"))
     it_var: Token = Token(RESULT_VAR, command_token.line, command_token.file)
     it_var.type = LexType.VARIABLE
     it_var_id: str = global_compiler_state.declare_variable(it_var, True)
-    compiled_code += f'\nVSET "{it_var_id}"'
-    compiled_code += f"\nLNOT"
-    compiled_code += f"\nJPIF {end_tag}"
+    compiled_code.append(Instruction("VSET", f'"{it_var_id}"'))
+    compiled_code.append(Instruction("LNOT"))
+    compiled_code.append(Instruction("JPIF", end_tag))
     # Push end code to state for it to be used on next ok;
-    block_end_code += f"\n@{end_tag}"
+    block_end_code.append(Instruction("@", end_tag))
     global_compiler_state.add_block_end_code(block_end_code, command_token)
     return compiled_code
 
 
-def parse_command_ok(command_token: Token, args: List[Token]) -> str:
+def parse_command_ok(command_token: Token, args: List[Token]) -> List[Instruction]:
     if args:
         parse_error(f"Unexpected arguments for command '{command_token.value}'.", command_token.line, command_token.file)
-    compiled_code: str = ""
+    compiled_code: List[Instruction] = []
     global_compiler_state.close_open_loop()
     compiled_code += global_compiler_state.del_scope(command_token)
     block_end_data = global_compiler_state.get_block_end_data(command_token)
     compiled_code += block_end_data[0]
     if block_end_data[1].type == LexType.WORD and block_end_data[1].value in ("if", "elif", "else"):
-        compiled_code += f"\n@EXIT_IF_{block_end_data[2]}"
+        compiled_code.append(Instruction("@", f"EXIT_IF_{block_end_data[2]}"))
     return compiled_code
 
 
-def parse_command_continue(command_token: Token, args: List[Token]) -> str:
-    compiled_code: str = ""
+def parse_command_continue(command_token: Token, args: List[Token]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if args:
         parse_error(f"Unexpected arguments for command '{command_token.value}'.", command_token.line, command_token.file)
     if global_compiler_state.get_open_loop_tags() is None:
         parse_error(f"Continue can only be used inside loops.", command_token.line, command_token.file)
     else:
         start_tag: str = global_compiler_state.get_open_loop_tags()[0]
-        compiled_code += f"\nJUMP {start_tag}"
+        compiled_code.append(Instruction("JUMP", start_tag))
     return compiled_code
 
 
-def parse_command_break(command_token: Token, args: List[Token]) -> str:
-    compiled_code: str = ""
+def parse_command_break(command_token: Token, args: List[Token]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args) > 1:
         parse_error(f"Wrong number of arguments for command '{command_token.value}' (expected 0 or 1).", command_token.line, command_token.file)
     count: int = 1
@@ -1604,169 +3359,176 @@ def parse_command_break(command_token: Token, args: List[Token]) -> str:
     if global_compiler_state.get_open_loop_tags(depth=count - 1) is None:
         parse_error(f"Break can only be used inside loops.", command_token.line, command_token.file)
     end_tag: str = global_compiler_state.get_open_loop_tags(depth=count - 1)[1]
-    compiled_code += f"\nJUMP {end_tag}"
+    compiled_code.append(Instruction("JUMP", end_tag))
     return compiled_code
 
 
-def parse_command_len(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_len(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 1:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += f"\nSLEN"
+    compiled_code += compile_expression(args_list[0])
+    compiled_code.append(Instruction("SLEN"))
     return compiled_code
 
 
-def parse_command_substr(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_substr(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 2 and len(args_list) != 3:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 2 or 3).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[0])
+    compiled_code += compile_expression(args_list[0])
     if len(args_list) == 2:
-        compiled_code += f"\nDUPL"
-    compiled_code += "\n" + compile_expression(args_list[1])
+        compiled_code.append(Instruction("DUPL"))
+    compiled_code += compile_expression(args_list[1])
     if len(args_list) == 3:
-        compiled_code += "\n" + compile_expression(args_list[2])
+        compiled_code += compile_expression(args_list[2])
     elif len(args_list) == 2:
-        compiled_code += f"\nSWAP"
-        compiled_code += f"\nSLEN"
-    compiled_code += f"\nSSTR"
+        compiled_code.append(Instruction("SWAP"))
+        compiled_code.append(Instruction("SLEN"))
+    compiled_code.append(Instruction("SSTR"))
     return compiled_code
 
 
-def parse_command_replace(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_replace(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 3:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 3).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += "\n" + compile_expression(args_list[1])
-    compiled_code += "\n" + compile_expression(args_list[2])
-    compiled_code += f"\nREPL"
+    compiled_code += compile_expression(args_list[0])
+    compiled_code += compile_expression(args_list[1])
+    compiled_code += compile_expression(args_list[2])
+    compiled_code.append(Instruction("REPL"))
     return compiled_code
 
 
-def parse_command_split(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_split(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) < 2 or len(args_list) > 4:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 2, 3 or 4).", command_token.line, command_token.file)
     if len(args_list) == 4:
-        compiled_code += "\n" + compile_expression(args_list[3])  # If add empty elements or not
+        compiled_code += compile_expression(args_list[3])  # If add empty elements or not
     else:
-        compiled_code += "\nPUSH 1"
+        compiled_code.append(Instruction("PUSH", "1"))
     if len(args_list) >= 3:
-        compiled_code += "\n" + compile_expression(args_list[2])  # Max number of splits
+        compiled_code += compile_expression(args_list[2])  # Max number of splits
     else:
-        compiled_code += "\nPUSH -1"
-    compiled_code += "\n" + compile_expression(args_list[1])
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += f"\nEXPL"
+        compiled_code.append(Instruction("PUSH", "-1"))
+    compiled_code += compile_expression(args_list[1])
+    compiled_code += compile_expression(args_list[0])
+    compiled_code.append(Instruction("EXPL"))
     return compiled_code
 
 
-def parse_command_explode(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_explode(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) < 2 or len(args_list) > 4:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 2, 3 or 4).", command_token.line, command_token.file)
     if len(args_list) == 4:
-        compiled_code += "\n" + compile_expression(args_list[3])  # If add empty elements or not
+        compiled_code += compile_expression(args_list[3])  # If add empty elements or not
     else:
-        compiled_code += "\nPUSH 1"
+        compiled_code.append(Instruction("PUSH", "1"))
     if len(args_list) >= 3:
-        compiled_code += "\n" + compile_expression(args_list[2])  # Max number of splits
+        compiled_code += compile_expression(args_list[2])  # Max number of splits
     else:
-        compiled_code += "\nPUSH -1"
-    compiled_code += "\n" + compile_expression(args_list[1])
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += f"\nMXPL"
+        compiled_code.append(Instruction("PUSH", "-1"))
+    compiled_code += compile_expression(args_list[1])
+    compiled_code += compile_expression(args_list[0])
+    compiled_code.append(Instruction("MXPL"))
     return compiled_code
 
 
-def parse_command_def(command_token: Token, args: List[Token]) -> str:
-    if len(args) != 1:
-        parse_error(f"Unexpected token in def line '{args[1].value}'.", args[1].line, args[1].file)
+def parse_command_def(command_token: Token, args: List[Token]) -> List[Instruction]:
+    # def name noinline; keeps the optimizer from inlining the function
+    inlinable: bool = len(args) < 2 or args[1].value != NO_INLINE_MODIFIER
+    expected_arg_count: int = 1 if inlinable else 2
+    if len(args) != expected_arg_count:
+        parse_error(f"Unexpected token in def line '{args[expected_arg_count].value}'.", args[expected_arg_count].line, args[expected_arg_count].file)
     global_compiler_state.add_scope()
     start_tag, end_tag, post_tag = global_compiler_state.get_function_label(args[0], force_new=True)
-    compiled_code: str = ""
-    block_end_code: str = ""
-    compiled_code += f"\nJUMP {post_tag}"
-    compiled_code += f"\n@{start_tag}"
-    compiled_code += f"\nADSC"
+    compiled_code: List[Instruction] = []
+    block_end_code: List[Instruction] = []
+    compiled_code.append(Instruction("JUMP", post_tag))
+    compiled_code.append(Instruction("@", start_tag))
+    compiled_code.append(Instruction("ADSC"))
     args_var: Token = Token(ARGS_VAR, command_token.line, command_token.file)
     args_var.type = LexType.VARIABLE
     # Parameter variable
-    compiled_code += f'\nARRR'
-    compiled_code += f'\nVSET "{global_compiler_state.declare_variable(args_var, False)}"'
+    compiled_code.append(Instruction("ARRR"))
+    compiled_code.append(Instruction("VSET", f'"{global_compiler_state.declare_variable(args_var, False)}"'))
     # Context variables
     caller_var: Token = Token(CALLER_VAR, command_token.line, command_token.file)
     caller_var.type = LexType.VARIABLE
     caller_var_id = global_compiler_state.declare_variable(caller_var, False)
-    compiled_code += f"\nVSET \"{caller_var_id}\""
+    compiled_code.append(Instruction("VSET", f'"{caller_var_id}"'))
     new_context_var: Token = Token(CONTEXT_VAR, command_token.line, command_token.file)
     new_context_var.type = LexType.VARIABLE
     new_context_var_id = global_compiler_state.declare_variable(new_context_var, False)
-    compiled_code += f"\nPUSH \"{args[0].value}\""
-    compiled_code += f"\nVSET \"{new_context_var_id}\""
+    compiled_code.append(Instruction("PUSH", f'"{args[0].value}"'))
+    compiled_code.append(Instruction("VSET", f'"{new_context_var_id}"'))
     # Default return value
-    compiled_code += f'\nPNIL'  
+    compiled_code.append(Instruction("PNIL"))
+    if not inlinable:
+        compiled_code.append(Instruction(";", NO_INLINE_MODIFIER))
     # Push end code to state for it to be used on next ok;
-    block_end_code += f"\n@{end_tag}"
-    block_end_code += f"\nDLSC"
-    block_end_code += f"\nRTRN"
-    block_end_code += f"\n@{post_tag}"
+    block_end_code.append(Instruction("@", end_tag))
+    block_end_code.append(Instruction("DLSC"))
+    block_end_code.append(Instruction("RTRN"))
+    block_end_code.append(Instruction("@", post_tag))
     global_compiler_state.add_function(args[0], start_tag, end_tag, post_tag)
     global_compiler_state.add_block_end_code(block_end_code, args[0])
     return compiled_code
 
 
-def parse_function_call(command_token: Token, args_list: List[List[Token]]) -> str:
+def parse_function_call(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
     # All functions are variadic in Katalyn
-    compiled_code: str = ""
+    compiled_code: List[Instruction] = []
     # Push Caller
     context_var: Token = Token(CONTEXT_VAR, command_token.line, command_token.file)
     context_var.type = LexType.VARIABLE
     context_var_id = global_compiler_state.get_var_identifier(context_var, False)
-    compiled_code += f"\nVGET \"{context_var_id}\""
+    compiled_code.append(Instruction("VGET", f'"{context_var_id}"'))
     # Push argument array
-    compiled_code += f'\nPLIM'  # So the ARRR works.
+    compiled_code.append(Instruction("PLIM"))  # So the ARRR works.
     for args in args_list:
-        compiled_code += "\n" + compile_expression(args)
+        compiled_code += compile_expression(args)
     function_end_label: str = global_compiler_state.get_function_label(command_token)[0]
-    compiled_code += f'\nCALL {function_end_label}'
+    call: Instruction = Instruction("CALL", function_end_label)
+    call.argument_count = len(args_list)
+    compiled_code.append(call)
     return compiled_code
 
 
-def parse_command_return(command_token: Token, args: List[Token]) -> str:
-    compiled_code: str = ""
+def parse_command_return(command_token: Token, args: List[Token]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if not global_compiler_state.get_in_function_declaration():
         parse_error(f"Return can only be used inside functions.", command_token.line, command_token.file)
     if len(args):
-        compiled_code += f"\nPOPV"  # To remove the default nil
-        compiled_code += "\n" + compile_expression(args)
-    compiled_code += f"\nDLSC"
-    compiled_code += f"\nRTRN"
+        compiled_code.append(Instruction("POPV"))  # To remove the default nil
+        compiled_code += compile_expression(args)
+    compiled_code.append(Instruction("DLSC"))
+    compiled_code.append(Instruction("RTRN"))
     return compiled_code
 
 
-def parse_command_floor(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_floor(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 1:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += f"\nFLOR"
+    compiled_code += compile_expression(args_list[0])
+    compiled_code.append(Instruction("FLOR"))
     return compiled_code
 
 
-def parse_command_exec(command_token: Token, args_list: List[List[Token]]) -> str:
+def parse_command_exec(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
     if not args_list:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1+).", command_token.line, command_token.file)
-    compiled_code: str = ""
+    compiled_code: List[Instruction] = []
     pushed_count: int = 0
     for args in args_list:
-        compiled_code += "\n" + compile_expression(args)
+        compiled_code += compile_expression(args)
         if pushed_count > 0:
-            compiled_code += "\nJOIN"
+            compiled_code.append(Instruction("JOIN"))
         pushed_count += 1
-    compiled_code += '\nEXEC'
+    compiled_code.append(Instruction("EXEC"))
     stdout_var: Token = Token(EXEC_STDOUT_VAR, command_token.line, command_token.file)
     stdout_var.type = LexType.VARIABLE
     stdout_var_id = global_compiler_state.declare_variable(stdout_var, False)
@@ -1776,27 +3538,27 @@ def parse_command_exec(command_token: Token, args_list: List[List[Token]]) -> st
     exitcode_var: Token = Token(EXEC_EXITCODE_VAR, command_token.line, command_token.file)
     exitcode_var.type = LexType.VARIABLE
     exitcode_var_id = global_compiler_state.declare_variable(exitcode_var, False)
-    compiled_code += f"\nVSET \"{stdout_var_id}\""
-    compiled_code += f"\nVSET \"{stderr_var_id}\""
-    compiled_code += f"\nDUPL"
-    compiled_code += f"\nVSET \"{exitcode_var_id}\""
+    compiled_code.append(Instruction("VSET", f'"{stdout_var_id}"'))
+    compiled_code.append(Instruction("VSET", f'"{stderr_var_id}"'))
+    compiled_code.append(Instruction("DUPL"))
+    compiled_code.append(Instruction("VSET", f'"{exitcode_var_id}"'))
     return compiled_code
 
 
-def parse_command_sleep(command_token: Token, args: List[Token]) -> str:
-    compiled_code: str = ""
+def parse_command_sleep(command_token: Token, args: List[Token]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args):
-        compiled_code += "\n" + compile_expression(args)
-    compiled_code += f"\nWAIT"
+        compiled_code += compile_expression(args)
+    compiled_code.append(Instruction("WAIT"))
     return compiled_code
 
 
-def parse_command_keys(command_token: Token, args_list: List[List[Token]]) -> str:
-    compiled_code: str = ""
+def parse_command_keys(command_token: Token, args_list: List[ExpressionNode]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args_list) != 1:
         parse_error(f"Wrong number of arguments for function '{command_token.value}' (expected 1).", command_token.line, command_token.file)
-    compiled_code += "\n" + compile_expression(args_list[0])
-    compiled_code += f"\nKEYS"
+    compiled_code += compile_expression(args_list[0])
+    compiled_code.append(Instruction("KEYS"))
     return compiled_code
 
 
@@ -1807,8 +3569,8 @@ def get_relative_path(base_path, target_path):
     return absolute_path
 
 
-def parse_command_import(command_token: Token, args: List[Token]) -> str:
-    compiled_code: str = ""
+def parse_command_import(command_token: Token, args: List[Token]) -> List[Instruction]:
+    compiled_code: List[Instruction] = []
     if len(args) != 1:
         parse_error(f"Wrong number of arguments for command '{command_token.value}' (expected 1).", command_token.line, command_token.file)
     if args:
@@ -1816,8 +3578,16 @@ def parse_command_import(command_token: Token, args: List[Token]) -> str:
             parse_error(f"Expected a static string argument for command '{command_token.value}'.", command_token.line, command_token.file)
         else:
             path = get_relative_path(command_token.file, args[0].value.strip())
-            compiled_code += f"\n;\n;\n; --- Imported File: '{path}' ---\n;\n;"
-            compiled_code += "\n" + file_to_nambly(path)
+            if path in global_compiler_state.compiled_modules:
+                # Its functions and globals are already declared, so calls just bind to them
+                compiled_code.append(Instruction(";", f" --- Already Imported File: '{path}' ---"))
+                return compiled_code
+            compiled_code.append(Instruction(";", ""))
+            compiled_code.append(Instruction(";", ""))
+            compiled_code.append(Instruction(";", f" --- Imported File: '{path}' ---"))
+            compiled_code.append(Instruction(";", ""))
+            compiled_code.append(Instruction(";", ""))
+            compiled_code += file_to_nambly(path)
     return compiled_code
 
 
@@ -1827,11 +3597,21 @@ global_compiler_state = CompilerState()
 def print_help():
     print("Usage: katalyn [switches] <source file>")
     print("  -a <source>             read source from argument")
+    print("  -c                      write NariVM bytecode (.nvb) for the Python NariVM instead of executing")
     print("  -h                      print this information")
     print("  -i                      print internal representation instead of executing")
     print("  -n                      do not include standard library")
+    print("  -O0                     disable every optimization")
+    print("  -O1                     enable every optimization (default)")
+    print("  -p                      print how many instructions each optimization removed (and traces with --vm=tracing)")
+    print("  -r                      recompile everything instead of using the compilation cache")
     print("  -s                      read source from standard input")
     print("  -v                      print version")
+    print("  --vm=narivm             run on the NariVM found in your path (default)")
+    print("  --vm=python             run on the Python NariVM, inside the compiler process")
+    print("  --vm=threaded           like --vm=python, compiling each command into a closure first")
+    print("  --vm=transpiled         like --vm=python, transpiling the program into Python first")
+    print("  --vm=tracing            like --vm=python, compiling the loops that get hot into Python")
 
 
 def print_version():
@@ -1848,10 +3628,9 @@ def print_version():
     print("")
 
 
-def file_to_nambly(filename: str, called_from_file: str = "", called_from_line: int = 0) -> str:
-    """Loads, tokenizes, lexes, parses and compiles a whole Katalyn file into Nambly code.
+def file_to_nambly(filename: str, called_from_file: str = "", called_from_line: int = 0) -> List[Instruction]:
+    """Loads, tokenizes, lexes, parses and compiles a whole Katalyn file into Nambly instructions.
     """
-    nambly = ""
     try:
         with open(filename) as f:
             code = f.read()
@@ -1861,46 +3640,355 @@ def file_to_nambly(filename: str, called_from_file: str = "", called_from_line:
         else:
             parse_error(f"File {filename} not found.", called_from_line, called_from_file)
         exit(1)
-    return code_to_nambly(code, filename)
+    # Every module being compiled depends on this file
+    for dependencies in global_compiler_state.module_dependencies:
+        dependencies.append((os.path.abspath(filename), hash_source(code)))
+    global_compiler_state.compiled_modules.add(os.path.abspath(filename))
+    return module_to_nambly(code, filename)
 
 
-def code_to_nambly(code: str, filename: str) -> str:
-    """Tokenizes, lexes, parses and compiles Katalyn code into Nambly code.
+def hash_source(code: str) -> str:
+    return hashlib.sha256(code.encode()).hexdigest()
+
+
+def hash_compiler_file(location: str) -> str:
+    """Returns the hash of one of the files the compiler is made of, reading it only once per run.
+    """
+    if location not in global_compiler_state.compiler_file_hashes:
+        with open(location, "rb") as f:
+            global_compiler_state.compiler_file_hashes[location] = hashlib.sha256(f.read()).hexdigest()
+    return global_compiler_state.compiler_file_hashes[location]
+
+
+def get_cache_prefix() -> str:
+    """Returns the start of the name of every cache entry written by this version of the compiler.
     """
-    tokenized_lines: List[List[Token]] = tokenize_source(code, filename)
-    nambly = ""
+    return hash_compiler_file(os.path.abspath(__file__))[:CACHE_PREFIX_LENGTH]
+
+
+def get_module_cache_key(code: str, filename: str) -> str:
+    """Returns the name of the cache entry for a module. It changes whenever the
+    compiler, the optimization level, the module, the globals and functions it
+    can see or the files imported before it change.
+    """
+    compiler_hash: str = hash_compiler_file(os.path.abspath(__file__))
+    key_parts: List[str] = [VERSION, compiler_hash, sys.implementation.cache_tag, str(global_compiler_state.optimization_level), filename, os.path.abspath(filename), hash_source(code)]
+    key_parts += sorted(global_compiler_state.get_global_variables())
+    key_parts.append("")  # Separates variables from functions
+    key_parts += sorted(global_compiler_state.get_declared_functions())
+    key_parts.append("")  # Separates functions from compiled modules
+    key_parts += sorted(global_compiler_state.compiled_modules)
+    key_hash: str = hashlib.sha256("\0".join(key_parts).encode()).hexdigest()
+    return f"{get_cache_prefix()}-{key_hash}"
+
+
+def encode_relocatable(text: str, base: int, external_functions: Dict[str, str]) -> Union[str, Tuple]:
+    """Makes a label or compiler generated variable name independent of the block count
+    the module was compiled with. Names numbered from the base on become (prefix, offset, suffix)
+    and start labels of functions declared before the module become (function name,).
+    """
+    match = RELOCATABLE_NAME_REGEX.match(text)
+    if match is None:
+        return text
+    number: int = int(match.group(2))
+    if number >= base:
+        return (match.group(1), number - base, match.group(3))
+    if text in external_functions:
+        return (external_functions[text],)
+    return text
+
+
+def decode_relocatable(value: Union[str, Tuple], base: int, filename: str) -> str:
+    """Turns a value encoded by encode_relocatable back into a name, using the current base.
+    """
+    if isinstance(value, str):
+        return value
+    if len(value) == 1:
+        return global_compiler_state.get_function_label(Token(value[0], 0, filename, LexType.WORD))[0]
+    prefix, offset, suffix = value
+    return f"{prefix}{base + offset}{suffix}"
+
+
+def load_cached_module(cache_path: str) -> Optional[Dict]:
+    """Returns a cache entry if it exists and none of the files it imported have changed.
+    """
+    try:
+        with open(cache_path, "rb") as f:
+            entry: Dict = marshal.loads(f.read())
+        for path, content_hash in entry["dependencies"]:
+            with open(path) as f:
+                if hash_source(f.read()) != content_hash:
+                    return None
+    except (OSError, EOFError, ValueError, TypeError, KeyError):
+        return None
+    mark_cache_entry_used(cache_path)
+    return entry
+
+
+def store_cached_module(cache_path: str, entry: Dict):
+    """Writes a cache entry. Failing to do so is not an error, the module just won't be cached.
+    """
+    store_cache_entry(cache_path, marshal.dumps(entry))
+
+
+def store_cache_entry(cache_path: str, data: bytes):
+    """Writes a file to the compilation cache, replacing it atomically, and prunes the
+    cache the first time this run writes to it.
+    """
+    temp_path: str = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(CACHE_LOCATION, exist_ok=True)
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        return
+    if not global_compiler_state.cache_pruned:
+        global_compiler_state.cache_pruned = True
+        prune_cache()
+
+
+def mark_cache_entry_used(cache_path: str):
+    """Updates the modification time of a cache entry, which prune_cache uses as its last use.
+    """
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass
+
+
+def prune_cache():
+    """Deletes the entries of the compilation cache written by other versions of the compiler
+    that haven't been used for a while, and then the least recently used entries until the
+    cache fits in CACHE_SIZE_LIMIT. Every edit of a script adds a new entry, so without this
+    the cache would only grow.
+    """
+    prefix: str = get_cache_prefix()
+    now: float = time.time()
+    entries: List[Tuple[float, int, str]] = []  # Last use, size and path of the entries that are kept
+    try:
+        with os.scandir(CACHE_LOCATION) as directory:
+            for file in directory:
+                try:
+                    stat: os.stat_result = file.stat()
+                    if not file.name.startswith(prefix) and now - stat.st_mtime > CACHE_STALE_SECONDS:
+                        os.remove(file.path)
+                    else:
+                        entries.append((stat.st_mtime, stat.st_size, file.path))
+                except OSError:
+                    pass
+    except OSError:
+        return
+    cache_size: int = sum([size for _, size, _ in entries])
+    for _, size, path in sorted(entries):
+        if cache_size <= CACHE_SIZE_LIMIT:
+            break
+        try:
+            os.remove(path)
+            cache_size -= size
+        except OSError:
+            pass
+
+
+def link_cached_module(entry: Dict, filename: str) -> List[Instruction]:
+    """Relocates the instructions of a cached module to the current block count and
+    leaves the compiler state as if the module had just been compiled.
+    """
+    base: int = global_compiler_state.block_count
+    global_compiler_state.block_count += entry["block_count"]
+    global_variables: Dict[str, str] = {}
+    for name, var_id in entry["global_variables"]:
+        global_variables[decode_relocatable(name, base, filename)] = decode_relocatable(var_id, base, filename)
+    functions: Dict[str, Tuple[str, str, str]] = {}
+    for function_name, labels in entry["functions"]:
+        functions[function_name] = tuple([decode_relocatable(label, base, filename) for label in labels])
+    shadowed_functions: Dict[str, str] = {}
+    for shadowed_label, shadower_label in entry["shadowed_functions"]:
+        shadowed_functions[decode_relocatable(shadowed_label, base, filename)] = decode_relocatable(shadower_label, base, filename)
+    instructions: List[Instruction] = []
+    for opcode, argument, line, file, argument_count in entry["instructions"]:
+        if argument is not None and opcode in RELOCATABLE_OPCODES:
+            argument = decode_relocatable(argument, base, filename)
+        instructions.append(Instruction(opcode, argument, line, file))
+        instructions[-1].argument_count = argument_count
+    global_compiler_state.link_module(global_variables, functions, shadowed_functions, filename)
+    for optimization, count in entry["removed_instructions"]:
+        global_compiler_state.count_removed_instructions(optimization, count)
+    global_compiler_state.compiled_modules.update(entry["compiled_modules"])
+    for dependencies in global_compiler_state.module_dependencies:
+        dependencies += entry["dependencies"]
+    return instructions
+
+
+def module_to_nambly(code: str, filename: str) -> List[Instruction]:
+    """Compiles a Katalyn file into Nambly instructions, or loads them from the
+    compilation cache if neither the file, the files it imports nor the globals
+    and functions declared before it have changed since it was last compiled.
+    """
+    if not global_compiler_state.use_cache or not global_compiler_state.get_at_top_level():
+        return code_to_nambly(code, filename)
+    cache_path: str = os.path.join(CACHE_LOCATION, get_module_cache_key(code, filename))
+    entry: Optional[Dict] = load_cached_module(cache_path)
+    if entry is not None:
+        return link_cached_module(entry, filename)
+    base: int = global_compiler_state.block_count
+    entry_functions: Dict[str, Tuple[str, str, str]] = global_compiler_state.get_declared_functions()
+    shadowed_count: int = len(global_compiler_state.shadowed_functions)
+    entry_removed_instructions: Dict[str, int] = dict(global_compiler_state.removed_instructions)
+    entry_compiled_modules: Set[str] = set(global_compiler_state.compiled_modules)
+    global_compiler_state.module_dependencies.append([])
+    instructions: List[Instruction] = code_to_nambly(code, filename)
+    dependencies: List[Tuple[str, str]] = global_compiler_state.module_dependencies.pop()
+    # Start labels of the functions declared before this module, to link calls to them by name
+    external_functions: Dict[str, str] = {labels[0]: name for name, labels in entry_functions.items()}
+    encoded_instructions: List[Tuple] = []
+    for instruction in instructions:
+        argument: Optional[Union[str, Tuple]] = instruction.argument
+        if argument is not None and instruction.opcode in RELOCATABLE_OPCODES:
+            argument = encode_relocatable(argument, base, external_functions)
+        encoded_instructions.append((instruction.opcode, argument, instruction.line, instruction.file, instruction.argument_count))
+    global_variables: List[Tuple] = []
+    for name, var_id in global_compiler_state.get_global_variables().items():
+        global_variables.append((encode_relocatable(name, base, external_functions), encode_relocatable(var_id, base, external_functions)))
+    functions: List[Tuple] = []
+    for function_name, labels in global_compiler_state.get_declared_functions().items():
+        if entry_functions.get(function_name) != labels:
+            functions.append((function_name, tuple([encode_relocatable(label, base, external_functions) for label in labels])))
+    shadowed_functions: List[Tuple] = []
+    for shadowed_label, shadower_label in list(global_compiler_state.shadowed_functions.items())[shadowed_count:]:
+        shadowed_functions.append((encode_relocatable(shadowed_label, base, external_functions), encode_relocatable(shadower_label, base, external_functions)))
+    removed_instructions: List[Tuple[str, int]] = []
+    for optimization, count in global_compiler_state.removed_instructions.items():
+        removed_instructions.append((optimization, count - entry_removed_instructions.get(optimization, 0)))
+    store_cached_module(cache_path, {
+        "dependencies": dependencies,
+        "block_count": global_compiler_state.block_count - base,
+        "instructions": encoded_instructions,
+        "global_variables": global_variables,
+        "functions": functions,
+        "shadowed_functions": shadowed_functions,
+        "removed_instructions": removed_instructions,
+        "compiled_modules": sorted(global_compiler_state.compiled_modules - entry_compiled_modules),
+    })
+    return instructions
+
+
+def code_to_nambly(code: str, filename: str) -> List[Instruction]:
+    """Tokenizes, lexes, parses and compiles Katalyn code into Nambly instructions.
+    """
+    tokenized_lines: List[List[Token]] = scan_source(code, filename)
+    nambly: List[Instruction] = []
     if tokenized_lines:
-        # print_tokens(tokenized_lines, filename, "Tokenization")
-        lex_tokens(tokenized_lines)
-        #print_tokens(tokenized_lines, filename, "Lexing")
+        # print_tokens(tokenized_lines, filename, "Scanning")
         nambly = compile_lines(tokenized_lines)
         global_compiler_state.check_for_errors()
     return nambly
 
 
+def load_transpiled_program(instructions: List[Instruction]) -> Optional[CodeType]:
+    """Transpiles a program into Python and compiles it, or loads it from the .pyc the
+    compilation cache keeps for it. Returns None if the program nests too deeply for
+    Python to compile it.
+    """
+    key = hashlib.sha256()
+    for location in (os.path.abspath(__file__), os.path.join(STDLIB_LOCATION, "old", "narivm.py")):
+        key.update(hash_compiler_file(location).encode())
+    key.update(f"{VERSION}\0{sys.implementation.cache_tag}\0".encode())
+    key.update(instructions_to_nambly(instructions).encode())
+    cache_path: str = os.path.join(CACHE_LOCATION, f"{get_cache_prefix()}-{key.hexdigest()}.pyc")
+    if global_compiler_state.use_cache:
+        try:
+            with open(cache_path, "rb") as f:
+                data: bytes = f.read()
+            if data[:4] == importlib.util.MAGIC_NUMBER:
+                program: CodeType = marshal.loads(data[16:])
+                mark_cache_entry_used(cache_path)
+                return program
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+    try:
+        program = compile(instructions_to_python(instructions), "<katalyn>", "exec")
+    except (RecursionError, MemoryError):
+        return None
+    store_cache_entry(cache_path, importlib.util.MAGIC_NUMBER + bytes(12) + marshal.dumps(program))
+    return program
+
+
+def run_on_python_vm(instructions: List[Instruction], mode: str, print_trace_counters: bool) -> None:
+    """Runs a program on the Python NariVM (old/narivm.py) inside this same process,
+    without writing it anywhere. The threaded mode compiles the program into closures
+    before running it, the tracing one compiles its hot loops while running it and the
+    transpiled one turns it into a Python module that runs the NariVM values and commands
+    directly.
+    """
+    sys.path.insert(0, os.path.join(STDLIB_LOCATION, "old"))
+    import narivm
+    if print_trace_counters and mode == "tracing":
+        atexit.register(narivm.print_trace_counters)
+    if mode == "transpiled":
+        program: Optional[CodeType] = load_transpiled_program(instructions)
+        if program is not None:
+            narivm.run_python_program(program)
+            return
+    narivm.nari_run_bytecode(instructions_to_bytecode(instructions), "loop" if mode in ("python", "transpiled") else mode)
+
+
+def run_on_narivm(nambly: str) -> None:
+    """Replaces this process with the NariVM, handing it the program through an
+    in-memory file (or through a pipe, where those are not available) instead of a
+    file on disk.
+    """
+    if hasattr(os, "memfd_create"):
+        program_fd: int = os.memfd_create("kat_exec", 0)
+        with open(program_fd, "w", closefd=False) as f:
+            f.write(nambly)
+    else:
+        program_fd, write_fd = os.pipe()
+        if os.fork() == 0:
+            # The writer must be another process, as the pipe fills up before the NariVM starts reading
+            os.close(program_fd)
+            try:
+                with open(write_fd, "w") as f:
+                    f.write(nambly)
+            except OSError:
+                pass
+            os._exit(0)
+        os.close(write_fd)
+    os.set_inheritable(program_fd, True)
+    command = "narivm"
+    args = [f"/dev/fd/{program_fd}"]
+    try:
+        os.execvp(command, [command] + args)
+    except FileNotFoundError:
+        print("The NariVM couldn't be loaded. Make sure it's in your path.")
+
 
 if __name__ == "__main__":
-    full_nambly: str = ""
+    full_nambly: List[Instruction] = []
     context_var: Token = Token(CONTEXT_VAR, 0, "")
     context_var.type = LexType.VARIABLE
     context_var_id = global_compiler_state.declare_variable(context_var, True)
-    full_nambly += f"\nPUSH \"\""
-    full_nambly += f"\nVSET \"{context_var_id}\""
+    full_nambly.append(Instruction("PUSH", '""'))
+    full_nambly.append(Instruction("VSET", f'"{context_var_id}"'))
     flags_var: Token = Token(FLAGS_VAR, 0, "")
     flags_var.type = LexType.VARIABLE
     flags_var_id = global_compiler_state.declare_variable(flags_var, True)
-    full_nambly += "\nPLIM"
+    full_nambly.append(Instruction("PLIM"))
     filename: str = ""
     dont_expect_filename: bool = False
     include_standard_lib: bool = True
     read_standard_input: bool = False
     next_argument_is_code: bool = False
     print_ir: bool = False
+    write_bytecode: bool = False
+    print_optimization_stats: bool = False
+    use_python_vm: bool = False
+    python_vm_mode: str = "python"
     code: str = ""
     for arg in sys.argv[1:]:
         if filename:
             # Pass arguments to Nambly
-            full_nambly += f"\nPUSH \"{arg}\""
+            full_nambly.append(Instruction("PUSH", f'"{arg}"'))
         else:
             if next_argument_is_code:
                 code = arg
@@ -1908,6 +3996,8 @@ if __name__ == "__main__":
             elif arg == "-a":
                 next_argument_is_code = True
                 dont_expect_filename = True
+            elif arg == "-c":
+                write_bytecode = True
             elif arg == "-h":
                 print_help()
                 exit(0)
@@ -1915,21 +4005,30 @@ if __name__ == "__main__":
                 print_ir = True
             elif arg == "-n":
                 include_standard_lib = False
+            elif arg in ("-O0", "-O1"):
+                global_compiler_state.optimization_level = int(arg[2:])
+            elif arg == "-p":
+                print_optimization_stats = True
+            elif arg == "-r":
+                global_compiler_state.use_cache = False
             elif arg == "-s":
                 read_standard_input = True
                 dont_expect_filename = True
             elif arg == "-v":
                 print_version()
                 exit(0)
+            elif arg in ("--vm=narivm", "--vm=python", "--vm=threaded", "--vm=transpiled", "--vm=tracing"):
+                use_python_vm = arg != "--vm=narivm"
+                python_vm_mode = arg[len("--vm="):]
             else:
                 filename = arg
-    full_nambly += f"\nARRR"
-    full_nambly += f"\nVSET \"{flags_var_id}\""
+    full_nambly.append(Instruction("ARRR"))
+    full_nambly.append(Instruction("VSET", f'"{flags_var_id}"'))
     if not filename and not dont_expect_filename:
         print_help()
         exit(1)
     if include_standard_lib:
-        full_nambly += "\n" + file_to_nambly(f"{STDLIB_LOCATION}/stdlib.kat")
+        full_nambly += file_to_nambly(f"{STDLIB_LOCATION}/stdlib.kat")
     if read_standard_input:
         while True:
             try:
@@ -1938,31 +4037,31 @@ if __name__ == "__main__":
                 break
             except Exception:
                 exit(1)
-        full_nambly += "\n" + code_to_nambly(code, os.path.join(os.getcwd(), "stdin"))
+        full_nambly += code_to_nambly(code, os.path.join(os.getcwd(), "stdin"))
     elif code:
-        full_nambly += "\n" + code_to_nambly(code, os.path.join(os.getcwd(), "argument_code"))
+        full_nambly += code_to_nambly(code, os.path.join(os.getcwd(), "argument_code"))
     else:
-        full_nambly += "\n" + file_to_nambly(filename)
-    nambly = stylize_namby(full_nambly)
-    # Replace shadowed functions
-    for shadow_tuple in global_compiler_state.shadower_functions:
-        shadower_function, shadowed_function = shadow_tuple
-        nambly = nambly.replace(f"CALL {shadowed_function}", f"CALL {shadower_function}")
+        full_nambly += file_to_nambly(filename)
+    resolve_shadowed_calls(full_nambly)
+    if global_compiler_state.optimization_level >= 1:
+        full_nambly = inline_functions(full_nambly)
+        full_nambly = eliminate_dead_functions(full_nambly)
+        if use_python_vm or write_bytecode:
+            full_nambly = use_fast_calls(full_nambly)
+        full_nambly = optimize_peephole(full_nambly)
+    if print_optimization_stats:
+        print_removed_instructions()
+    if use_python_vm or write_bytecode:
+        full_nambly = resolve_variable_slots(full_nambly)
+    if write_bytecode:
+        source_name: str = filename or ("stdin" if read_standard_input else "argument_code")
+        with open(f"{os.path.splitext(source_name)[0]}.nvb", "wb") as f:
+            f.write(instructions_to_bytecode(full_nambly))
+        exit(0)
     if print_ir:
-        print(nambly)
+        print(instructions_to_nambly(full_nambly))
+    elif use_python_vm:
+        run_on_python_vm(full_nambly, python_vm_mode, print_optimization_stats)
     else:
-        filename: str = "/tmp/kat_exec_"
-        for i in range(0, 4):
-            for i in range(0, 4):
-                filename += f"{random.randint(0, 9)}"
-            filename += f"-"
-        filename += f"{time.time_ns()}"
-        with open(filename, "w+") as f:
-            f.write(nambly)
-        command = "narivm"
-        args = [filename]
-        try:
-            os.execvp(command, [command] + args)
-        except FileNotFoundError:
-            print("The NariVM couldn't be loaded. Make sure it's in your path.")
+        run_on_narivm(instructions_to_nambly(full_nambly))
 
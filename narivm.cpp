@@ -114,6 +114,9 @@ enum Opcode : uint8_t
     KEYS,
     GITR,
     NEXT,
+    RITR, // Range ITeRator
+    RNXT, // Range NeXT
+    PNXT, // Pair NeXT
     PLIM,
     EXPL, // Explode
     MXPL, // Multi eXPLode
@@ -183,6 +186,9 @@ Opcode opcode_from_string(string_view str)
         {"KEYS", Opcode::KEYS},
         {"GITR", Opcode::GITR},
         {"NEXT", Opcode::NEXT},
+        {"RITR", Opcode::RITR},
+        {"RNXT", Opcode::RNXT},
+        {"PNXT", Opcode::PNXT},
         {"PLIM", Opcode::PLIM},
         {"EXPL", Opcode::EXPL},
         {"MXPL", Opcode::MXPL},
@@ -346,6 +352,12 @@ string_view opcode_as_string(Opcode opcode)
         return "GITR";
     case Opcode::NEXT:
         return "NEXT";
+    case Opcode::RITR:
+        return "RITR";
+    case Opcode::RNXT:
+        return "RNXT";
+    case Opcode::PNXT:
+        return "PNXT";
     case Opcode::PLIM:
         return "PLIM";
     case Opcode::EXPL:
@@ -390,6 +402,13 @@ string double_to_string(double value)
     }
 }
 
+// State of a range iterator, which counts from its first number to its last one without storing them
+struct Range
+{
+    double next;
+    double last;
+};
+
 class Value
 {
 private:
@@ -400,6 +419,8 @@ private:
     double num_rep;
     shared_ptr<map<string, Value>> table_rep;
     shared_ptr<queue<string> /**/> iterator_elements;
+    shared_ptr<Value> iterated_value; // Table or text the keys of an iterator are looked up in (PNXT)
+    shared_ptr<Range> range_rep;
 
     void reset_values()
     {
@@ -444,10 +465,18 @@ public:
         this->type = LISTLIMIT;
     }
 
-    void set_iterator_value()
+    void set_iterator_value(const Value &container)
     {
         reset_values();
         this->iterator_elements = std::make_shared<queue<string>>();
+        this->iterated_value = std::make_shared<Value>(container);
+        this->type = ITER;
+    }
+
+    void set_range_value(double first, double last)
+    {
+        reset_values();
+        this->range_rep = std::make_shared<Range>(Range{first, last});
         this->type = ITER;
     }
 
@@ -466,6 +495,16 @@ public:
         return iterator_elements.get();
     }
 
+    Value *get_iterated_value()
+    {
+        return iterated_value.get();
+    }
+
+    Range *get_range()
+    {
+        return range_rep.get();
+    }
+
     const string &get_raw_string_value() const
     {
         // Gets the string value of the value, even if it wasn't set, used for arguments.
@@ -890,6 +929,8 @@ vector<Command> generate_label_map_and_code_listing(const string &code)
         {
         case Opcode::JUMP:
         case Opcode::JPIF:
+        case Opcode::RNXT:
+        case Opcode::PNXT:
         case Opcode::CALL:
             pc = label_to_pc[command.get_arguments()[0].get_raw_string_value()] - 1;
             command.set_branch_target(pc);
@@ -2109,7 +2150,7 @@ void execute_code_listing(vector<Command> &code_listing)
                     // Idea: I can use it->second here to add the values as well to the table maybe
                     Value key;
                     key.set_string_value(it->first);
-                    (*value.get_table())[double_to_string(index)] = key;
+                    (*result.get_table())[double_to_string(index)] = key;
                     ++index;
                 }
                 push(std::move(result));
@@ -2120,7 +2161,7 @@ void execute_code_listing(vector<Command> &code_listing)
         {
             Value container = pop(command);
             Value result;
-            result.set_iterator_value();
+            result.set_iterator_value(container);
             if (container.get_type() == TABLE)
             {
                 vector<string> dict_keys;
@@ -2179,6 +2220,75 @@ void execute_code_listing(vector<Command> &code_listing)
             }
             break;
         }
+        case Opcode::RITR:
+        {
+            Value last = pop(command);
+            Value first = pop(command);
+            Value result;
+            result.set_range_value(first.get_as_number(), last.get_as_number());
+            push(std::move(result));
+            break;
+        }
+        case Opcode::RNXT: // Range NeXT, or jump once the range is over
+        {
+            Value iterator = pop(command);
+            Range *range = iterator.get_range();
+            if (iterator.get_type() != ITER || range == nullptr)
+            {
+                raise_nvm_error("Cannot RNXT a non-range iterator.");
+            }
+            else if (range->next > range->last)
+            {
+                pc = command.get_branch_target();
+            }
+            else
+            {
+                Value result;
+                result.set_number_value(range->next);
+                range->next += 1;
+                push(std::move(result));
+            }
+            break;
+        }
+        case Opcode::PNXT: // Pair NeXT: pushes the next key and its value, or jumps once there are none left
+        {
+            Value iterator = pop(command);
+            Value *container = iterator.get_iterated_value();
+            if (iterator.get_type() != ITER || container == nullptr)
+            {
+                raise_nvm_error("Cannot PNXT a non-key iterator.");
+            }
+            else if (iterator.get_iterator_queue()->empty())
+            {
+                pc = command.get_branch_target();
+            }
+            else
+            {
+                Value key;
+                key.set_string_value(iterator.get_iterator_queue()->front());
+                iterator.get_iterator_queue()->pop();
+                Value value;
+                if (container->get_type() == TABLE)
+                {
+                    auto it = container->get_table()->find(key.get_as_string());
+                    if (it != container->get_table()->end())
+                    {
+                        value = it->second;
+                    }
+                    else
+                    {
+                        value.set_nil_value();
+                    }
+                }
+                else
+                {
+                    value.set_string_value(container->get_as_string().substr(stoul(key.get_as_string()) - 1, 1));
+                }
+                push(std::move(key));
+                push(std::move(value));
+            }
+            break;
+        }
         case Opcode::DEBUG:
         {
             cout << "NariVM Debug Output:" << endl;
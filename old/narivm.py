@@ -1,19 +1,44 @@
 from __future__ import annotations
 from io import TextIOWrapper
-from typing import Dict, List, Set, Tuple, Any, Optional, Union
+from types import CodeType, TracebackType
+from typing import Callable, Dict, Iterator, List, Set, Tuple, Any, Optional, Union
 from enum import Enum
+from functools import partial
 import math
+import re
+import struct
 import sys
 import subprocess
+import threading
 import time
 from sys import exit
 
 variable_tables: List[Dict[str, Value]] = [{}]
+global_slots: List[Optional[Value]] = []  # Variables of programs compiled with slots, None if unset
+slot_frames: List[List[Optional[Value]]] = []
 label_to_pc: Dict[str, int] = {}
 pc_to_label: Dict[int, str] = {}
 execution_stack: List[Any] = []
 open_files: Dict[str, TextIOWrapper] = {}
 return_stack: List[int] = []
+line_table: List[Tuple[int, int, str]] = []  # (First PC, source line, source file) for each run of commands
+BYTECODE_MAGIC = b"NVB\0"
+BYTECODE_VERSION = 3
+BRANCH_COMMANDS = ("JUMP", "JPIF", "RNXT", "PNXT", "CALL")
+BLOCK_ENDING_COMMANDS = BRANCH_COMMANDS + ("RTRN",)
+GLOBAL_SLOT_COMMANDS = ("GGET", "GPUT", "GDEL", "GNXT")
+FALLBACK_SLOT_COMMANDS = ("LGET", "LDEL", "LNXT")  # Frame slot, then the global slot to fall back to
+SLOT_COMMANDS = ("ADFR", "ARGS", "LPUT") + GLOBAL_SLOT_COMMANDS + FALLBACK_SLOT_COMMANDS
+PYTHON_RECURSION_LIMIT = 1000000  # Deepest Katalyn recursion programs transpiled to Python can reach
+PYTHON_THREAD_STACK_SIZE = 512 * 1024 * 1024
+TRACE_THRESHOLD = 50  # Times a loop has to jump back to its start before it gets traced and compiled
+TRACE_LENGTH_LIMIT = 1000  # Most commands a trace can have
+TRACE_OPERAND_COUNTS = {  # Values the commands compiled in traces take from the stack
+    "ADDV": 2, "SUBT": 2, "MULT": 2, "FDIV": 2, "IDIV": 2, "POWR": 2, "MODL": 2, "ISGT": 2, "ISLT": 2, "ISGE": 2, "ISLE": 2,
+    "ISEQ": 2, "ISNE": 2, "JOIN": 2, "PGET": 2, "LAND": 2, "LGOR": 2, "ISIN": 2, "RITR": 2,
+    "NIL?": 1, "LNOT": 1, "TRIM": 1, "SLEN": 1, "FLOR": 1, "JPIF": 1,
+}
+trace_counters: Dict[str, int] = {"traces compiled": 0, "traces aborted": 0, "guard failures": 0, "side exits": 0}
 
 class Types(Enum):
     INT = 1
@@ -22,16 +47,165 @@ class Types(Enum):
     TAB = 4
     NIL = 5
     ITR = 6
+    LIM = 7
 
 
 # Para setear tabla: primero tabla, despues campo, despues valor, después escritura (arriba)
 # Para leer tabla: primero tabla, después campo, después lectura (arriba)
 
 
+class RangePosition:
+    """The state of a range iterator (RITR), which counts from its first number
+    to its last one without storing them.
+    """
+    def __init__(self, first: Union[int, float], last: Union[int, float]) -> None:
+        self.next: Union[int, float] = first
+        self.last: Union[int, float] = last
+
+
+class KeyPosition:
+    """The state of a key iterator (GITR). The keys of a text, and of a table that
+    only has the keys "1" to "n", are counted from 1 to the last one without storing
+    them. Other tables are sorted once, and then their keys are taken by position.
+    In both cases, the keys are the ones the value had when the iterator was made:
+    keys added inside the loop are skipped and deleted ones are still visited, as
+    the C++ NariVM does.
+    """
+    __slots__ = ("container", "keys", "next", "last")
+
+    def __init__(self, container: Union["Table", str], last: int, keys: Optional[List[str]] = None) -> None:
+        self.container: Union[Table, str] = container  # Table or text the keys are looked up in (PNXT)
+        self.keys: Optional[List[str]] = keys
+        self.next: int = 1
+        self.last: int = last
+
+
+class TextBuilder:
+    """The contents of a text (TXT) value built by JOIN, kept as the texts joined so far until
+    something needs the whole text (see Value.get_as_string). Builders share their list of
+    parts with the builder they were appended to, so a text that keeps growing in a loop
+    isn't copied every time. Only a builder that sees the end of the list can append to it,
+    the rest copy their own parts first.
+    """
+    __slots__ = ("parts", "count", "length")
+
+    def __init__(self, parts: List[str], length: int) -> None:
+        self.parts: List[str] = parts
+        self.count: int = len(parts)
+        self.length: int = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __str__(self) -> str:
+        if self.count == len(self.parts):
+            return "".join(self.parts)
+        return "".join(self.parts[:self.count])
+
+    def append(self, text: str) -> "TextBuilder":
+        parts: List[str] = self.parts
+        if self.count != len(parts):
+            parts = parts[:self.count]
+        parts.append(text)
+        return TextBuilder(parts, self.length + len(text))
+
+
+class Table:
+    """The contents of a table (TAB) value. The values of the keys "1" to "n" are kept in a
+    list, and every other key in a dict. Keys only go to the list while they are added in
+    order and before any other key, so the table can always list its keys in the order
+    they were added, like a dict would.
+    """
+    __slots__ = ("array", "hash")
+
+    def __init__(self, array: Optional[List[Value]] = None) -> None:
+        self.array: List[Value] = array if array is not None else []
+        self.hash: Dict[str, Value] = {}
+
+    def __len__(self) -> int:
+        return len(self.array) + len(self.hash)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Table) and dict(self.items()) == dict(other.items())
+
+    def get(self, key: str) -> Optional[Value]:
+        index: int = get_array_index(key)
+        if 0 < index <= len(self.array):
+            return self.array[index - 1]
+        return self.hash.get(key)
+
+    def get_index(self, index: int) -> Optional[Value]:
+        """Returns the value of the key an INT value stands for, without turning it into a string.
+        """
+        if type(index) is int and 0 < index <= len(self.array):
+            return self.array[index - 1]
+        return self.hash.get(str(index)) if self.hash else None
+
+    def set(self, key: str, value: Value) -> None:
+        index: int = get_array_index(key)
+        if index:
+            self.set_index(index, value)
+        else:
+            self.hash[key] = value
+
+    def set_index(self, index: int, value: Value) -> None:
+        if type(index) is int and 0 < index <= len(self.array):
+            self.array[index - 1] = value
+        elif type(index) is int and index == len(self.array) + 1 and not self.hash:
+            self.array.append(value)
+        else:
+            self.hash[str(index)] = value
+
+    def delete(self, key: str) -> None:
+        index: int = get_array_index(key)
+        if index == len(self.array) and index > 0:
+            self.array.pop()
+        elif 0 < index < len(self.array):
+            # The list can't have holes, so the whole table goes to the dict
+            self.hash = dict(self.items())
+            self.array = []
+            del self.hash[key]
+        else:
+            self.hash.pop(key, None)
+
+    def keys(self) -> List[str]:
+        return [str(index) for index in range(1, len(self.array) + 1)] + list(self.hash)
+
+    def values(self) -> List[Value]:
+        return self.array + list(self.hash.values())
+
+    def items(self) -> List[Tuple[str, Value]]:
+        return list(zip(self.keys(), self.values()))
+
+    def get_sorted_keys(self) -> List[str]:
+        """Returns the keys in the order for loops go through them (see iterator_sort_key).
+        """
+        if not self.hash:
+            return self.keys()
+        return sorted(self.keys(), key=iterator_sort_key)
+
+
+def get_array_index(key: str) -> int:
+    """Returns the number a table key stands for if it is one of "1", "2", "3"... and 0 otherwise.
+    """
+    if key.isdigit() and key.isascii() and key[0] != "0":
+        return int(key)
+    return 0
+
+
 class Command:
     def __init__(self):
         self.command = ""
         self.arguments: List[Value]= []
+        self.opcode: int = -1  # Index of the command handler, set when the listing is loaded
+        self.branch_target: int = -1  # PC that JUMP, JPIF, RNXT, PNXT and CALL go to
+        self.slot: int = -1  # Frame slot of the slot commands (frame size for ADFR, argument count for ARGS)
+        self.global_slot: int = -1
+        self.line: int = 0
+        self.file: str = ""
 
     def __repr__(self) -> str:
         rep: str = f"{self.command}"
@@ -43,9 +217,15 @@ class Command:
     
 
 class Value:
-    def __init__(self) -> None:
-        self.value = ""
-        self.type = Types.NIL
+    # Values are never changed once built, so they can be shared, and the string and number
+    # forms of the INT, FLO and TXT ones are kept the first time they are asked for
+    __slots__ = ("value", "type", "string", "number")
+
+    def __init__(self, value: Any = "", value_type: Types = Types.NIL) -> None:
+        self.value = value
+        self.type = value_type
+        self.string: Optional[str] = None
+        self.number: Optional[Union[int, float]] = None
 
     def __repr__(self) -> str:
         type_name = str(self.type).split('.')[1]
@@ -55,52 +235,98 @@ class Value:
         return str(self.value)
     
     def get_as_string(self) -> str:
-        """Returns a string representation of the value.
-        TODO: Optimizar esto para que no haya que convertir cada vez.
+        """Returns a string representation of the value, in the same format as the C++ NariVM.
         """
-        if self.type == Types.NIL:
-            return "nil"
+        if self.string is not None:
+            return self.string
+        if self.type in (Types.NIL, Types.ITR, Types.LIM):
+            nambly_error(f"Can't convert {TYPE_NAMES[self.type]} value to string.")
         elif self.type == Types.TAB:
+            # Keys in the order of the std::map the C++ NariVM keeps them in
             table_values: List[str] = []
-            for key in self.value:
-                table_values.append(f"{key}: '{self.value[key].get_as_string()}'")
+            for key, value in sorted(self.value.items()):
+                if value.type == Types.TXT:
+                    table_values.append(f"'{key}':'{value.get_as_string()}'")
+                else:
+                    table_values.append(f"'{key}':{value.get_as_string()}")
             return "[" + ", ".join(table_values) + "]"
-        return str(self.value)
+        elif self.type == Types.FLO and math.isfinite(self.value):
+            # Same format as the C++ NariVM: integral values without decimals, six decimals at most otherwise
+            if self.value == math.floor(self.value):
+                self.string = str(int(self.value))
+            else:
+                self.string = f"{self.value:f}".rstrip("0").rstrip(".")
+            return self.string
+        string: str = str(self.value)
+        if self.type in CACHED_TYPES:
+            self.string = string
+            if self.type == Types.TXT:
+                self.value = string  # Built texts are only joined once
+        return string
     
     def get_as_number(self) -> Union[float|int]:
-        """Returns an int or a float depending on the string.
-        TODO: Optimizar esto para que no haya que convertir cada vez.
+        """Returns an int or a float depending on the string. Texts are read like the C++
+        NariVM does with stod: leading spaces are skipped and the longest number at the
+        start of the text is taken, the rest is ignored.
         """
-        if self.type == Types.NIL:
-            nambly_error("Runtime error: a NIL value cannot be turned into a number.")
-        begin: int = 0
-        found_period: bool = False
-        if self.type == Types.INT:
-            return int(self.value)
-        if self.type == Types.FLO:
-            return float(self.value)
-        if self.type == Types.TXT:
-            txt_value = self.get_as_string().strip()
-            if txt_value[0] in "+-":
-                begin = 1
-            for char in txt_value[begin:]:
-                if char not in "0123456789.":
-                    nambly_error(f"Invalid number: {self}")
-                if char == ".":
-                    if found_period:
-                        nambly_error(f"Invalid number: {self}")
-                    else:
-                        found_period = True
-            if not found_period:
-                return int(txt_value)
+        if self.number is not None:
+            return self.number
+        if self.type in (Types.NIL, Types.ITR, Types.LIM):
+            nambly_error(f"Can't convert {TYPE_NAMES[self.type]} value to number.")
+        elif self.type == Types.INT:
+            self.number = int(self.value)
+        elif self.type == Types.FLO:
+            self.number = float(self.value)
+        elif self.type == Types.TAB:
+            return len(self.value)
+        elif self.type == Types.TXT:
+            text: str = self.get_as_string()
+            match: Optional[re.Match] = NUMBER_PREFIX_REGEX.match(text)
+            if match is None:
+                nambly_error(f"Can't convert value {text} to number.")
+            if match.group("integer") is not None:
+                self.number = int(match.group("integer"))
+            elif match.group("hexadecimal") is not None:
+                self.number = int(match.group("hexadecimal"), 16)
             else:
-                return float(txt_value)
-    
+                self.number = float(match.group(0))
+        return self.number
+
+
+CACHED_TYPES = (Types.INT, Types.FLO, Types.TXT)  # Types whose values keep their string and number forms
+TYPE_NAMES = {Types.NIL: "NIL", Types.ITR: "iterator", Types.LIM: "LISTLIMIT"}  # As the C++ NariVM names them in conversion errors
+# What stod reads at the start of a text: a hexadecimal integer, a decimal integer or any other float stod accepts
+NUMBER_PREFIX_REGEX = re.compile(r"""\s*(?:
+    (?P<hexadecimal>[+-]?0[xX][0-9a-fA-F]+)(?![.pP])
+    | (?P<integer>[+-]?[0-9]+)(?![0-9.eE])
+    | [+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?
+    | [+-]?(?:inf(?:inity)?|nan)
+)""", re.VERBOSE | re.IGNORECASE)
+SMALL_INTEGER_COUNT = 1024
+SMALL_INTEGERS: List[Value] = [Value(number, Types.INT) for number in range(SMALL_INTEGER_COUNT)]  # Shared INT values from 0
+NIL_VALUE = Value(None, Types.NIL)
+TEXT_BUILDER_MINIMUM = 256  # Length a text needs for JOIN to append to it with a TextBuilder instead of copying it
+
+
+class NamblyError(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.pc: Optional[int] = None
+
 
 def nambly_error(message: str):
-    print("Runtime Error!")
-    print(message)
-    exit(1)
+    raise NamblyError(message)
+
+
+def get_source_location(pc: int) -> Optional[Tuple[int, str]]:
+    """Returns the source line and file a PC was compiled from, using the line table.
+    """
+    location: Optional[Tuple[int, str]] = None
+    for first_pc, line, file in line_table:
+        if first_pc > pc:
+            break
+        location = (line, file)
+    return location
 
 
 def generate_label_map(code_listing: List[Command]) -> List[Command]:
@@ -116,10 +342,32 @@ def generate_label_map(code_listing: List[Command]) -> List[Command]:
             pc_to_label[jmp_pc_value] = command.command
         else:
             new_listing.append(command)
+            if not line_table or line_table[-1][1:] != (command.line, command.file):
+                line_table.append((pc, command.line, command.file))
             pc += 1
+    for command in new_listing:
+        command.opcode = OPCODE_NUMBERS.get(command.command, UNKNOWN_OPCODE)
+        if command.command in BRANCH_COMMANDS:
+            label: str = command.arguments[0].value
+            if label not in label_to_pc:
+                nambly_error(f"Unknown label: {label}")
+            command.branch_target = label_to_pc[label]
+        elif command.command in GLOBAL_SLOT_COMMANDS:
+            command.global_slot = command.arguments[0].value
+        elif command.command in SLOT_COMMANDS:
+            command.slot = command.arguments[0].value
+            command.global_slot = command.arguments[-1].value
+    allocate_global_slots(new_listing)
     return new_listing
 
 
+def allocate_global_slots(code_listing: List[Command]) -> None:
+    """Makes room in the global table for every global slot the code listing uses.
+    """
+    slot_count: int = max([command.global_slot + 1 for command in code_listing], default=0)
+    global_slots[:] = [None] * slot_count
+
+
 def split_lines(code: str) -> List[Command]:
     """Splits a code into multiple lines, skipping empty lines.
     This generates what we call a code listing: a list of assembly lines, trimmed, with
@@ -127,11 +375,20 @@ def split_lines(code: str) -> List[Command]:
     """
     lines = code.split("\n")
     code_listing = []
+    source_line: int = 0
+    source_file: str = ""
     for line in lines:
         line = line.strip()
         if len(line):
             if line[0] != ";":
-                code_listing.append(split_command_arguments(line))
+                command: Command = split_command_arguments(line)
+                command.line = source_line
+                command.file = source_file
+                code_listing.append(command)
+            elif line.startswith(";line"):
+                source_line = int(line[5:])
+            elif line.startswith(";file"):
+                source_file = line[5:].strip()
     return code_listing
 
 
@@ -320,575 +577,1540 @@ def display(v: Value):
     print(v.get_as_string(), end="", flush=True)
 
 
-def execute_code_listing(code_listing: List[Command]):
-    """Inefficiently executes a code listing.
+def execute_push(command: Command, pc: int) -> int:
+    push(command.arguments[0])
+    return pc
+
+
+def execute_lget(command: Command, pc: int) -> int:
+    # Local (frame slot) GET, or the global slot if empty
+    value: Optional[Value] = slot_frames[-1][command.slot]
+    if value is None:
+        value = global_slots[command.global_slot]
+    push(value if value is not None else get_nil_value())
+    return pc
+
+
+def execute_gget(command: Command, pc: int) -> int:
+    # Global (slot) GET
+    value: Optional[Value] = global_slots[command.global_slot]
+    push(value if value is not None else get_nil_value())
+    return pc
+
+
+def execute_lput(command: Command, pc: int) -> int:
+    # Local (frame slot) PUT
+    slot_frames[-1][command.slot] = pop(command)
+    return pc
+
+
+def execute_gput(command: Command, pc: int) -> int:
+    # Global (slot) PUT
+    global_slots[command.global_slot] = pop(command)
+    return pc
+
+
+def execute_adfr(command: Command, pc: int) -> int:
+    # ADd FRame
+    slot_frames.append([None] * command.slot)
+    return pc
+
+
+def execute_args(command: Command, pc: int) -> int:
+    # ARGumentS, popped into the first frame slots up to the LIM value
+    limit: int = len(execution_stack) - 1
+    while limit >= 0 and execution_stack[limit].type != Types.LIM:
+        limit -= 1
+    if limit < 0:
+        nambly_error(f"Execution stack empty for command: {command}")
+    for value in execution_stack[limit + 1:]:
+        if value.type in (Types.NIL, Types.ITR):
+            # Like the ARRR that builds $_ in the other call convention
+            nambly_error(f"Cannot add a {value.type.name} value to a table. This error may trigger if you are passing a nil value to a function or a table constructor.")
+    arguments: List[Value] = execution_stack[limit + 1:limit + 1 + command.slot]
+    slot_frames[-1][:len(arguments)] = arguments
+    del execution_stack[limit:]
+    return pc
+
+
+def execute_dlfr(command: Command, pc: int) -> int:
+    # DeLete FRame
+    if not slot_frames:
+        nambly_error("No more frames left.")
+    slot_frames.pop()
+    return pc
+
+
+def execute_ldel(command: Command, pc: int) -> int:
+    # Local (frame slot) DELete, or the global slot if empty
+    if slot_frames[-1][command.slot] is not None:
+        slot_frames[-1][command.slot] = None
+    else:
+        global_slots[command.global_slot] = None
+    return pc
+
+
+def execute_gdel(command: Command, pc: int) -> int:
+    # Global (slot) DELete
+    global_slots[command.global_slot] = None
+    return pc
+
+
+def execute_lnxt_gnxt(command: Command, pc: int) -> int:
+    # NEXT on a slot
+    iterator: Optional[Value] = slot_frames[-1][command.slot] if "LNXT" == command.command else None
+    if iterator is None:
+        iterator = global_slots[command.global_slot]
+    push(next_iterator_value(iterator))
+    return pc
+
+
+def execute_pnil(command: Command, pc: int) -> int:
+    push(get_nil_value())
+    return pc
+
+
+def execute_plim(command: Command, pc: int) -> int:
+    # Push LIMit for ARRR
+    result_value = Value()
+    result_value.value = None
+    result_value.type = Types.LIM
+    push(result_value)
+    return pc
+
+
+def apply_addv(com_1: Value, com_2: Value) -> Value:
+    value_2: Union[float|int] = com_2.get_as_number()
+    value_1: Union[float|int] = com_1.get_as_number()
+    if com_1.type == Types.FLO or com_2.type == Types.FLO:
+        return Value(value_1 + value_2, Types.FLO)
+    return make_int(value_1 + value_2)
+
+
+def execute_addv(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_addv(com_1, com_2))
+    return pc
+
+
+def apply_subt(com_1: Value, com_2: Value) -> Value:
+    value_2: Union[float|int] = com_2.get_as_number()
+    value_1: Union[float|int] = com_1.get_as_number()
+    if com_1.type == Types.FLO or com_2.type == Types.FLO:
+        return Value(value_1 - value_2, Types.FLO)
+    return make_int(value_1 - value_2)
+
+
+def execute_subt(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_subt(com_1, com_2))
+    return pc
+
+
+def apply_mult(com_1: Value, com_2: Value) -> Value:
+    value_2: Union[float|int] = com_2.get_as_number()
+    value_1: Union[float|int] = com_1.get_as_number()
+    if com_1.type == Types.FLO or com_2.type == Types.FLO:
+        return Value(value_1 * value_2, Types.FLO)
+    return make_int(value_1 * value_2)
+
+
+def execute_mult(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_mult(com_1, com_2))
+    return pc
+
+
+def apply_fdiv(com_1: Value, com_2: Value) -> Value:
+    value_2: Union[float|int] = com_2.get_as_number()
+    value_1: Union[float|int] = com_1.get_as_number()
+    return Value(float(value_1) / float(value_2), Types.FLO)
+
+
+def execute_fdiv(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_fdiv(com_1, com_2))
+    return pc
+
+
+def apply_idiv(com_1: Value, com_2: Value) -> Value:
+    # floor(a / b), like the C++ NariVM
+    value_2: Union[float|int] = com_2.get_as_number()
+    value_1: Union[float|int] = com_1.get_as_number()
+    return make_int(math.floor(value_1 / value_2))
+
+
+def execute_idiv(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_idiv(com_1, com_2))
+    return pc
+
+
+def apply_powr(com_1: Value, com_2: Value) -> Value:
+    value_2: Union[float|int] = com_2.get_as_number()
+    value_1: Union[float|int] = com_1.get_as_number()
+    if com_1.type == Types.FLO or com_2.type == Types.FLO:
+        return Value(value_1 ** value_2, Types.FLO)
+    return make_int(value_1 ** value_2)
+
+
+def execute_powr(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_powr(com_1, com_2))
+    return pc
+
+
+def apply_modl(com_1: Value, com_2: Value) -> Value:
+    # (int)floor(a) % (int)floor(b), like the C++ NariVM, so the sign follows the dividend
+    value_2: int = math.floor(com_2.get_as_number())
+    value_1: int = math.floor(com_1.get_as_number())
+    if value_2 == 0:
+        raise ZeroDivisionError()
+    return make_int(int(math.fmod(value_1, value_2)))
+
+
+def execute_modl(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_modl(com_1, com_2))
+    return pc
+
+
+def apply_isgt(com_1: Value, com_2: Value) -> Value:
+    value_2: Union[float|int] = com_2.get_as_number()
+    value_1: Union[float|int] = com_1.get_as_number()
+    return make_boolean(value_1 > value_2)
+
+
+def execute_isgt(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_isgt(com_1, com_2))
+    return pc
+
+
+def apply_islt(com_1: Value, com_2: Value) -> Value:
+    value_2: Union[float|int] = com_2.get_as_number()
+    value_1: Union[float|int] = com_1.get_as_number()
+    return make_boolean(value_1 < value_2)
+
+
+def execute_islt(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_islt(com_1, com_2))
+    return pc
+
+
+def apply_isge(com_1: Value, com_2: Value) -> Value:
+    value_2: Union[float|int] = com_2.get_as_number()
+    value_1: Union[float|int] = com_1.get_as_number()
+    return make_boolean(value_1 >= value_2)
+
+
+def execute_isge(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_isge(com_1, com_2))
+    return pc
+
+
+def apply_isle(com_1: Value, com_2: Value) -> Value:
+    value_2: Union[float|int] = com_2.get_as_number()
+    value_1: Union[float|int] = com_1.get_as_number()
+    return make_boolean(value_1 <= value_2)
+
+
+def execute_isle(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_isle(com_1, com_2))
+    return pc
+
+
+def values_equal(com_1: Value, com_2: Value) -> bool:
+    """Returns if ISEQ finds two values equal.
     """
-    pc: int = 0
-    while pc < len(code_listing):
-        command: Command = code_listing[pc]
-        if "PUSH" == command.command:
-            push(command.arguments[0])
-        elif "PNIL" == command.command:
-            result_value = Value()
-            result_value.value = None
-            result_value.type = Types.NIL
-            push(result_value)
-        elif "ADDV" == command.command:
-            com_2: Value = pop(command)
-            com_1: Value = pop(command)
-            value_2: Union[float|int] = com_2.get_as_number()
-            value_1: Union[float|int] = com_1.get_as_number()
-            result_value = Value()
-            result_value.value = value_1 + value_2
-            if com_1.type == Types.FLO or com_2.type == Types.FLO:
-                result_value.type = Types.FLO
-            else:
-                result_value.type = Types.INT 
-            push(result_value)
-        elif "SUBT" == command.command:
-            com_2: Value = pop(command)
-            com_1: Value = pop(command)
-            value_2: Union[float|int] = com_2.get_as_number()
-            value_1: Union[float|int] = com_1.get_as_number()
-            result_value = Value()
-            result_value.value = value_1 - value_2
-            if com_1.type == Types.FLO or com_2.type == Types.FLO:
-                result_value.type = Types.FLO
-            else:
-                result_value.type = Types.INT 
-            push(result_value)
-        elif "MULT" == command.command:
-            com_2: Value = pop(command)
-            com_1: Value = pop(command)
-            value_2: Union[float|int] = com_2.get_as_number()
-            value_1: Union[float|int] = com_1.get_as_number()
-            result_value = Value()
-            result_value.value = value_1 * value_2
-            if com_1.type == Types.FLO or com_2.type == Types.FLO:
-                result_value.type = Types.FLO
-            else:
-                result_value.type = Types.INT 
-            push(result_value)
-        elif "FDIV" == command.command:
-            value_2: Union[float|int] = pop(command).get_as_number()
-            value_1: Union[float|int] = pop(command).get_as_number()
-            result_value = Value()
-            result_value.value = float(value_1) / float(value_2)
-            result_value.type = Types.FLO
-            push(result_value)
-        elif "IDIV" == command.command:
-            value_2: Union[float|int] = pop(command).get_as_number()
-            value_1: Union[float|int] = pop(command).get_as_number()
-            result_value = Value()
-            result_value.value = int(value_1) // int(value_2)
-            result_value.type = Types.INT
-            push(result_value)
-        elif "POWR" == command.command:
-            com_2: Value = pop(command)
-            com_1: Value = pop(command)
-            value_2: Union[float|int] = com_2.get_as_number()
-            value_1: Union[float|int] = com_1.get_as_number()
-            result_value = Value()
-            result_value.value = value_1 ** value_2
-            if com_1.type == Types.FLO or com_2.type == Types.FLO:
-                result_value.type = Types.FLO
-            else:
-                result_value.type = Types.INT 
-            push(result_value)
-        elif "MODL" == command.command:
-            value_2: Union[float|int] = pop(command).get_as_number()
-            value_1: Union[float|int] = pop(command).get_as_number()
-            result_value = Value()
-            result_value.value = int(value_1) % int(value_2)
-            result_value.type = Types.INT
-            push(result_value)
-        elif "ISGT" == command.command:
-            com_2: Value = pop(command)
-            com_1: Value = pop(command)
-            value_2: Union[float|int] = com_2.get_as_number()
-            value_1: Union[float|int] = com_1.get_as_number()
-            result_value = Value()
-            result_value.type = Types.INT
-            result_value.value = 0
-            if value_1 > value_2:
-                result_value.value = 1
-            push(result_value)
-        elif "ISLT" == command.command:
-            com_2: Value = pop(command)
-            com_1: Value = pop(command)
-            value_2: Union[float|int] = com_2.get_as_number()
-            value_1: Union[float|int] = com_1.get_as_number()
-            result_value = Value()
-            result_value.type = Types.INT
-            result_value.value = 0
-            if value_1 < value_2:
-                result_value.value = 1
-            push(result_value)
-        elif "ISGE" == command.command:
-            com_2: Value = pop(command)
-            com_1: Value = pop(command)
-            value_2: Union[float|int] = com_2.get_as_number()
-            value_1: Union[float|int] = com_1.get_as_number()
-            result_value = Value()
-            result_value.type = Types.INT
-            result_value.value = 0
-            if value_1 >= value_2:
-                result_value.value = 1
-            push(result_value)
-        elif "ISLE" == command.command:
-            com_2: Value = pop(command)
-            com_1: Value = pop(command)
-            value_2: Union[float|int] = com_2.get_as_number()
-            value_1: Union[float|int] = com_1.get_as_number()
-            result_value = Value()
-            result_value.type = Types.INT
-            result_value.value = 0
-            if value_1 <= value_2:
-                result_value.value = 1
-            push(result_value)
-        elif "ISEQ" == command.command:
-            com_2: Value = pop(command)
-            com_1: Value = pop(command)
-            result_value = Value()
-            result_value.type = Types.INT
-            result_value.value = 0
-            if com_1.type == Types.NIL or com_2.type == Types.NIL:
-                result_value.value = 0
-            elif com_1.type == Types.TAB and com_2.type == Types.TAB:
-                if com_1.value == com_2.value: # By reference
-                    result_value.value = 1
-            elif com_1.type == Types.TXT and com_2.type == Types.TXT:
-                if com_1.value == com_2.value:
-                    result_value.value = 1
-            elif com_1.type == Types.INT and com_2.type == Types.INT:
-                if com_1.value == com_2.value:
-                    result_value.value = 1
-            elif com_1.type == Types.FLO and com_2.type == Types.FLO:
-                if math.isclose(com_1.value, com_2.value):
-                    result_value.value = 1
-            else:
-                # Default to numeric comparison
-                value_2: Union[float|int] = com_2.get_as_number()
-                value_1: Union[float|int] = com_1.get_as_number()
-                if isinstance(value_1, int) and isinstance(value_2, int):
-                    if value_1 == value_2:
-                        result_value.value = 1
-                    elif math.isclose(value_1, value_2):
-                        result_value.value = 1
-            push(result_value)
-        elif "ISNE" == command.command:
-            com_2: Value = pop(command)
-            com_1: Value = pop(command)
-            result_value = Value()
-            result_value.type = Types.INT
-            result_value.value = 0
-            if com_1.type == Types.NIL or com_2.type == Types.NIL:
-                result_value.value = 1
-            elif com_1.type == Types.TAB and com_2.type == Types.TAB:
-                if com_1.value == com_2.value: # By reference
-                    result_value.value = 1
-            elif com_1.type == Types.TXT and com_2.type == Types.TXT:
-                if com_1.value == com_2.value:
-                    result_value.value = 1
-            elif com_1.type == Types.INT and com_2.type == Types.INT:
-                if com_1.value == com_2.value:
-                    result_value.value = 1
-            elif com_1.type == Types.FLO and com_2.type == Types.FLO:
-                if math.isclose(com_1.value, com_2.value):
-                    result_value.value = 1
-            else:
-                # Default to numeric comparison
-                value_2: Union[float|int] = com_2.get_as_number()
-                value_1: Union[float|int] = com_1.get_as_number()
-                if isinstance(value_1, int) and isinstance(value_2, int):
-                    if value_1 == value_2:
-                        result_value.value = 1
-                    elif math.isclose(value_1, value_2):
-                        result_value.value = 1
-            if result_value.value == 1:
-                result_value.value = 0
-            else:
-                result_value.value = 1
-            push(result_value)
-        elif "VSET" == command.command:
-            set_variable(command.arguments[0].value, pop(command))
-        elif "GSET" == command.command:  # Global (variable) SET
-            set_global_variable(command.arguments[0].value, pop(command))
-        elif "VGET" == command.command:
-            value: Optional[Value] = get_variable(command.arguments[0].value)
-            if value:
-                push(value)
-            else:
-                result_value = Value()
-                result_value.value = None
-                result_value.type = Types.NIL
-                push(result_value)
-        elif "JOIN" == command.command:
-            value_2: str = pop(command).get_as_string()
-            value_1: str = pop(command).get_as_string()
-            result_value = Value()
-            result_value.value = value_1 + value_2
-            result_value.type = Types.TXT
-            push(result_value)
-        elif "SSTR" == command.command:  # SubSTRing
-            idx_count: str = int(pop(command).get_as_number())
-            idx_from: str = int(pop(command).get_as_number())
-            val_str: str = pop(command).get_as_string()
+    if com_1.type == Types.NIL or com_2.type == Types.NIL:
+        return False
+    elif com_1.type == Types.TAB and com_2.type == Types.TAB:
+        return com_1.value == com_2.value # By reference
+    elif com_1.type == Types.TXT and com_2.type == Types.TXT:
+        return com_1.get_as_string() == com_2.get_as_string()
+    else:
+        # Default to numeric comparison, exact like in the C++ NariVM
+        return com_1.get_as_number() == com_2.get_as_number()
+
+
+def apply_iseq(com_1: Value, com_2: Value) -> Value:
+    return make_boolean(values_equal(com_1, com_2))
+
+
+def execute_iseq(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_iseq(com_1, com_2))
+    return pc
+
+
+def apply_isne(com_1: Value, com_2: Value) -> Value:
+    return make_boolean(not values_equal(com_1, com_2))
+
+
+def execute_isne(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_isne(com_1, com_2))
+    return pc
+
+
+def execute_vset(command: Command, pc: int) -> int:
+    set_variable(command.arguments[0].value, pop(command))
+    return pc
+
+
+def execute_gset(command: Command, pc: int) -> int:
+    # Global (variable) SET
+    set_global_variable(command.arguments[0].value, pop(command))
+    return pc
+
+
+def execute_vget(command: Command, pc: int) -> int:
+    value: Optional[Value] = get_variable(command.arguments[0].value)
+    if value:
+        push(value)
+    else:
+        result_value = get_nil_value()
+        push(result_value)
+    return pc
+
+
+def apply_join(com_1: Value, com_2: Value) -> Value:
+    text: str = com_2.get_as_string()
+    if type(com_1.value) is TextBuilder:
+        return Value(com_1.value.append(text), Types.TXT)
+    start: str = com_1.get_as_string()
+    if len(start) < TEXT_BUILDER_MINIMUM:
+        return Value(start + text, Types.TXT)
+    return Value(TextBuilder([start, text], len(start) + len(text)), Types.TXT)
+
+
+def execute_join(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_join(com_1, com_2))
+    return pc
+
+
+def execute_sstr(command: Command, pc: int) -> int:
+    # SubSTRing
+    idx_count: str = int(pop(command).get_as_number())
+    idx_from: str = int(pop(command).get_as_number())
+    val_str: str = pop(command).get_as_string()
+    result_value = Value()
+    result_value.type = Types.TXT
+    if idx_from > 0:
+        idx_from -= 1
+    if idx_from >= len(val_str) or idx_count == 0:
+        result_value.value = ""
+        push(result_value)
+    else:
+        if idx_from < 0:
+            idx_from = len(val_str) + idx_from
+        if idx_from + idx_count >= len(val_str):
+            idx_count = len(val_str) - idx_from
+        result_value.value = val_str[idx_from:idx_from+idx_count]
+        push(result_value)
+    return pc
+
+
+def execute_repl(command: Command, pc: int) -> int:
+    # REPLace all instances
+    replacement: str = pop(command).get_as_string()
+    needle: str = pop(command).get_as_string()
+    haystack: str = pop(command).get_as_string()
+    result_value = Value()
+    result_value.type = Types.TXT
+    result_value.value = haystack.replace(needle, replacement) if needle else haystack
+    push(result_value)
+    return pc
+
+
+def execute_expl_mxpl(command: Command, pc: int) -> int:
+    # EXPLode, Multi eXPLode
+    haystack: str = pop(command).get_as_string()
+    delimiters: Value = pop(command)
+    max_splits: int = int(pop(command).get_as_number())
+    add_empties: bool = pop(command).get_as_number() == 1
+    if "EXPL" == command.command:
+        delimiter_list: List[str] = [delimiters.get_as_string()]
+    elif delimiters.type != Types.TAB:
+        nambly_error("Delimiters for a multiexplode must be a table.")
+    else:
+        delimiter_list = [delimiter.get_as_string() for delimiter in delimiters.value.values()]
+    tokens: List[Value] = [Value(token, Types.TXT) for token in split_text(haystack, delimiter_list, max_splits, add_empties)]
+    push(Value(Table(tokens), Types.TAB))
+    return pc
+
+
+def execute_jump(command: Command, pc: int) -> int:
+    return command.branch_target - 1
+
+
+def execute_call(command: Command, pc: int) -> int:
+    return_stack.append(pc)
+    return command.branch_target - 1
+
+
+def execute_rtrn(command: Command, pc: int) -> int:
+    if not return_stack:
+        nambly_error("Empty return stack.")
+    return return_stack.pop()
+
+
+def is_false(value_1: Value) -> bool:
+    """Returns if JPIF jumps on a value.
+    """
+    if value_1.type in (Types.INT, Types.FLO):
+        return value_1.value == 0
+    elif value_1.type == Types.NIL:
+        return True
+    elif value_1.type in (Types.TAB, Types.TXT):
+        return len(value_1.value) == 0
+    nambly_error(f"Cannot check if value {value_1} of type {value_1.type} is false.")
+
+
+def execute_jpif(command: Command, pc: int) -> int:
+    # JumP If False
+    if is_false(pop(command)):
+        pc = command.branch_target - 1
+    return pc
+
+
+def next_range_value(iterator: Value) -> Optional[Value]:
+    """Takes the next number out of a range iterator, or returns None once the range is over.
+    """
+    if iterator.type != Types.ITR or not isinstance(iterator.value, RangePosition):
+        nambly_error("Cannot RNXT a non-range iterator.")
+    position: RangePosition = iterator.value
+    if position.next > position.last:
+        return None
+    result_value: Value = make_int(position.next) if isinstance(position.next, int) else Value(position.next, Types.FLO)
+    position.next += 1
+    return result_value
+
+
+def execute_rnxt(command: Command, pc: int) -> int:
+    # Range NeXT, or jump once the range is over
+    value: Optional[Value] = next_range_value(pop(command))
+    if value is None:
+        pc = command.branch_target - 1
+    else:
+        push(value)
+    return pc
+
+
+def execute_pnxt(command: Command, pc: int) -> int:
+    # Pair NeXT: pushes the next key and its value, or jumps once there are none left
+    pair: Optional[Tuple[Value, Value]] = next_iterator_pair(pop(command))
+    if pair is None:
+        pc = command.branch_target - 1
+    else:
+        push(pair[0])
+        push(pair[1])
+    return pc
+
+
+def execute_tabl(command: Command, pc: int) -> int:
+    push(Value(Table(), Types.TAB))
+    return pc
+
+
+def execute_pset(command: Command, pc: int) -> int:
+    value: Value = pop(command)
+    index: Value = pop(command)
+    table: Value = pop(command)
+    if index.type == Types.INT:
+        table.value.set_index(index.value, value)
+    else:
+        table.value.set(index.get_as_string(), value)
+    return pc
+
+
+def execute_arrr(command: Command, pc: int) -> int:
+    # ARRRay, like the pirates - Create array until a LIM value is found
+    array_values: List[Value] = []
+    # Pop values until we find the list limit
+    while True:
+        value: Value = pop(command)
+        if value.type == Types.LIM:
+            break
+        elif value.type in (Types.NIL, Types.ITR):
+            nambly_error(f"Cannot add a {value.type.name} value to a table. This error may trigger if you are passing a nil value to a function or a table constructor.")
+        else:
+            array_values.append(value)
+    # The values were popped last to first
+    array_values.reverse()
+    push(Value(Table(array_values), Types.TAB))
+    return pc
+
+
+def execute_dupl(command: Command, pc: int) -> int:
+    push(execution_stack[-1])
+    return pc
+
+
+def apply_pget(table: Value, index: Value) -> Value:
+    if table.type == Types.TAB:
+        if index.type == Types.INT:
+            value: Optional[Value] = table.value.get_index(index.value)
+        else:
+            value = table.value.get(index.get_as_string())
+        return value if value is not None else get_nil_value()
+    index_value = index.get_as_string()
+    if table.type == Types.NIL:
+        nambly_error(f"Trying to index a nil value.")
+    else:
+        string_value = table.get_as_string()
+        if get_token_type(index_value) != Types.INT:
+            nambly_error(f"Cannot index {string_value} with non-integer value {index_value}.")
+        else:
             result_value = Value()
             result_value.type = Types.TXT
-            if idx_from > 0:
-                idx_from -= 1
-            if idx_from >= len(val_str) or idx_count == 0:
+            idx: int = int(index_value)
+            if idx > 0:
+                idx -= 1
+            if idx >= len(string_value):
                 result_value.value = ""
-                push(result_value)
+                return result_value
             else:
-                if idx_from < 0:
-                    idx_from = len(val_str) + idx_from
-                if idx_from + idx_count >= len(val_str):
-                    idx_count = len(val_str) - idx_from
-                result_value.value = val_str[idx_from:idx_from+idx_count]
-                push(result_value)
-        elif "JUMP" == command.command:
-            pc = label_to_pc[command.arguments[0].value] - 1
-        elif "CALL" == command.command:
+                if idx < 0:
+                    idx = len(string_value) + idx
+                if idx < 0:
+                    result_value.value = ""
+                    return result_value
+                else:
+                    result_value.value = string_value[idx]
+                    return result_value
+
+
+def execute_pget(command: Command, pc: int) -> int:
+    index: Value = pop(command)
+    table: Value = pop(command)
+    push(apply_pget(table, index))
+    return pc
+
+
+def apply_isnil(value: Value) -> Value:
+    # check if value is NIL?
+    return make_boolean(value.type == Types.NIL)
+
+
+def execute_isnil(command: Command, pc: int) -> int:
+    value: Value = pop(command)
+    push(apply_isnil(value))
+    return pc
+
+
+def execute_disp(command: Command, pc: int) -> int:
+    value: Value = pop(command)
+    display(value)
+    return pc
+
+
+def execute_accp(command: Command, pc: int) -> int:
+    prompt: str = pop(command).get_as_string()
+    result_value = Value()
+    try:
+        result_value.type = Types.TXT
+        result_value.value = input(prompt if sys.stdin.isatty() else "")
+    except (EOFError, KeyboardInterrupt):
+        result_value.type = Types.NIL
+        result_value.value = None
+    push(result_value)
+    return pc
+
+
+def execute_popv(command: Command, pc: int) -> int:
+    if execution_stack:
+        pop(command)
+    return pc
+
+
+def execute_exit(command: Command, pc: int) -> int:
+    exit(int(pop(command).get_as_number()))
+    return pc
+
+
+def execute_unst(command: Command, pc: int) -> int:
+    # UNSeT
+    delete_variable(command.arguments[0].value)
+    return pc
+
+
+def execute_pust(command: Command, pc: int) -> int:
+    # Position UnSeT
+    index = pop(command).get_as_string()
+    table = pop(command)
+    table.value.delete(index)
+    return pc
+
+
+def execute_rfil(command: Command, pc: int) -> int:
+    # Read FILe
+    filename = pop(command)
+    with open(filename.get_as_string(), "r") as file:
+        result_value = Value()
+        result_value.value = file.read()
+        result_value.type = Types.TXT
+        push(result_value)
+    return pc
+
+
+def execute_forw(command: Command, pc: int) -> int:
+    # File Open Read Write
+    filename = pop(command)
+    str_filename = filename.get_as_string()
+    if str_filename in open_files:
+        open_files[str_filename].close()
+    try:
+        file = open(str_filename, "r+")
+        open_files[str_filename] = file
+    except:
+        pop(command)
+        # Replace filename with nil value
+        result_value = get_nil_value()
+        push(result_value)
+    return pc
+
+
+def execute_fora(command: Command, pc: int) -> int:
+    # File Open Read Append
+    filename = pop(command)
+    str_filename = filename.get_as_string()
+    if str_filename in open_files:
+        open_files[str_filename].close()
+    try:
+        file = open(str_filename, "a+")
+        open_files[str_filename] = file
+    except:
+        pop(command)
+        # Replace filename with nil value
+        result_value = get_nil_value()
+        push(result_value)
+    return pc
+
+
+def execute_fore(command: Command, pc: int) -> int:
+    # File Open REad
+    filename = pop(command)
+    str_filename = filename.get_as_string()
+    if str_filename in open_files:
+        open_files.pop(str_filename).close()
+    try:
+        open_files[str_filename] = open(str_filename, "r")
+    except OSError:
+        pass
+    return pc
+
+
+def execute_fcls(command: Command, pc: int) -> int:
+    # File CLoSe
+    filename = pop(command)
+    str_filename = filename.get_as_string()
+    if str_filename in open_files:
+        open_files.pop(str_filename).close()
+    return pc
+
+
+def execute_isop(command: Command, pc: int) -> int:
+    # IS file OPen?
+    filename = pop(command)
+    result_value = Value()
+    result_value.type = Types.INT
+    result_value.value = 1 if filename.get_as_string() in open_files else 0
+    push(result_value)
+    return pc
+
+
+def execute_rlne(command: Command, pc: int) -> int:
+    # Read LiNE
+    filename = pop(command)
+    str_filename = filename.get_as_string()
+    if str_filename not in open_files:
+        nambly_error(f"File '{str_filename}' is not open.")
+    line: str = open_files[str_filename].readline()
+    result_value = Value()
+    result_value.value = line
+    result_value.type = Types.TXT
+    push(result_value)
+    return pc
+
+
+def execute_fwrt(command: Command, pc: int) -> int:
+    # File WRiTe
+    filename = pop(command)
+    str_filename = filename.get_as_string()
+    if str_filename not in open_files:
+        nambly_error(f"File '{str_filename}' is not open.")
+    contents = pop(command)
+    str_contents = contents.get_as_string()
+    open_files[str_filename].write(str_contents)
+    open_files[str_filename].flush()
+    return pc
+
+
+def apply_lnot(com_1: Value) -> Value:
+    # Logic NOT
+    if com_1.type == Types.NIL:
+        return make_boolean(True)
+    elif com_1.type in (Types.TAB, Types.TXT):
+        return make_boolean(len(com_1.value) == 0)
+    elif com_1.type == Types.INT:
+        return make_boolean(com_1.value == 0)
+    elif com_1.type == Types.FLO:
+        return make_boolean(math.isclose(com_1.value, 0))
+    nambly_error(f"Unknown type: {com_1.type}")
+
+
+def execute_lnot(command: Command, pc: int) -> int:
+    com_1: Value = pop(command)
+    push(apply_lnot(com_1))
+    return pc
+
+
+def apply_trim(string: Value) -> Value:
+    return Value(string.get_as_string().strip(), Types.TXT)
+
+
+def execute_trim(command: Command, pc: int) -> int:
+    string: Value = pop(command)
+    push(apply_trim(string))
+    return pc
+
+
+def apply_slen(string: Value) -> Value:
+    # String Length (or table length)
+    if string.type == Types.NIL:
+        nambly_error(f"You cannot get the length of a nil value")
+    elif string.type == Types.TAB:
+        return make_int(len(string.value))
+    return make_int(len(string.get_as_string()))
+
+
+def execute_slen(command: Command, pc: int) -> int:
+    string: Value = pop(command)
+    push(apply_slen(string))
+    return pc
+
+
+def execute_swap(command: Command, pc: int) -> int:
+    v2 = pop(command)
+    v1 = pop(command)
+    push(v2)
+    push(v1)
+    return pc
+
+
+def apply_land(com_1: Value, com_2: Value) -> Value:
+    return make_boolean(is_true(com_1) and is_true(com_2))
+
+
+def execute_land(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_land(com_1, com_2))
+    return pc
+
+
+def apply_lgor(com_1: Value, com_2: Value) -> Value:
+    return make_boolean(is_true(com_1) or is_true(com_2))
+
+
+def execute_lgor(command: Command, pc: int) -> int:
+    com_2: Value = pop(command)
+    com_1: Value = pop(command)
+    push(apply_lgor(com_1, com_2))
+    return pc
+
+
+def apply_isin(value: Value, container: Value) -> Value:
+    if container.type == Types.TAB:
+        return make_boolean(value.get_as_string() in container.value)
+    return make_boolean(value.get_as_string() in container.get_as_string())
+
+
+def execute_isin(command: Command, pc: int) -> int:
+    container: Value = pop(command)
+    value: Value = pop(command)
+    push(apply_isin(value, container))
+    return pc
+
+
+def apply_flor(com_1: Value) -> Value:
+    # FLOoR
+    return make_int(math.floor(com_1.get_as_number()))
+
+
+def execute_flor(command: Command, pc: int) -> int:
+    com_1: Value = pop(command)
+    push(apply_flor(com_1))
+    return pc
+
+
+def execute_adsc(command: Command, pc: int) -> int:
+    # ADd SCope
+    variable_tables.append({})
+    return pc
+
+
+def execute_dlsc(command: Command, pc: int) -> int:
+    # DeLete SCope
+    if variable_tables:
+        variable_tables.pop()
+    else:
+        nambly_error("No more scopes left.")
+    return pc
+
+
+def execute_exec(command: Command, pc: int) -> int:
+    # EXECute Subprocess
+    com_1: Value = pop(command)
+    output, error, exit_code = run_subprocess(com_1.get_as_string())
+    exit_code_value = Value()
+    exit_code_value.value = int(exit_code)
+    exit_code_value.type = Types.INT 
+    stderr_value = Value()
+    stderr_value.value = error
+    stderr_value.type = Types.TXT 
+    stdout_value = Value()
+    stdout_value.value = output
+    stdout_value.type = Types.TXT 
+    push(exit_code_value)
+    push(stderr_value)
+    push(stdout_value)
+    return pc
+
+
+def execute_wait(command: Command, pc: int) -> int:
+    time.sleep(pop(command).get_as_number())
+    return pc
+
+
+def execute_keys(command: Command, pc: int) -> int:
+    # Pushes all keys of a dict to the stack
+    value = pop(command)
+    if value.type != Types.TAB:
+        nambly_error(f"Cannot get keys of a non-table value.")
+    # In the order of the std::map the C++ NariVM keeps them in
+    push(Value(Table([Value(key, Types.TXT) for key in sorted(value.value.keys())]), Types.TAB))
+    return pc
+
+
+def execute_gitr(command: Command, pc: int) -> int:
+    # Get iterator
+    table = pop(command)
+    if table.type == Types.TAB:
+        if table.value.hash:
+            push(Value(KeyPosition(table.value, len(table.value), table.value.get_sorted_keys()), Types.ITR))
+        else:
+            push(Value(KeyPosition(table.value, len(table.value.array)), Types.ITR))
+    elif table.type in (Types.TXT, Types.INT, Types.FLO):
+        text: str = table.get_as_string()
+        push(Value(KeyPosition(text, len(text)), Types.ITR))
+    else:
+        nambly_error(f"Cannot iterate over non-iterable values.")
+    return pc
+
+
+def apply_ritr(first: Value, last: Value) -> Value:
+    # Range ITeRator
+    result_value = Value()
+    result_value.type = Types.ITR
+    result_value.value = RangePosition(first.get_as_number(), last.get_as_number())
+    return result_value
+
+
+def execute_ritr(command: Command, pc: int) -> int:
+    last: Value = pop(command)
+    first: Value = pop(command)
+    push(apply_ritr(first, last))
+    return pc
+
+
+def execute_next(command: Command, pc: int) -> int:
+    iterator: Optional[Value] = get_variable(command.arguments[0].value)
+    if not iterator:
+        nambly_error(f"The iterator {command.arguments[0].value} doesn't exist.")
+    push(next_iterator_value(iterator))
+    return pc
+
+def execute_unknown(command: Command, pc: int) -> int:
+    nambly_error(f"Unknown Nambly command: {command}")
+    return pc
+
+
+# Handler of each Nambly command, indexed by the opcode number the loaders store in each command
+COMMAND_HANDLERS: Dict[str, Callable[[Command, int], int]] = {
+    "PUSH": execute_push,
+    "LGET": execute_lget,
+    "GGET": execute_gget,
+    "LPUT": execute_lput,
+    "GPUT": execute_gput,
+    "ADFR": execute_adfr,
+    "ARGS": execute_args,
+    "DLFR": execute_dlfr,
+    "LDEL": execute_ldel,
+    "GDEL": execute_gdel,
+    "LNXT": execute_lnxt_gnxt,
+    "GNXT": execute_lnxt_gnxt,
+    "PNIL": execute_pnil,
+    "PLIM": execute_plim,
+    "ADDV": execute_addv,
+    "SUBT": execute_subt,
+    "MULT": execute_mult,
+    "FDIV": execute_fdiv,
+    "IDIV": execute_idiv,
+    "POWR": execute_powr,
+    "MODL": execute_modl,
+    "ISGT": execute_isgt,
+    "ISLT": execute_islt,
+    "ISGE": execute_isge,
+    "ISLE": execute_isle,
+    "ISEQ": execute_iseq,
+    "ISNE": execute_isne,
+    "VSET": execute_vset,
+    "GSET": execute_gset,
+    "VGET": execute_vget,
+    "JOIN": execute_join,
+    "SSTR": execute_sstr,
+    "REPL": execute_repl,
+    "EXPL": execute_expl_mxpl,
+    "MXPL": execute_expl_mxpl,
+    "JUMP": execute_jump,
+    "CALL": execute_call,
+    "RTRN": execute_rtrn,
+    "JPIF": execute_jpif,
+    "RNXT": execute_rnxt,
+    "PNXT": execute_pnxt,
+    "TABL": execute_tabl,
+    "PSET": execute_pset,
+    "ARRR": execute_arrr,
+    "DUPL": execute_dupl,
+    "PGET": execute_pget,
+    "NIL?": execute_isnil,
+    "DISP": execute_disp,
+    "ACCP": execute_accp,
+    "POPV": execute_popv,
+    "EXIT": execute_exit,
+    "UNST": execute_unst,
+    "PUST": execute_pust,
+    "RFIL": execute_rfil,
+    "FORW": execute_forw,
+    "FORA": execute_fora,
+    "FORE": execute_fore,
+    "FCLS": execute_fcls,
+    "ISOP": execute_isop,
+    "RLNE": execute_rlne,
+    "FWRT": execute_fwrt,
+    "LNOT": execute_lnot,
+    "TRIM": execute_trim,
+    "SLEN": execute_slen,
+    "SWAP": execute_swap,
+    "LAND": execute_land,
+    "LGOR": execute_lgor,
+    "ISIN": execute_isin,
+    "FLOR": execute_flor,
+    "ADSC": execute_adsc,
+    "DLSC": execute_dlsc,
+    "EXEC": execute_exec,
+    "WAIT": execute_wait,
+    "KEYS": execute_keys,
+    "GITR": execute_gitr,
+    "RITR": execute_ritr,
+    "NEXT": execute_next,
+}
+OPCODE_NUMBERS: Dict[str, int] = {name: number for number, name in enumerate(COMMAND_HANDLERS)}
+UNKNOWN_OPCODE: int = len(OPCODE_NUMBERS)
+OPCODE_HANDLERS: List[Callable[[Command, int], int]] = list(COMMAND_HANDLERS.values()) + [execute_unknown]
+
+
+def execute_code_listing(code_listing: List[Command]):
+    """Executes a code listing, calling the handler of each command through its opcode number.
+    Handlers get the PC of their command and return it, or the PC before the one to jump to.
+    """
+    handlers: List[Callable[[Command, int], int]] = OPCODE_HANDLERS
+    pc: int = 0
+    try:
+        while pc < len(code_listing):
+            command: Command = code_listing[pc]
+            pc = handlers[command.opcode](command, pc) + 1
+    except NamblyError as error:
+        error.pc = pc
+        raise
+    except ZeroDivisionError:
+        error = NamblyError("Division by zero.")
+        error.pc = pc
+        raise error
+
+
+def compile_closure(command: Command, pc: int) -> Callable[[], Optional[int]]:
+    """Compiles a command into a closure with its operands already bound. The closures of
+    commands that can jump return the PC to go to next, the rest return nothing.
+    """
+    append = execution_stack.append
+    next_pc: int = pc + 1
+    target: int = command.branch_target
+    if "PUSH" == command.command:
+        value: Value = command.arguments[0]
+        return lambda: append(value)
+    elif "LGET" == command.command:
+        slot: int = command.slot
+        global_slot: int = command.global_slot
+        def closure():
+            value: Optional[Value] = slot_frames[-1][slot]
+            if value is None:
+                value = global_slots[global_slot]
+            append(value if value is not None else get_nil_value())
+        return closure
+    elif "GGET" == command.command:
+        global_slot: int = command.global_slot
+        def closure():
+            value: Optional[Value] = global_slots[global_slot]
+            append(value if value is not None else get_nil_value())
+        return closure
+    elif "LPUT" == command.command:
+        slot: int = command.slot
+        def closure():
+            slot_frames[-1][slot] = pop(command)
+        return closure
+    elif "GPUT" == command.command:
+        global_slot: int = command.global_slot
+        def closure():
+            global_slots[global_slot] = pop(command)
+        return closure
+    elif "VGET" == command.command:
+        name: str = sys.intern(command.arguments[0].value)
+        def closure():
+            value: Optional[Value] = get_variable(name)
+            append(value if value else get_nil_value())
+        return closure
+    elif "VSET" == command.command:
+        name: str = sys.intern(command.arguments[0].value)
+        def closure():
+            variable_tables[-1][name] = pop(command)
+        return closure
+    elif "DUPL" == command.command:
+        return lambda: append(execution_stack[-1])
+    elif "JUMP" == command.command:
+        return lambda: target
+    elif "JPIF" == command.command:
+        return lambda: target if is_false(pop(command)) else next_pc
+    elif "CALL" == command.command:
+        def closure():
             return_stack.append(pc)
-            pc = label_to_pc[command.arguments[0].value] - 1
-        elif "RTRN" == command.command:
+            return target
+        return closure
+    elif "RTRN" == command.command:
+        def closure():
             if not return_stack:
                 nambly_error("Empty return stack.")
-            pc = return_stack.pop()
-        elif "JPIF" == command.command:  #JumP If False
-            value_1 = pop(command)
-            if value_1.type in (Types.INT, Types.FLO):
-                if value_1.value == 0:
-                    pc = label_to_pc[command.arguments[0].value] - 1
-            elif value_1.type == Types.NIL:
-                pc = label_to_pc[command.arguments[0].value] - 1
-            elif value_1.type == Types.TAB:
-                if len(value_1.value) == 0:
-                    pc = label_to_pc[command.arguments[0].value] - 1
-            elif value_1.type == Types.TXT:
-                if len(value_1.value) == 0:
-                    pc = label_to_pc[command.arguments[0].value] - 1
-            else:
-                nambly_error(f"Cannot check if value {value_1} of type {value_1.type} is false.")
-        elif "TABL" == command.command:
-            result_value = Value()
-            result_value.value = {}
-            result_value.type = Types.TAB
-            push(result_value)
-        elif "PSET" == command.command:
-            value: Value = pop(command)
-            index: Value = pop(command)
-            table: Value = pop(command)
-            table.value[index.get_as_string()] = value
-        elif "ARRR" == command.command:  # ARRRay, like the pirates - Create array until NIL value is found
-            # Create array table
-            result_value = Value()
-            result_value.value = {}
-            result_value.type = Types.TAB
-            array_values: List[Value] = []
-            # Pop values until we find a nil
-            while True:
-                value: Value = pop(command)
-                if value.type == Types.NIL:
-                    break
-                else:
-                    array_values.append(value)
-            # Add the values to the array in reverse order
-            arr_index: int = 0
-            for value in array_values:
-                result_value.value[str(len(array_values) - arr_index)] = value
-                arr_index += 1
-            push(result_value)
-        elif "DUPL" == command.command:
-            push(execution_stack[-1])
-        elif "PGET" == command.command:
-            index_value = pop(command).get_as_string()
-            table = pop(command)
-            if table.type == Types.TAB:
-                if index_value in table.value:
-                    push(table.value[index_value])
-                else:
-                    result_value = Value()
-                    result_value.value = None
-                    result_value.type = Types.NIL
-                    push(result_value)
-            elif table.type == Types.NIL:
-                nambly_error(f"Trying to index a nil value.")
-            else:
-                string_value = table.get_as_string()
-                if get_token_type(index_value) != Types.INT:
-                    nambly_error(f"Cannot index {string_value} with non-integer value {index_value}.")
-                else:
-                    result_value = Value()
-                    result_value.type = Types.TXT
-                    idx: int = int(index_value)
-                    if idx > 0:
-                        idx -= 1
-                    if idx >= len(string_value):
-                        result_value.value = ""
-                        push(result_value)
-                    else:
-                        if idx < 0:
-                            idx = len(string_value) + idx
-                        if idx < 0:
-                            result_value.value = ""
-                            push(result_value)
-                        else:
-                            result_value.value = string_value[idx]
-                            push(result_value)
-        elif "NIL?" == command.command:  # check if value is NIL?
-            value = pop(command)
-            result_value = Value()
-            result_value.value = 0
-            result_value.type = Types.INT
-            if value.type == Types.NIL:
-                result_value.value = 1
-            push(result_value)
-        elif "DISP" == command.command:
-            value: Value = pop(command)
-            display(value)
-        elif "ACCP" == command.command:
-            result_value = Value()
-            try:
-                result_value.type = Types.TXT
-                result_value.value = input()
-            except (EOFError, KeyboardInterrupt):
-                result_value.type = Types.NIL
-                result_value.value = None
-            push(result_value)
-        elif "POPV" == command.command:
-            if execution_stack:
-                pop(command)
-        elif "EXIT" == command.command:
-            exit(int(pop(command).get_as_number()))
-        elif "UNST" == command.command:  #UNSeT
-            delete_variable(command.arguments[0].value)
-        elif "PUST" == command.command: #Position UnSeT
-            index = pop(command).get_as_string()
-            table = pop(command)
-            if index in table.value:
-                del table.value[index]
-        elif "RFIL" == command.command: #Read FILe
-            filename = pop(command)
-            with open(filename.get_as_string(), "r") as file:
-                result_value = Value()
-                result_value.value = file.read()
-                result_value.type = Types.TXT
-                push(result_value)
-        elif "FORW" == command.command: #File Open Read Write
-            filename = pop(command)
-            str_filename = filename.get_as_string()
-            if str_filename in open_files:
-                open_files[str_filename].close()
-            try:
-                file = open(str_filename, "r+")
-                open_files[str_filename] = file
-            except:
-                pop(command)
-                # Replace filename with nil value
-                result_value = Value()
-                result_value.value = None
-                result_value.type = Types.NIL
-                push(result_value)
-        elif "FORA" == command.command: #File Open Read Append
-            filename = pop(command)
-            str_filename = filename.get_as_string()
-            if str_filename in open_files:
-                open_files[str_filename].close()
-            try:
-                file = open(str_filename, "a+")
-                open_files[str_filename] = file
-            except:
-                pop(command)
-                # Replace filename with nil value
-                result_value = Value()
-                result_value.value = None
-                result_value.type = Types.NIL
-                push(result_value)
-        elif "FCLS" == command.command: #File CLoSe
-            filename = pop(command)
-            str_filename = filename.get_as_string()
-            if str_filename in open_files:
-                open_files[str_filename].close()
-        elif "RLNE" == command.command: #Read LiNE
-            filename = pop(command)
-            str_filename = filename.get_as_string()
-            if str_filename not in open_files:
-                nambly_error(f"File '{str_filename}' is not open.")
-            line: str = open_files[str_filename].readline()
-            result_value = Value()
-            result_value.value = line
-            result_value.type = Types.TXT
-            push(result_value)
-        elif "FWRT" == command.command: #File WRiTe
-            filename = pop(command)
-            str_filename = filename.get_as_string()
-            if str_filename not in open_files:
-                nambly_error(f"File '{str_filename}' is not open.")
-            contents = pop(command)
-            str_contents = contents.get_as_string()
-            line: str = open_files[str_filename].write(str_contents)
-        elif "LNOT" == command.command:  # Logic NOT
-            com_1: Value = pop(command)
-            result_value = Value()
-            result_value.type = Types.INT
-            result_value.value = 0
-            if com_1.type == Types.NIL:
-                result_value.value = 1
-            elif com_1.type == Types.TAB:
-                if len(com_1.value) > 0:
-                    result_value.value = 0
-                else:
-                    result_value.value = 1
-            elif com_1.type == Types.TXT:
-                if len(com_1.value) > 0:
-                    result_value.value = 0
-                else:
-                    result_value.value = 1
-            elif com_1.type == Types.INT:
-                if com_1.value == 0:
-                    result_value.value = 1
-                else:
-                    result_value.value = 0
-            elif com_1.type == Types.FLO:
-                if math.isclose(com_1.value, 0):
-                    result_value.value = 1
-                else:
-                    result_value.value = 0
-            else:
-                nambly_error(f"Unknown type: {com_1.type}")
-            push(result_value)
-        elif "TRIM" == command.command:
-            string = pop(command)
-            result_value = Value()
-            result_value.value = string.get_as_string().strip()
-            result_value.type = Types.TXT
-            push(result_value)
-        elif "SLEN" == command.command:  # String Length (or table length)
-            string = pop(command)
-            result_value = Value()
-            result_value.type = Types.INT
-            if string.type == Types.NIL:
-                nambly_error(f"You cannot get the length of a nil value")
-            elif string.type == Types.TAB:
-                result_value.value = len(string.value)
-            else:
-                result_value.value = len(string.get_as_string())
-            push(result_value)
-        elif "SWAP" == command.command:
-            v2 = pop(command)
-            v1 = pop(command)
-            push(v2)
-            push(v1)
-        elif "LAND" == command.command:
-            com_2: Value = pop(command)
-            com_1: Value = pop(command)
-            result_value = Value()
-            result_value.type = Types.INT
-            result_value.value = 0
-            if is_true(com_1) and is_true(com_2):
-                result_value.value = 1
-            push(result_value)
-        elif "LGOR" == command.command:
-            com_2: Value = pop(command)
-            com_1: Value = pop(command)
-            result_value = Value()
-            result_value.type = Types.INT
-            result_value.value = 0
-            if is_true(com_1) or is_true(com_2):
-                result_value.value = 1
-            push(result_value)
-        elif "ISIN" == command.command:
-            container: Value = pop(command)
-            value: Value = pop(command)
-            result_value = Value()
-            result_value.type = Types.INT
-            result_value.value = 0
-            if container.type == Types.TAB:
-                if value.get_as_string() in container.value:
-                    result_value.value = 1
-            else:
-                if value.get_as_string() in container.get_as_string():
-                    result_value.value = 1
-            push(result_value)
-        elif "FLOR" == command.command:  # FLOoR
-            com_1: Value = pop(command)
-            result_value = Value()
-            result_value.value = math.floor(com_1.get_as_number())
-            result_value.type = Types.INT 
-            push(result_value)
-        elif "ADSC" == command.command:  # ADd SCope
-            variable_tables.append({})
-        elif "DLSC" == command.command:  # DeLete SCope
-            if variable_tables:
-                variable_tables.pop()
-            else:
-                nambly_error("No more scopes left.")
-        elif "EXEC" == command.command:  # EXECute Subprocess
-            com_1: Value = pop(command)
-            output, error, exit_code = run_subprocess(com_1.get_as_string())
-            exit_code_value = Value()
-            exit_code_value.value = int(exit_code)
-            exit_code_value.type = Types.INT 
-            stderr_value = Value()
-            stderr_value.value = error
-            stderr_value.type = Types.TXT 
-            stdout_value = Value()
-            stdout_value.value = output
-            stdout_value.type = Types.TXT 
-            push(exit_code_value)
-            push(stderr_value)
-            push(stdout_value)
-        elif "WAIT" == command.command:
-            time.sleep(pop(command).get_as_number())
-        elif "KEYS" == command.command:  # Pushes all keys of a dict to the stack
-            value = pop(command)
-            if value.type != Types.TAB:
-                nambly_error(f"Cannot get keys of a non-table value.")
-            result_value = Value()
-            result_value.type = Types.TAB
-            result_value.value = {}
-            ind: int = 1
-            for key in value.value:
-                key_value = Value()
-                key_value.type = Types.TXT
-                key_value.value = str(key)
-                result_value.value[str(ind)] = key_value
-                ind += 1
-            push(result_value)
-        elif "GITR" == command.command:  # Get iterator
-            table = pop(command)
-            result_value = Value()
-            result_value.type = Types.ITR
-            if table.type == Types.TAB:
-                result_value.value = list(table.value.keys())
-            elif table.type in (Types.TXT, Types.INT, Types.FLO):
-                iterable_value = table.get_as_string()
-                result_value.value = [str(i + 1) for i in range(0, len(iterable_value))]
+            return return_stack.pop() + 1
+        return closure
+    handler: Callable[[Command, int], int] = OPCODE_HANDLERS[command.opcode]
+    if command.command in BLOCK_ENDING_COMMANDS:
+        return lambda: handler(command, pc) + 1
+    return partial(handler, command, pc)
+
+
+# (PC and closure of each command but the last one, PC of the last command, closure that runs it)
+BasicBlock = Tuple[Tuple[Tuple[int, Callable[[], None]], ...], int, Callable[[], int]]
+
+
+def compile_basic_blocks(code_listing: List[Command]) -> List[Optional[BasicBlock]]:
+    """Splits a code listing into basic blocks of closures, stored at the PC of their first
+    command. The closure of the last command of a block returns the PC to go to next.
+    """
+    block_starts: Set[int] = {0}
+    for pc, command in enumerate(code_listing):
+        if command.command in BLOCK_ENDING_COMMANDS:
+            block_starts.add(pc + 1)
+            if command.branch_target >= 0:
+                block_starts.add(command.branch_target)
+    blocks: List[Optional[BasicBlock]] = [None] * len(code_listing)
+    body: List[Tuple[int, Callable[[], None]]] = []
+    for pc, command in enumerate(code_listing):
+        closure = compile_closure(command, pc)
+        if pc + 1 not in block_starts and pc + 1 < len(code_listing):
+            body.append((pc, closure))
+            continue
+        if command.command not in BLOCK_ENDING_COMMANDS:
+            closure = partial(run_and_continue, closure, pc + 1)
+        blocks[pc - len(body)] = (tuple(body), pc, closure)
+        body = []
+    return blocks
+
+
+def run_and_continue(closure: Callable[[], None], next_pc: int) -> int:
+    closure()
+    return next_pc
+
+
+def execute_threaded_code(code_listing: List[Command]):
+    """Executes a code listing compiled into closures, running each basic block without
+    going back to the main loop.
+    """
+    blocks = compile_basic_blocks(code_listing)
+    pc: int = 0
+    try:
+        while pc < len(blocks):
+            body, last_pc, last_closure = blocks[pc]
+            for pc, closure in body:
+                closure()
+            pc = last_pc
+            pc = last_closure()
+    except NamblyError as error:
+        error.pc = pc
+        raise
+    except ZeroDivisionError:
+        error = NamblyError("Division by zero.")
+        error.pc = pc
+        raise error
+
+
+# Inline code for commands that took the given types, the type of its result if known and whether it is a Python bool
+TRACE_FAST_PATHS: Dict[Tuple[str, Tuple[Types, ...]], Tuple[str, Optional[Types], bool]] = {
+    ("ADDV", (Types.INT, Types.INT)): ("make_int({0}.value + {1}.value)", Types.INT, False),
+    ("SUBT", (Types.INT, Types.INT)): ("make_int({0}.value - {1}.value)", Types.INT, False),
+    ("MULT", (Types.INT, Types.INT)): ("make_int({0}.value * {1}.value)", Types.INT, False),
+    ("ISGT", (Types.INT, Types.INT)): ("{0}.value > {1}.value", None, True),
+    ("ISLT", (Types.INT, Types.INT)): ("{0}.value < {1}.value", None, True),
+    ("ISGE", (Types.INT, Types.INT)): ("{0}.value >= {1}.value", None, True),
+    ("ISLE", (Types.INT, Types.INT)): ("{0}.value <= {1}.value", None, True),
+    ("ISEQ", (Types.INT, Types.INT)): ("{0}.value == {1}.value", None, True),
+    ("ISNE", (Types.INT, Types.INT)): ("{0}.value != {1}.value", None, True),
+    ("ISEQ", (Types.TXT, Types.TXT)): ("{0}.get_as_string() == {1}.get_as_string()", None, True),
+    ("ISNE", (Types.TXT, Types.TXT)): ("{0}.get_as_string() != {1}.get_as_string()", None, True),
+    ("LNOT", (Types.INT,)): ("{0}.value == 0", None, True),
+    ("JOIN", (Types.TXT, Types.TXT)): ("Value({0}.value + {1}.value, TYPE_TXT) if type({0}.value) is str and type({1}.value) is str "
+                                       "and len({0}.value) < TEXT_BUILDER_MINIMUM else apply_join({0}, {1})", Types.TXT, False),
+    ("PGET", (Types.TAB, Types.TXT)): ("{0}.value.get({1}.get_as_string()) or get_nil_value()", None, False),
+    ("PGET", (Types.TAB, Types.INT)): ("{0}.value.get_index({1}.value) or get_nil_value()", None, False),
+}
+TraceEntry = Tuple[int, Tuple[Types, ...], int]  # PC, types of the values the command took and PC it went to
+
+
+def record_trace(code_listing: List[Command], head: int, back_edge: int) -> Tuple[Optional[List[TraceEntry]], int]:
+    """Runs one iteration of the loop that starts at head and jumps back to it from back_edge,
+    recording the commands it goes through and the types of the values they take. Returns the
+    trace, or None if the iteration called a function, ran an inner loop or left the loop, and
+    the PC to go on from.
+    """
+    handlers: List[Callable[[Command, int], int]] = OPCODE_HANDLERS
+    trace: List[TraceEntry] = []
+    pc: int = head
+    try:
+        while True:
+            command: Command = code_listing[pc]
+            if command.command in ("CALL", "RTRN") or len(trace) == TRACE_LENGTH_LIMIT:
+                return None, pc
+            operand_count: int = TRACE_OPERAND_COUNTS.get(command.command, 0)
+            types: Tuple[Types, ...] = ()
+            if len(execution_stack) >= operand_count > 0:
+                types = tuple([value.type for value in execution_stack[-operand_count:]])
+            next_pc: int = handlers[command.opcode](command, pc) + 1
+            trace.append((pc, types, next_pc))
+            if next_pc == head:
+                return trace, next_pc
+            if next_pc <= pc or next_pc > back_edge:
+                return None, next_pc
+            pc = next_pc
+    except NamblyError as error:
+        error.pc = pc
+        raise
+    except ZeroDivisionError:
+        error = NamblyError("Division by zero.")
+        error.pc = pc
+        raise error
+
+
+class TraceCompiler:
+    """Turns the trace of a loop into a Python function that runs the loop over and over along
+    the path the trace took. Values stay in local variables instead of the execution stack and
+    the commands that took the types the trace saw run inline, after a guard that checks those
+    types. If a guard fails or a jump goes another way, the function pushes its values to the
+    execution stack and returns the PC the main loop goes on from.
+    """
+    def __init__(self, code_listing: List[Command], trace: List[TraceEntry]) -> None:
+        self.code_listing: List[Command] = code_listing
+        self.trace: List[TraceEntry] = trace
+        self.lines: List[str] = []
+        self.line_pcs: Dict[int, int] = {}  # Line of the function -> PC of the command it runs
+        self.pending: List[Tuple[str, bool]] = []  # Values not on the execution stack yet, True for Python bools
+        self.known_types: Dict[str, Types] = {}  # Type of the local variables and constants known when compiling
+        self.temporary_count: int = 0
+        self.namespace: Dict[str, Any] = dict(globals())
+        for value_type in Types:
+            self.namespace[f"TYPE_{value_type.name}"] = value_type
+        self.pc: int = 0
+
+    def compile(self) -> Callable[[], int]:
+        commands: List[str] = [self.code_listing[pc].command for pc, _, _ in self.trace]
+        frame: str = "slot_frames[-1]" if "ADFR" in commands or "DLFR" in commands else "frame"
+        self.pc = self.trace[0][0]
+        self.emit(0, "def trace():")
+        if frame == "frame" and any(command in ("LGET", "LPUT") for command in commands):
+            self.emit(1, "frame = slot_frames[-1]")
+        self.emit(1, "while True:")
+        for pc, types, next_pc in self.trace:
+            self.pc = pc
+            self.compile_command(self.code_listing[pc], types, next_pc, frame)
+        self.flush()
+        self.namespace["TRACE_PCS"] = self.line_pcs
+        exec(compile("\n".join(self.lines) + "\n", f"<trace of PC {self.trace[0][0]}>", "exec"), self.namespace)
+        return self.namespace["trace"]
+
+    def emit(self, indentation: int, code: str) -> None:
+        self.lines.append("    " * indentation + code)
+        self.line_pcs[len(self.lines)] = self.pc
+
+    def temporary(self) -> str:
+        self.temporary_count += 1
+        return f"t{self.temporary_count}"
+
+    def bind(self, prefix: str, value: Any) -> str:
+        name: str = f"{prefix}{self.pc}"
+        self.namespace[name] = value
+        return name
+
+    def get_value(self, operand: Tuple[str, bool]) -> str:
+        """Returns an expression for an operand as a Value, building one from it if it's a Python bool.
+        """
+        expression, is_condition = operand
+        if not is_condition:
+            return expression
+        temporary: str = self.temporary()
+        self.emit(2, f"{temporary} = make_boolean({expression})")
+        self.known_types[temporary] = Types.INT
+        return temporary
+
+    def need(self, count: int) -> None:
+        """Makes sure the top values of the stack the next command takes are local variables.
+        """
+        while len(self.pending) < count:
+            temporary: str = self.temporary()
+            self.emit(2, f"{temporary} = pop({self.bind('c', self.code_listing[self.pc])})")
+            self.pending.insert(0, (temporary, False))
+
+    def flush(self) -> None:
+        values: List[str] = [self.get_value(operand) for operand in self.pending]
+        if values:
+            self.emit(2, f"execution_stack.extend(({', '.join(values)},))")
+        self.pending = []
+
+    def emit_exit(self, condition: str, pc: int, counter: str, extra_values: Tuple[str, ...] = ()) -> None:
+        """Emits the code that leaves the trace, going on from a PC, if a condition holds.
+        """
+        self.emit(2, f"if {condition}:")
+        values: List[str] = [f"make_boolean({expression})" if is_condition else expression for expression, is_condition in self.pending]
+        values += extra_values
+        if values:
+            self.emit(3, f"execution_stack.extend(({', '.join(values)},))")
+        self.emit(3, f'trace_counters["{counter}"] += 1')
+        self.emit(3, f"return {pc}")
+
+    def guard(self, operands: List[str], types: Tuple[Types, ...]) -> None:
+        """Emits a guard that leaves the trace before the current command if its operands don't
+        have the types the trace saw.
+        """
+        checks: List[str] = [f"{operand}.type is not TYPE_{value_type.name}" for operand, value_type in zip(operands, types) if self.known_types.get(operand) != value_type]
+        if checks:
+            self.emit_exit(" or ".join(checks), self.pc, "guard failures")
+        for operand, value_type in zip(operands, types):
+            self.known_types[operand] = value_type
+
+    def push_value(self, expression: str, value_type: Optional[Types] = None) -> None:
+        temporary: str = self.temporary()
+        self.emit(2, f"{temporary} = {expression}")
+        if value_type is not None:
+            self.known_types[temporary] = value_type
+        self.pending.append((temporary, False))
+
+    def compile_command(self, command: Command, types: Tuple[Types, ...], next_pc: int, frame: str) -> None:
+        name: str = command.command
+        operand_count: int = TRACE_OPERAND_COUNTS.get(name, 0)
+        if operand_count:
+            self.need(operand_count)
+        if name == "PUSH":
+            constant: str = self.bind("k", command.arguments[0])
+            self.known_types[constant] = command.arguments[0].type
+            self.pending.append((constant, False))
+        elif name == "PNIL":
+            self.push_value("get_nil_value()", Types.NIL)
+        elif name == "LGET":
+            self.push_value(f"{frame}[{command.slot}] or global_slots[{command.global_slot}] or get_nil_value()")
+        elif name == "GGET":
+            self.push_value(f"global_slots[{command.global_slot}] or get_nil_value()")
+        elif name == "VGET":
+            self.push_value(f"get_variable({command.arguments[0].value!r}) or get_nil_value()")
+        elif name in ("LPUT", "GPUT", "VSET", "DISP"):
+            self.need(1)
+            value: str = self.get_value(self.pending.pop())
+            if name == "LPUT":
+                self.emit(2, f"{frame}[{command.slot}] = {value}")
+            elif name == "GPUT":
+                self.emit(2, f"global_slots[{command.global_slot}] = {value}")
+            elif name == "VSET":
+                self.emit(2, f"variable_tables[-1][{command.arguments[0].value!r}] = {value}")
             else:
-                nambly_error(f"Cannot iterate over non-iterable values.")
-            push(result_value)
-        elif "NEXT" == command.command:
-            iterator: Optional[Value] = get_variable(command.arguments[0].value)
-            if not iterator:
-                nambly_error(f"The iterator {command.arguments[0].value} doesn't exist.")
-            if iterator.type != Types.ITR:
-                nambly_error("Cannot NEXT a non-iterator.")
-            result_value = Value()
-            if iterator.value:
-                result_value.value = iterator.value.pop(0)
-                result_value.type = Types.TXT
+                self.emit(2, f"display({value})")
+        elif name == "DUPL":
+            self.need(1)
+            self.pending.append(self.pending[-1])
+        elif name == "SWAP":
+            self.need(2)
+            self.pending[-1], self.pending[-2] = self.pending[-2], self.pending[-1]
+        elif name == "POPV":
+            if self.pending:
+                self.pending.pop()
             else:
-                # print(f"Deleting {command.arguments[0].value}")
-                # delete_variable(command.arguments[0].value)
-                result_value.value = None
-                result_value.type = Types.NIL
-            push(result_value)
+                self.emit(2, "if execution_stack:")
+                self.emit(3, "execution_stack.pop()")
+        elif name == "JUMP":
+            pass
+        elif name == "JPIF":
+            self.compile_jpif(command, types, next_pc)
+        elif name in ("RNXT", "PNXT"):
+            self.compile_rnxt_pnxt(command, next_pc)
+        elif operand_count:
+            self.compile_operation(command, types)
         else:
-            nambly_error(f"Unknown Nambly command: {command}")
-        pc += 1
+            self.flush()
+            self.emit(2, f"{self.bind('h', OPCODE_HANDLERS[command.opcode])}({self.bind('c', command)}, {self.pc})")
+
+    def compile_operation(self, command: Command, types: Tuple[Types, ...]) -> None:
+        """Compiles a command that takes values and pushes its result, inline if the trace saw
+        it take types it has a fast path for.
+        """
+        name: str = command.command
+        count: int = TRACE_OPERAND_COUNTS[name]
+        if name == "LNOT" and self.pending[-1][1]:
+            self.pending[-1] = (f"not ({self.pending[-1][0]})", True)
+            return
+        operands: List[str] = [self.get_value(operand) for operand in self.pending[-count:]]
+        self.pending[-count:] = [(operand, False) for operand in operands]
+        fast_path: Optional[Tuple[str, Optional[Types], bool]] = TRACE_FAST_PATHS.get((name, types))
+        if fast_path is not None:
+            self.guard(operands, types)
+        del self.pending[-count:]
+        if name == "NIL?":
+            self.pending.append((f"{operands[0]}.type is TYPE_NIL", True))
+        elif fast_path is None:
+            self.push_value(f"apply_{name.lower()}({', '.join(operands)})")
+        elif fast_path[2]:
+            self.pending.append((fast_path[0].format(*operands), True))
+        else:
+            self.push_value(fast_path[0].format(*operands), fast_path[1])
+
+    def compile_jpif(self, command: Command, types: Tuple[Types, ...], next_pc: int) -> None:
+        self.need(1)
+        expression, is_condition = self.pending[-1]
+        if is_condition:
+            is_false: str = f"not ({expression})"
+        elif types == (Types.INT,):
+            self.guard([expression], types)
+            is_false = f"{expression}.value == 0"
+        else:
+            is_false = f"is_false({expression})"
+        self.pending.pop()
+        if command.branch_target == self.pc + 1:
+            return
+        if next_pc == command.branch_target:
+            self.emit_exit(f"not ({is_false})", self.pc + 1, "side exits")
+        else:
+            self.emit_exit(is_false, command.branch_target, "side exits")
+
+    def compile_rnxt_pnxt(self, command: Command, next_pc: int) -> None:
+        self.need(1)
+        iterator: str = self.get_value(self.pending.pop())
+        temporary: str = self.temporary()
+        if command.command == "RNXT":
+            self.emit(2, f"{temporary} = next_range_value({iterator})")
+            values: Tuple[str, ...] = (temporary,)
+        else:
+            self.emit(2, f"{temporary} = next_iterator_pair({iterator})")
+            values = (f"{temporary}[0]", f"{temporary}[1]")
+        if next_pc == command.branch_target:
+            self.emit_exit(f"{temporary} is not None", self.pc + 1, "side exits", values)
+        else:
+            self.emit_exit(f"{temporary} is None", command.branch_target, "side exits")
+            self.pending += [(value, False) for value in values]
+
+
+def trace_loop(code_listing: List[Command], head: int, back_edge: int, traces: Dict[int, Callable[[], int]], back_edge_counts: Dict[int, int]) -> int:
+    """Records a trace of a hot loop and compiles it. Returns the PC to go on from.
+    """
+    trace, pc = record_trace(code_listing, head, back_edge)
+    if trace is None:
+        trace_counters["traces aborted"] += 1
+        # Loops left while recording get another chance, the rest are never recorded again
+        back_edge_counts[back_edge] = 0 if pc < head or pc > back_edge else TRACE_THRESHOLD
+        return pc
+    traces[head] = TraceCompiler(code_listing, trace).compile()
+    trace_counters["traces compiled"] += 1
+    return pc
+
+
+def get_trace_pc(error: BaseException, pc: int) -> int:
+    """Returns the PC of the command a compiled trace was running when an error happened, or
+    the given PC if it didn't happen inside of a trace.
+    """
+    traceback: Optional[TracebackType] = error.__traceback__
+    while traceback is not None:
+        trace_pcs: Optional[Dict[int, int]] = traceback.tb_frame.f_globals.get("TRACE_PCS")
+        if trace_pcs is not None:
+            pc = trace_pcs.get(traceback.tb_lineno, pc)
+        traceback = traceback.tb_next
+    return pc
+
+
+def execute_traced_code(code_listing: List[Command]):
+    """Executes a code listing like execute_code_listing, counting how many times each JUMP goes
+    back to the start of its loop. Once a loop gets hot it is traced and compiled (see
+    TraceCompiler), and from then on its JUMPs run the compiled trace instead.
+    """
+    handlers: List[Callable[[Command, int], int]] = OPCODE_HANDLERS
+    jump_opcode: int = OPCODE_NUMBERS["JUMP"]
+    back_edge_counts: Dict[int, int] = {}
+    traces: Dict[int, Callable[[], int]] = {}  # Loop start PC -> compiled trace
+    pc: int = 0
+    try:
+        while pc < len(code_listing):
+            command: Command = code_listing[pc]
+            if command.opcode == jump_opcode and command.branch_target <= pc:
+                trace: Optional[Callable[[], int]] = traces.get(command.branch_target)
+                if trace is not None:
+                    pc = trace()
+                    continue
+                count: int = back_edge_counts.get(pc, 0) + 1
+                back_edge_counts[pc] = count
+                if count == TRACE_THRESHOLD:
+                    pc = trace_loop(code_listing, command.branch_target, pc, traces, back_edge_counts)
+                    continue
+            pc = handlers[command.opcode](command, pc) + 1
+    except NamblyError as error:
+        if error.pc is None:
+            error.pc = get_trace_pc(error, pc)
+        raise
+    except ZeroDivisionError as division_error:
+        error = NamblyError("Division by zero.")
+        error.pc = get_trace_pc(division_error, pc)
+        raise error
+
+
+def print_trace_counters() -> None:
+    for name, count in trace_counters.items():
+        print(f"Tracing: {count} {name}.", file=sys.stderr)
+
+
+def get_nil_value() -> Value:
+    return NIL_VALUE
+
+
+def make_int(number: int) -> Value:
+    """Returns an INT value, shared with every other user of the number if it's a small one.
+    Operations on texts that hold floats give floats, which become FLO values instead.
+    """
+    if type(number) is int and 0 <= number < SMALL_INTEGER_COUNT:
+        return SMALL_INTEGERS[number]
+    if type(number) is float:
+        return Value(number, Types.FLO)
+    return Value(number, Types.INT)
+
+
+def make_boolean(condition: bool) -> Value:
+    return SMALL_INTEGERS[1] if condition else SMALL_INTEGERS[0]
+
+
+def next_iterator_value(iterator: Optional[Value]) -> Value:
+    """Takes the next key out of an iterator, or returns nil if there are none left.
+    """
+    if iterator is None:
+        nambly_error("The iterator doesn't exist.")
+    if iterator.type != Types.ITR or not isinstance(iterator.value, KeyPosition):
+        nambly_error("Cannot NEXT a non-iterator.")
+    position: KeyPosition = iterator.value
+    if position.next > position.last:
+        return get_nil_value()
+    key: str = position.keys[position.next - 1] if position.keys is not None else str(position.next)
+    position.next += 1
+    return Value(key, Types.TXT)
+
+
+def next_iterator_pair(iterator: Value) -> Optional[Tuple[Value, Value]]:
+    """Takes the next key out of an iterator and returns it with its value (nil if it was
+    deleted), or returns None if there are none left.
+    """
+    if iterator.type != Types.ITR or not isinstance(iterator.value, KeyPosition):
+        nambly_error("Cannot PNXT a non-key iterator.")
+    position: KeyPosition = iterator.value
+    index: int = position.next
+    if index > position.last:
+        return None
+    position.next += 1
+    container: Union[Table, str] = position.container
+    if position.keys is not None:
+        key: str = position.keys[index - 1]
+        value: Optional[Value] = container.get(key)
+    elif isinstance(container, Table):
+        key = str(index)
+        value = container.get_index(index)
+    else:
+        key = str(index)
+        value = Value(container[index - 1], Types.TXT)
+    return Value(key, Types.TXT), value if value is not None else get_nil_value()
+
+
+def split_text(haystack: str, delimiters: List[str], max_splits: int, add_empties: bool) -> List[str]:
+    """Splits a text at the earliest of the delimiters each time, up to max_splits
+    times (-1 for no limit). Empty tokens are only kept if add_empties is set.
+    """
+    tokens: List[str] = []
+    start: int = 0
+    splits_done: int = 0
+    while splits_done != max_splits:
+        end: int = -1
+        found_delimiter: str = ""
+        for delimiter in delimiters:
+            position: int = haystack.find(delimiter, start) if delimiter else -1
+            if position != -1 and (end == -1 or position < end):
+                end = position
+                found_delimiter = delimiter
+        if end == -1:
+            break
+        if end > start or add_empties:
+            tokens.append(haystack[start:end])
+        start = end + len(found_delimiter)
+        splits_done += 1
+    if start < len(haystack) or add_empties:
+        tokens.append(haystack[start:])
+    return tokens
+
+
+def iterator_sort_key(key: str) -> Tuple[int, float, str]:
+    """Sorts table keys for iteration the way the C++ NariVM does: numeric keys first,
+    by value, and then every other key in lexicographical order.
+    """
+    try:
+        return (0, float(key), "")
+    except ValueError:
+        return (1, 0.0, key)
 
 
 def run_subprocess(command):
@@ -913,15 +2135,103 @@ def is_true(value: Value) -> bool:
         return False
 
 
-def nari_run(code: str) -> None:
-    """Executes a NariVM code.
+def make_constant(constant_type: int, text: str) -> Value:
+    """Builds the value of a constant from its type number and its text.
+    """
+    value = Value()
+    value.type = Types(constant_type)
+    value.value = text
+    if value.type == Types.INT:
+        value.value = int(text)
+    elif value.type == Types.FLO:
+        value.value = float(text)
+    return value
+
+
+def make_command(name: str, arguments: List[Value], slot: int = -1, global_slot: int = -1) -> Command:
+    """Builds a command outside of a code listing, for the handlers called by
+    programs transpiled to Python.
+    """
+    command: Command = Command()
+    command.command = name
+    command.arguments = arguments
+    command.opcode = OPCODE_NUMBERS.get(name, UNKNOWN_OPCODE)
+    command.slot = slot
+    command.global_slot = global_slot
+    return command
+
+
+def load_bytecode(data: bytes) -> List[Command]:
+    """Turns a NariVM bytecode (.nvb) program into a code listing. Jump targets
+    come already resolved and every constant is built once, from the constant pool.
+    """
+    magic, version = struct.unpack_from("<4sH", data, 0)
+    if magic != BYTECODE_MAGIC or version != BYTECODE_VERSION:
+        nambly_error("Not a NariVM bytecode file, or one made for another version.")
+    offset: int = 6
+    opcode_count: int = struct.unpack_from("<I", data, offset)[0]
+    offset += 4
+    opcode_names: List[str] = [data[offset + index * 4:offset + index * 4 + 4].decode() for index in range(opcode_count)]
+    offset += opcode_count * 4
+    constant_count: int = struct.unpack_from("<I", data, offset)[0]
+    offset += 4
+    constant_types: bytes = data[offset:offset + constant_count]
+    offset += constant_count
+    constant_sizes: Tuple[int, ...] = struct.unpack_from(f"<{constant_count}I", data, offset)
+    offset += constant_count * 4
+    constants: List[Value] = []
+    for constant_type, size in zip(constant_types, constant_sizes):
+        constants.append(make_constant(constant_type, data[offset:offset + size].decode()))
+        offset += size
+    command_count: int = struct.unpack_from("<I", data, offset)[0]
+    offset += 4
+    opcodes: bytes = data[offset:offset + command_count]
+    offset += command_count
+    operands: Tuple[int, ...] = struct.unpack_from(f"<{command_count}i", data, offset)
+    offset += command_count * 4
+    fallback_slot_count: int = struct.unpack_from("<I", data, offset)[0]
+    offset += 4
+    fallback_slots: Iterator[int] = iter(struct.unpack_from(f"<{fallback_slot_count}I", data, offset))
+    offset += fallback_slot_count * 4
+    line_count: int = struct.unpack_from("<I", data, offset)[0]
+    offset += 4
+    lines: Tuple[int, ...] = struct.unpack_from(f"<{line_count * 3}I", data, offset)
+    line_table[:] = [(lines[index], lines[index + 1], constants[lines[index + 2]].value) for index in range(0, line_count * 3, 3)]
+    code_listing: List[Command] = []
+    for opcode, operand in zip(opcodes, operands):
+        command: Command = Command()
+        command.command = opcode_names[opcode]
+        command.opcode = OPCODE_NUMBERS.get(command.command, UNKNOWN_OPCODE)
+        if command.command in BRANCH_COMMANDS:
+            command.branch_target = operand
+        elif command.command in GLOBAL_SLOT_COMMANDS:
+            command.global_slot = operand
+        elif command.command in FALLBACK_SLOT_COMMANDS:
+            command.slot = operand
+            command.global_slot = next(fallback_slots)
+        elif command.command in SLOT_COMMANDS:
+            command.slot = operand
+        elif operand >= 0:
+            command.arguments.append(constants[operand])
+        code_listing.append(command)
+    allocate_global_slots(code_listing)
+    return code_listing
+
+
+def run_code_listing(code_listing: List[Command], mode: str = "loop") -> None:
+    """Executes a code listing, reporting runtime errors with the source line they happened in.
+    The threaded mode compiles the listing into closures first, and the tracing one compiles
+    its hot loops.
     """
     try:
         debug: bool = False
         #sys.set_int_max_str_digits(1000000000)
-        code_listing: List[Command] = split_lines(code)
-        code_listing = generate_label_map(code_listing)
-        execute_code_listing(code_listing)
+        if mode == "threaded":
+            execute_threaded_code(code_listing)
+        elif mode == "tracing":
+            execute_traced_code(code_listing)
+        else:
+            execute_code_listing(code_listing)
         if debug:
             print_variable_tables()
             print_stack()
@@ -929,7 +2239,120 @@ def nari_run(code: str) -> None:
     except KeyboardInterrupt:
         print("Execution interrupted by user.")
         exit(1)
+    except NamblyError as error:
+        location: Optional[Tuple[int, str]] = None if error.pc is None else get_source_location(error.pc)
+        report_runtime_error(str(error), location, error.pc)
+
+
+def nari_run(code: str, mode: str = "loop") -> None:
+    """Executes a NariVM code.
+    """
+    try:
+        code_listing: List[Command] = split_lines(code)
+        code_listing = generate_label_map(code_listing)
+    except NamblyError as error:
+        report_runtime_error(str(error))
+    run_code_listing(code_listing, mode)
+
+
+def nari_run_bytecode(data: bytes, mode: str = "loop") -> None:
+    """Executes a NariVM bytecode program.
+    """
+    try:
+        code_listing: List[Command] = load_bytecode(data)
+    except (NamblyError, struct.error, ValueError) as error:
+        report_runtime_error(f"Invalid bytecode file: {error}")
+    run_code_listing(code_listing, mode)
+
+
+def run_python_program(program: CodeType) -> None:
+    """Executes a program transpiled to Python by kat.py, reporting runtime errors with the
+    source line they happened in. It runs on a thread with a large stack, as every Katalyn
+    call becomes a Python call.
+    """
+    namespace: Dict[str, Any] = {"__name__": "__katalyn__"}
+    outcome: List[BaseException] = []
+
+    def run_program() -> None:
+        try:
+            exec(program, namespace)
+            namespace["main"]()
+        except BaseException as error:
+            outcome.append(error)
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), PYTHON_RECURSION_LIMIT))
+    threading.stack_size(PYTHON_THREAD_STACK_SIZE)
+    thread = threading.Thread(target=run_program, daemon=True)
+    try:
+        thread.start()
+        thread.join()
+    except KeyboardInterrupt:
+        print("Execution interrupted by user.")
+        exit(1)
+    if not outcome:
+        return
+    error: BaseException = outcome[0]
+    if isinstance(error, ZeroDivisionError):
+        error = NamblyError("Division by zero.")
+        error.__traceback__ = outcome[0].__traceback__
+    if not isinstance(error, NamblyError):
+        raise error
+    # The deepest line of the program the error went through knows what it was compiled from
+    line: int = 0
+    traceback: Optional[TracebackType] = error.__traceback__
+    while traceback is not None:
+        if traceback.tb_frame.f_globals is namespace:
+            line = traceback.tb_lineno
+        traceback = traceback.tb_next
+    report_runtime_error(str(error), namespace.get("SOURCE_LINES", {}).get(line))
+
+
+def report_runtime_error(message: str, location: Optional[Tuple[int, str]] = None, pc: Optional[int] = None) -> None:
+    """Prints a runtime error to the standard error the way the C++ NariVM does, and exits.
+    """
+    sys.stdout.flush()
+    print(file=sys.stderr)
+    print("====== Oh no! Runtime Error! ======", file=sys.stderr)
+    print(wrap_text(message, 70), file=sys.stderr)
+    if location is not None and location[1]:
+        print(file=sys.stderr)
+        print("--- Source File Information --- ", file=sys.stderr)
+        print(f"- Source File: {location[1]}", file=sys.stderr)
+        print(f"- Source Line: {location[0]}", file=sys.stderr)
+    if pc is not None:
+        print(file=sys.stderr)
+        print("--- NariVM State Information --- ", file=sys.stderr)
+        print(f"- PC: {pc + 1}", file=sys.stderr)
+    exit(1)
+
+
+def wrap_text(text: str, max_line_length: int) -> str:
+    """Breaks a text into lines at the first space after max_line_length characters.
+    """
+    result: List[str] = []
+    line_length: int = 0
+    for char in text:
+        if char == " ":
+            if line_length >= max_line_length:
+                result.append("\n")
+                line_length = 0
+            elif line_length > 0:
+                result.append(" ")
+                line_length += 1
+        else:
+            result.append(char)
+            line_length = 0 if char == "\n" else line_length + 1
+    return "".join(result)
 
 
 if __name__ == "__main__":
-    nari_run(code)
+    mode: str = sys.argv[1][2:] if len(sys.argv) == 3 and sys.argv[1] in ("--threaded", "--tracing") else "loop"
+    if len(sys.argv) != 2 and mode == "loop":
+        print("Usage: narivm.py [--threaded | --tracing] <nambly or bytecode file>", file=sys.stderr)
+        exit(1)
+    with open(sys.argv[-1], "rb") as f:
+        program: bytes = f.read()
+    if program.startswith(BYTECODE_MAGIC):
+        nari_run_bytecode(program, mode)
+    else:
+        nari_run(program.decode(), mode)
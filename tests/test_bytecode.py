@@ -0,0 +1,92 @@
+"""Checks that programs keep their meaning when the compiler writes them as NariVM bytecode
+(.nvb) and the Python NariVM loads them back, both in memory and from the file kat.py -c
+writes, which old/narivm.py runs.
+"""
+
+from __future__ import annotations
+import os
+import shutil
+import subprocess
+import sys
+from typing import List
+
+import pytest
+
+TESTS_LOCATION = os.path.abspath(os.path.dirname(__file__))
+ROOT_LOCATION = os.path.dirname(TESTS_LOCATION)
+PROGRAMS_LOCATION = os.path.join(TESTS_LOCATION, "programs")
+KAT_LOCATION = os.path.join(ROOT_LOCATION, "kat.py")
+NARIVM_LOCATION = os.path.join(ROOT_LOCATION, "old", "narivm.py")
+BYTECODE_VMS = ("python", "threaded", "tracing")
+OPTIMIZATION_LEVELS = ("-O0", "-O1")
+PROGRAMS = sorted([name[:-len(".kat")] for name in os.listdir(PROGRAMS_LOCATION) if name.endswith(".kat")])
+
+sys.path.insert(0, ROOT_LOCATION)
+sys.path.insert(0, os.path.join(ROOT_LOCATION, "old"))
+import kat
+import narivm
+
+
+def run_kat(arguments: List[str], cwd: str) -> subprocess.CompletedProcess:
+    environment = dict(os.environ, XDG_CACHE_HOME=os.path.join(cwd, "cache"))
+    return subprocess.run([sys.executable, KAT_LOCATION] + arguments, cwd=cwd, env=environment, capture_output=True, text=True, timeout=300)
+
+
+def read_expected(program: str, extension: str) -> str:
+    path: str = os.path.join(PROGRAMS_LOCATION, f"{program}.{extension}")
+    if not os.path.exists(path):
+        return ""
+    with open(path) as f:
+        return f.read()
+
+
+def run_bytecode_file(name: str, cwd: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, NARIVM_LOCATION, f"{name}.nvb"], cwd=cwd, capture_output=True, text=True, timeout=300)
+
+
+def test_slots_survive_bytecode():
+    instructions: List[kat.Instruction] = [
+        kat.Instruction("ADFR", "70000"),
+        kat.Instruction("LPUT", "65536"),
+        kat.Instruction("LGET", "65536 40000"),
+        kat.Instruction("LDEL", "3 200000"),
+        kat.Instruction("GPUT", "100000"),
+        kat.Instruction("LNXT", "0 1"),
+    ]
+    code_listing: List[narivm.Command] = narivm.load_bytecode(kat.instructions_to_bytecode(instructions))
+    assert [(command.command, command.slot) for command in code_listing] == [
+        ("ADFR", 70000), ("LPUT", 65536), ("LGET", 65536), ("LDEL", 3), ("GPUT", -1), ("LNXT", 0)]
+    assert [command.global_slot for command in code_listing if command.command in ("LGET", "LDEL", "GPUT", "LNXT")] == [40000, 200000, 100000, 1]
+
+
+@pytest.mark.parametrize("vm", BYTECODE_VMS)
+def test_many_global_slots(vm: str, tmp_path):
+    # Every global gets a slot, so the local of double falls back to a global slot past 32767
+    lines: List[str] = [f"$g{index}: {index};" for index in range(33000)]
+    lines += ["def double noinline;", "    in $local: $_[1] * 2;", "    return $local + $g32999;", "ok;", "print(double(3));"]
+    (tmp_path / "globals.kat").write_text("\n".join(lines) + "\n")
+    result = run_kat(["-O0", "-n", f"--vm={vm}", "globals.kat"], str(tmp_path))
+    assert result.returncode == 0, result.stderr
+    assert result.stdout == "33005\n"
+    if vm == "python":
+        assert run_kat(["-O0", "-n", "-c", "globals.kat"], str(tmp_path)).returncode == 0
+        result = run_bytecode_file("globals", str(tmp_path))
+        assert result.returncode == 0, result.stderr
+        assert result.stdout == "33005\n"
+
+
+@pytest.mark.parametrize("optimization_level", OPTIMIZATION_LEVELS)
+@pytest.mark.parametrize("program", [program for program in PROGRAMS if "=== Katayln" not in read_expected(program, "out")])
+def test_program_from_bytecode_file(program: str, optimization_level: str, tmp_path):
+    # The modules the program imports come along with it
+    shutil.copytree(PROGRAMS_LOCATION, tmp_path, dirs_exist_ok=True)
+    result = run_kat([optimization_level, "-c", f"{program}.kat"], str(tmp_path))
+    assert result.returncode == 0, result.stdout + result.stderr
+    result = run_bytecode_file(program, str(tmp_path))
+    expected_error: str = read_expected(program, "err").strip()
+    assert result.stdout == read_expected(program, "out")
+    if expected_error:
+        assert result.returncode == 1
+        assert expected_error in result.stderr
+    else:
+        assert result.returncode == 0, result.stderr
@@ -0,0 +1,97 @@
+"""Checks the compilation cache: that compiled modules are reused until a file they were
+compiled from changes, and that old entries are pruned.
+"""
+
+from __future__ import annotations
+import os
+import sys
+import time
+from typing import List
+
+import pytest
+
+TESTS_LOCATION = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_LOCATION))
+import kat
+
+
+@pytest.fixture
+def cache_location(tmp_path, monkeypatch: pytest.MonkeyPatch) -> str:
+    location: str = str(tmp_path / "cache")
+    monkeypatch.setattr(kat, "CACHE_LOCATION", location)
+    return location
+
+
+def compile_file(path: str, monkeypatch: pytest.MonkeyPatch) -> str:
+    """Compiles a file like a new run of the compiler would, and returns its Nambly.
+    """
+    monkeypatch.setattr(kat, "global_compiler_state", kat.CompilerState())
+    return kat.instructions_to_nambly(kat.file_to_nambly(path))
+
+
+def write_file(path: str, code: str, modification_time: float = 0) -> None:
+    with open(path, "w") as f:
+        f.write(code)
+    if modification_time:
+        os.utime(path, (modification_time, modification_time))
+
+
+def test_modules_are_reused_until_an_import_changes(tmp_path, cache_location: str, monkeypatch: pytest.MonkeyPatch):
+    main_path: str = str(tmp_path / "main.kat")
+    library_path: str = str(tmp_path / "library.kat")
+    write_file(library_path, 'def greeting;\n    return "first";\nok;\n')
+    write_file(main_path, 'import "library.kat";\nprint(greeting());\n')
+    nambly: str = compile_file(main_path, monkeypatch)
+    entries: List[str] = sorted(os.listdir(cache_location))
+    assert entries and all(entry.startswith(kat.get_cache_prefix() + "-") for entry in entries)
+
+    def fail_to_compile(code: str, filename: str):
+        raise AssertionError(f"{filename} was compiled instead of loaded from the cache")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(kat, "code_to_nambly", fail_to_compile)
+        assert compile_file(main_path, monkeypatch) == nambly
+    assert sorted(os.listdir(cache_location)) == entries
+    write_file(library_path, 'def greeting;\n    return "second";\nok;\n')
+    changed_nambly: str = compile_file(main_path, monkeypatch)
+    assert '"second"' in changed_nambly and '"first"' not in changed_nambly
+
+
+def test_compiler_files_are_hashed_once(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(kat, "global_compiler_state", kat.CompilerState())
+    prefix: str = kat.get_cache_prefix()
+
+    def fail_to_open(*args, **kwargs):
+        raise AssertionError("The compiler was read again")
+
+    monkeypatch.setattr(kat, "open", fail_to_open, raising=False)
+    assert kat.get_cache_prefix() == prefix
+    assert len(prefix) == kat.CACHE_PREFIX_LENGTH
+
+
+def test_stale_entries_of_other_compilers_are_pruned_on_the_first_write(tmp_path, cache_location: str, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(kat, "global_compiler_state", kat.CompilerState())
+    os.makedirs(cache_location)
+    stale_time: float = time.time() - kat.CACHE_STALE_SECONDS - 60
+    write_file(os.path.join(cache_location, "0000000000000000-stale"), "x", stale_time)
+    write_file(os.path.join(cache_location, "0000000000000000-recent"), "x")
+    write_file(os.path.join(cache_location, f"{kat.get_cache_prefix()}-old"), "x", stale_time)
+    kat.store_cache_entry(os.path.join(cache_location, f"{kat.get_cache_prefix()}-new"), b"x")
+    assert sorted(os.listdir(cache_location)) == sorted(["0000000000000000-recent", f"{kat.get_cache_prefix()}-old", f"{kat.get_cache_prefix()}-new"])
+    # Later writes of the same run don't scan the cache again
+    write_file(os.path.join(cache_location, "0000000000000000-stale"), "x", stale_time)
+    kat.store_cache_entry(os.path.join(cache_location, f"{kat.get_cache_prefix()}-newer"), b"x")
+    assert "0000000000000000-stale" in os.listdir(cache_location)
+
+
+def test_least_recently_used_entries_are_pruned_over_the_size_limit(cache_location: str, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(kat, "global_compiler_state", kat.CompilerState())
+    monkeypatch.setattr(kat, "CACHE_SIZE_LIMIT", 100)
+    os.makedirs(cache_location)
+    now: float = time.time()
+    for age, name in ((300, "oldest"), (200, "older"), (100, "newest")):
+        write_file(os.path.join(cache_location, f"{kat.get_cache_prefix()}-{name}"), "x" * 60, now - age)
+    # Loading an entry counts as using it
+    kat.mark_cache_entry_used(os.path.join(cache_location, f"{kat.get_cache_prefix()}-oldest"))
+    kat.prune_cache()
+    assert sorted(os.listdir(cache_location)) == [f"{kat.get_cache_prefix()}-oldest"]
@@ -0,0 +1,26 @@
+"""Checks what inlining leaves behind in the programs it optimizes.
+"""
+
+from __future__ import annotations
+import os
+import sys
+from typing import List, Set
+
+import pytest
+
+TESTS_LOCATION = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_LOCATION))
+import kat
+
+
+def test_copies_share_their_variables(monkeypatch: pytest.MonkeyPatch):
+    # Every copy used to get variables of its own, which at the top level became globals
+    code: str = "def add_scaled;\n    in $scaled: $_[2] * 10;\n    return $_[1] + $scaled;\nok;\n"
+    code += "".join([f"print(add_scaled({index}, 1));\n" for index in range(500)])
+    monkeypatch.setattr(kat, "global_compiler_state", kat.CompilerState())
+    kat.global_compiler_state.use_cache = False
+    instructions: List[kat.Instruction] = kat.code_to_nambly(code, os.path.join(TESTS_LOCATION, "add_scaled.kat"))
+    instructions = kat.inline_functions(instructions)
+    assert kat.global_compiler_state.inlined_calls.get('"add_scaled"') == 500
+    variables: Set[str] = {instruction.argument for instruction in instructions if instruction.opcode == "VSET" and instruction.argument.startswith('"$inl')}
+    assert 0 < len(variables) <= 4
@@ -0,0 +1,83 @@
+"""Runs every program in tests/programs on every backend, with and without optimizations,
+and checks that they all print the same thing.
+
+Each <name>.kat program comes with a <name>.out file holding what it prints on the C++
+NariVM. Programs that must fail also come with a <name>.err file holding the error
+message the compiler or the NariVM reports. The C++ NariVM is only tested if it's in the path.
+
+The transpiled backend runs programs it can't turn into Python on the main loop instead,
+so every program is also checked to transpile.
+"""
+
+from __future__ import annotations
+import os
+import shutil
+import subprocess
+import sys
+from typing import List
+
+import pytest
+
+TESTS_LOCATION = os.path.abspath(os.path.dirname(__file__))
+PROGRAMS_LOCATION = os.path.join(TESTS_LOCATION, "programs")
+KAT_LOCATION = os.path.join(os.path.dirname(TESTS_LOCATION), "kat.py")
+PYTHON_VMS = ("python", "threaded", "transpiled", "tracing")
+VMS = PYTHON_VMS + (("narivm",) if shutil.which("narivm") else ())
+OPTIMIZATION_LEVELS = ("-O0", "-O1")
+PROGRAMS = sorted([name[:-len(".kat")] for name in os.listdir(PROGRAMS_LOCATION) if name.endswith(".kat")])
+
+
+@pytest.fixture(scope="session")
+def cache_location(tmp_path_factory: pytest.TempPathFactory) -> str:
+    """Keeps the compilation cache of the tests away from the one of the user.
+    """
+    return str(tmp_path_factory.mktemp("cache"))
+
+
+def read_expected(program: str, extension: str) -> str:
+    path: str = os.path.join(PROGRAMS_LOCATION, f"{program}.{extension}")
+    if not os.path.exists(path):
+        return ""
+    with open(path) as f:
+        return f.read()
+
+
+# Programs that get past the compiler, whose expected output isn't a compiler error
+COMPILED_PROGRAMS = [program for program in PROGRAMS if "=== Katayln" not in read_expected(program, "out")]
+
+
+def run_program(program: str, vm: str, optimization_level: str, cache_location: str) -> subprocess.CompletedProcess:
+    command: List[str] = [sys.executable, KAT_LOCATION, optimization_level, f"--vm={vm}", f"{program}.kat"]
+    environment = dict(os.environ, XDG_CACHE_HOME=cache_location)
+    return subprocess.run(command, cwd=PROGRAMS_LOCATION, env=environment, capture_output=True, text=True, timeout=120)
+
+
+@pytest.mark.parametrize("optimization_level", OPTIMIZATION_LEVELS)
+@pytest.mark.parametrize("vm", VMS)
+@pytest.mark.parametrize("program", PROGRAMS)
+def test_program(program: str, vm: str, optimization_level: str, cache_location: str):
+    result = run_program(program, vm, optimization_level, cache_location)
+    expected_error: str = read_expected(program, "err").strip()
+    assert result.stdout == read_expected(program, "out")
+    if expected_error:
+        assert result.returncode == 1
+        # The compiler reports its errors on the standard output and the NariVM on the standard error
+        assert expected_error in result.stderr or expected_error in result.stdout
+    else:
+        assert result.returncode == 0, result.stderr
+
+
+@pytest.mark.parametrize("optimization_level", OPTIMIZATION_LEVELS)
+@pytest.mark.parametrize("program", COMPILED_PROGRAMS)
+def test_program_transpiles(program: str, optimization_level: str, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.syspath_prepend(os.path.dirname(KAT_LOCATION))
+    import kat
+    monkeypatch.setattr(kat, "global_compiler_state", kat.CompilerState())
+    kat.global_compiler_state.use_cache = False
+    kat.global_compiler_state.optimization_level = int(optimization_level[2:])
+    instructions: List[kat.Instruction] = kat.file_to_nambly(os.path.join(kat.STDLIB_LOCATION, "stdlib.kat"))
+    instructions += kat.file_to_nambly(os.path.join(PROGRAMS_LOCATION, f"{program}.kat"))
+    kat.resolve_shadowed_calls(instructions)
+    if kat.global_compiler_state.optimization_level >= 1:
+        instructions = kat.optimize_peephole(kat.use_fast_calls(kat.eliminate_dead_functions(kat.inline_functions(instructions))))
+    assert kat.load_transpiled_program(kat.resolve_variable_slots(instructions)) is not None